@@ -1,8 +1,44 @@
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import tarfile
+import time
 from pathlib import Path
+from typing import Iterator
 
 import click
+import pyarrow as pa
+
+import catalog_index
+import tiers
+
+"""
+Archives the partitions of a build into tar files of up to a max size, for releases.
+
+Partitions are packed into as few archives as possible (first fit, largest partitions first), and the
+archives are written in parallel. Each archive is streamed through the compressor as it's written,
+with gzip (`.tar.gz`), zstd (`.tar.zst`, much faster) or no compression (`.tar`, since parquet files
+are already compressed).
+
+Each member of an archive (its tar header and data) is compressed separately, as its own gzip members
+or zstd frames. Concatenated, they're still a regular `.tar.gz` or `.tar.zst`, but any member can also
+be decompressed on its own. The archives are listed in a manifest next to them, with the archive, byte
+offset, length and SHA-256 checksum of every file, so a client can fetch (e.g. with an HTTP range
+request) and extract only the partitions it needs (see `extract`).
+"""
+
+SUFFIXES = {
+    "gzip": ".tar.gz",
+    "zstd": ".tar.zst",
+    "none": ".tar",
+}
+
+MANIFEST_FILENAME = "gaia-dr3-manifest.json"
+
+# size of the chunks of each member that are compressed (as separate frames)
+CHUNK_SIZE = 16 * 1024**2
 
 
 def get_dir_size(p: Path) -> int:
@@ -16,10 +52,146 @@ def get_dir_size(p: Path) -> int:
     return total
 
 
-def archive(paths, output_filename):
-    with tarfile.open(output_filename, "w:gz") as tar:
-        for p in paths:
-            tar.add(p, arcname=p.name)
+def member_chunks(path: Path, info: tarfile.TarInfo, checksum) -> Iterator[bytes]:
+    """Yields a tar member (header, data and padding) in chunks of about CHUNK_SIZE"""
+    buffer = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+    if info.isfile():
+        with open(path, "rb") as f:
+            while data := f.read(CHUNK_SIZE):
+                checksum.update(data)
+                buffer += data
+                if len(buffer) >= CHUNK_SIZE:
+                    yield buffer
+                    buffer = b""
+        padding = -info.size % tarfile.BLOCKSIZE
+        buffer += tarfile.NUL * padding
+    if buffer:
+        yield buffer
+
+
+def archive_members(paths, source_path) -> Iterator[tuple[Path, tarfile.TarInfo]]:
+    """Yields each path (and everything in it, for directories) with its tar header"""
+    for path in paths:
+        path = Path(path)
+        stat = path.stat()
+        info = tarfile.TarInfo(str(path.relative_to(source_path)))
+        info.mtime = int(stat.st_mtime)
+        info.mode = stat.st_mode & 0o7777
+        if path.is_dir():
+            info.type = tarfile.DIRTYPE
+            yield path, info
+            yield from archive_members(sorted(path.iterdir()), source_path)
+        else:
+            info.size = stat.st_size
+            yield path, info
+
+
+def archive(
+    paths, output_filename, source_path, compression="gzip"
+) -> tuple[list[dict], str]:
+    """
+    Writes paths (relative to the source path) to a tar file, compressing each member separately.
+    Returns the offset, length (in the archive), size and checksum of each file in it, and the
+    checksum of the archive.
+    """
+    partial = Path(output_filename).with_name(f"{Path(output_filename).name}.partial")
+    files = []
+    archive_checksum = hashlib.sha256()
+
+    def write(data):
+        if compression != "none":
+            data = pa.compress(data, codec=compression, asbytes=True)
+        archive_checksum.update(data)
+        sink.write(data)
+
+    with open(partial, "wb") as sink:
+        for path, info in archive_members(paths, source_path):
+            offset = sink.tell()
+            checksum = hashlib.sha256()
+            for chunk in member_chunks(path, info, checksum):
+                write(chunk)
+            if info.isfile():
+                files.append(
+                    dict(
+                        path=info.name,
+                        partition=str(Path(info.name).parent),
+                        archive=Path(output_filename).name,
+                        offset=offset,
+                        length=sink.tell() - offset,
+                        size=info.size,
+                        sha256=checksum.hexdigest(),
+                    )
+                )
+        # end of archive
+        write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+
+    partial.rename(output_filename)
+    return files, archive_checksum.hexdigest()
+
+
+def archive_worker(args) -> dict:
+    time_start = time.time()
+    paths, output_filename, source_path, compression, size = args
+    files, checksum = archive(paths, output_filename, source_path, compression)
+    return dict(
+        filename=Path(output_filename).name,
+        size=size,
+        archived_size=Path(output_filename).stat().st_size,
+        sha256=checksum,
+        files=files,
+        duration=time.time() - time_start,
+    )
+
+
+def extract(archive_path, manifest: dict, partition_name, destination) -> list[Path]:
+    """
+    Extracts a partition's files from the archives in `archive_path`, reading only their bytes
+    (as listed in the manifest), and returns the paths of the extracted files
+    """
+    extracted = []
+    for file in manifest["files"]:
+        if file["partition"] != partition_name:
+            continue
+
+        with open(Path(archive_path) / file["archive"], "rb") as f:
+            f.seek(file["offset"])
+            data = f.read(file["length"])
+        if manifest["compression"] != "none":
+            data = pa.input_stream(
+                pa.py_buffer(data), compression=manifest["compression"]
+            ).read()
+
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            member = tar.next()
+            content = tar.extractfile(member).read()
+        if hashlib.sha256(content).hexdigest() != file["sha256"]:
+            raise ValueError(f"Checksum of {file['path']} doesn't match the manifest")
+
+        output_filename = Path(destination) / file["path"]
+        output_filename.parent.mkdir(parents=True, exist_ok=True)
+        output_filename.write_bytes(content)
+        extracted.append(output_filename)
+
+    return extracted
+
+
+def pack(sizes: dict[str, int], max_size: int) -> list[list[str]]:
+    """
+    Packs items into as few groups of up to `max_size` as it can (first fit decreasing), and
+    returns each group's items. An item larger than the max gets a group of its own.
+    """
+    groups = []
+    group_sizes = []
+    for name in sorted(sizes, key=lambda name: -sizes[name]):
+        for i, group_size in enumerate(group_sizes):
+            if group_size + sizes[name] <= max_size:
+                groups[i].append(name)
+                group_sizes[i] += sizes[name]
+                break
+        else:
+            groups.append([name])
+            group_sizes.append(sizes[name])
+    return [sorted(group) for group in groups]
 
 
 @click.command()
@@ -28,36 +200,80 @@ def archive(paths, output_filename):
 @click.option(
     "--max_filesize", default=2048, help="Max filesize per archived file, in MB"
 )
-def main(source, destination, max_filesize):
+@click.option(
+    "--compression",
+    default="gzip",
+    type=click.Choice(list(SUFFIXES)),
+    help="Compression of the archives (parquet files are already compressed, so zstd or none is much faster)",
+)
+@click.option("--num_workers", default=4, help="Number of archives to write at once")
+def main(source, destination, max_filesize, compression, num_workers):
+    time_start = time.time()
     source_path = Path(source)
     destination_path = Path(destination)
-    partition_names = sorted(
-        [item.name for item in source_path.iterdir() if item.is_dir()]
-    )
+    partition_names = tiers.partition_names(source_path)
 
     max_filesize_bytes = max_filesize * 1024 * 1024
+    sizes = {name: get_dir_size(source_path / name) for name in partition_names}
+    groups = pack(sizes, max_filesize_bytes)
+
+    items = []
+    for ctr, group in enumerate(groups):
+        paths = [source_path / name for name in group]
+        # the indexes of the build (its row groups and, if it's tiered, its tiers) go in the first archive
+        if ctr == 0:
+            paths[:0] = [
+                source_path / filename
+                for filename in (tiers.INDEX_FILENAME, catalog_index.INDEX_FILENAME)
+                if (source_path / filename).exists()
+            ]
+        output_filename = destination_path / f"gaia-dr3-p{ctr}{SUFFIXES[compression]}"
+        items.append(
+            (
+                paths,
+                output_filename,
+                source_path,
+                compression,
+                sum(sizes[name] for name in group),
+            )
+        )
 
-    ctr = 0
-    group_size = 0
-    group_paths = []
-
-    for partition_name in partition_names:
-        path = Path(source_path / partition_name)
-        dir_size = get_dir_size(str(path))
-        if group_size + dir_size > max_filesize_bytes:
-            output_filename = destination_path / f"gaia-dr3-p{ctr}.tar.gz"
-            print(f"Archiving {output_filename} | {str(int(group_size / 1024**2))} MB")
-            archive(group_paths, output_filename)
-            group_paths = []
-            group_size = 0
-            ctr += 1
-        group_paths.append(path)
-        group_size += dir_size
-
-    if group_paths:
-        output_filename = destination_path / f"gaia-dr3-p{ctr}.tar.gz"
-        print(f"Archiving {output_filename} | {str(int(group_size / 1024**2))} MB")
-        archive(group_paths, output_filename)
+    print(f"Archiving {len(partition_names):,} partitions into {len(items):,} archives")
+    total_size = 0
+    total_archived_size = 0
+    archives = []
+    files = []
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        for result in pool.imap_unordered(archive_worker, items):
+            total_size += result["size"]
+            total_archived_size += result["archived_size"]
+            archives.append(
+                dict(
+                    name=result["filename"],
+                    size=result["archived_size"],
+                    sha256=result["sha256"],
+                )
+            )
+            files.extend(result["files"])
+            print(
+                f"Archived {result['filename']} | {result['size'] / 1024**2:,.0f} MB "
+                f"-> {result['archived_size'] / 1024**2:,.0f} MB | {result['duration']:.2f}s "
+                f"| {result['size'] / 1024**2 / max(result['duration'], 1e-9):,.1f} MB/s"
+            )
+
+    manifest = dict(
+        compression=compression,
+        archives=sorted(archives, key=lambda a: a["name"]),
+        files=sorted(files, key=lambda f: f["path"]),
+    )
+    with open(destination_path / MANIFEST_FILENAME, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    duration = time.time() - time_start
+    print(
+        f"Done: {total_size / 1024**2:,.0f} MB -> {total_archived_size / 1024**2:,.0f} MB "
+        f"| {duration:.2f}s | {total_size / 1024**2 / max(duration, 1e-9):,.1f} MB/s"
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import click
+
+import bench_build
+import bench_conversions
+import bench_crossmatch
+import bench_pipeline
+import bench_query
+import bench_write
+
+"""Benchmarks for the catalog pipeline, run against synthetic Gaia data (see bench_*.py for each area)."""
+
+
+@click.group()
+def cli():
+    pass
+
+
+for command in [
+    bench_build.build_benchmark,
+    bench_build.stream_benchmark,
+    bench_build.staging_benchmark,
+    bench_build.variants_benchmark,
+    bench_build.sampling_benchmark,
+    bench_conversions.constellations_benchmark,
+    bench_conversions.photometry_benchmark,
+    bench_crossmatch.crossmatch_benchmark,
+    bench_write.writer_benchmark,
+    bench_write.squash_benchmark,
+    bench_write.profile_benchmark,
+    bench_query.subindex_benchmark,
+    bench_query.index_benchmark,
+    bench_query.query_benchmark,
+    bench_pipeline.pipeline_benchmark,
+]:
+    cli.add_command(command)
+
+
+if __name__ == "__main__":
+    cli()
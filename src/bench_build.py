@@ -0,0 +1,186 @@
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+import build
+import crossmatch
+import settings
+import staging
+import utils
+from bench_utils import build_source_file, logger, measure_peak_rss, write_gaia_source
+
+"""Benchmarks of reading source files and building catalog variants from them."""
+
+
+@click.command("build")
+@click.option("--rows", default=200_000, help="Number of stars in the source file")
+@click.option("--sample_rate", default=1.0, help="Random sampling rate")
+def build_benchmark(rows, sample_rate):
+    """Compares rows/sec of the object and columnar build methods"""
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = write_gaia_source(Path(tmp) / "gaia", rows)
+
+        source_ids = build.read_source(
+            gaia_path / "gaia_source" / "GaiaSource_000000.csv.gz"
+        )["source_id"].to_list()
+        crossmatch_hip = pl.DataFrame(
+            {"source_id": source_ids[::1000], "hip": range(len(source_ids[::1000]))}
+        )
+        crossmatch_tyc = pl.DataFrame(
+            {
+                "source_id": source_ids[::100],
+                "tyc": [f"{n}-1" for n in range(len(source_ids[::100]))],
+            }
+        )
+
+        for method in ["objects", "columnar"]:
+            destination = Path(tmp) / method
+            random.seed(2016)
+
+            time_start = time.time()
+            build.build(
+                0,
+                logger,
+                gaia_path=gaia_path,
+                variants=[build.Variant(destination, 4, 6, 18, sample_rate)],
+                crossmatch_hip=crossmatch.to_dict(crossmatch_hip)
+                if method == "objects"
+                else crossmatch_hip,
+                crossmatch_tyc=crossmatch.to_dict(crossmatch_tyc)
+                if method == "objects"
+                else crossmatch_tyc,
+                method=method,
+            )
+            duration = time.time() - time_start
+
+            written = pq.ParquetDataset(destination, schema=settings.SCHEMA).read()
+            print(
+                f"{method:<10} | {rows / duration:>12,.0f} rows/sec | "
+                f"{duration:.2f}s | {written.num_rows:,} stars written"
+            )
+
+
+@click.command("stream")
+@click.option("--rows", default=1_000_000, help="Number of stars in the source file")
+@click.option(
+    "--batch_size",
+    "batch_sizes",
+    multiple=True,
+    default=[0, 64, 16, 4],
+    help="Batch sizes to compare, in MB of CSV (0 reads the whole file)",
+)
+def stream_benchmark(rows, batch_sizes):
+    """Compares peak RSS and rows/sec of reading source files whole vs in batches"""
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = write_gaia_source(Path(tmp) / "gaia", rows)
+
+        expected = None
+        for batch_size in batch_sizes:
+            destination = Path(tmp) / f"batch-{batch_size}"
+            duration, peak = measure_peak_rss(
+                build_source_file, gaia_path, destination, batch_size
+            )
+            written = pq.ParquetDataset(destination, schema=settings.SCHEMA).read()
+            written = written.sort_by([("pk", "ascending")])
+            if expected is None:
+                expected = written
+            assert written.equals(expected), f"batch_size {batch_size} output differs"
+
+            print(
+                f"batch_size {batch_size:>4} MB | {rows / duration:>12,.0f} rows/sec | "
+                f"peak RSS +{peak:>8,.1f} MB | {written.num_rows:,} stars written"
+            )
+
+
+@click.command("staging")
+@click.option("--rows", default=1_000_000, help="Number of stars in the source file")
+def staging_benchmark(rows):
+    """Compares reading a source file from its CSV and from its staged Parquet copy"""
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = write_gaia_source(Path(tmp) / "gaia", rows)
+        source = gaia_path / "gaia_source" / "GaiaSource_000000.csv.gz"
+        staged = staging.stage(source, Path(tmp))
+
+        for label, filename in [
+            ("csv", source),
+            ("staged", Path(tmp) / staged["filename"]),
+        ]:
+            time_start = time.time()
+            df = build.read_source(filename)
+            duration = time.time() - time_start
+            print(
+                f"{label:<10} | {rows / duration:>12,.0f} rows/sec | {duration:.2f}s "
+                f"| {filename.stat().st_size / 1024**2:,.1f} MB on disk"
+            )
+            assert df.height == rows
+
+
+@click.command("variants")
+@click.option("--rows", default=1_000_000, help="Number of stars in the source file")
+def variants_benchmark(rows):
+    """Compares building the Makefile's variants one at a time, and all in a single pass"""
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = write_gaia_source(Path(tmp) / "gaia", rows)
+        specs = [(2, 9, 16, 0.5), (4, 6, 18, 0.8), (4, 6, 18, 1.0), (8, 6, 30, 1.0)]
+
+        time_start = time.time()
+        for n, spec in enumerate(specs):
+            variant = build.Variant(Path(tmp) / f"single-{n}", *spec)
+            build_source_file(gaia_path, None, variants=[variant])
+        duration_single = time.time() - time_start
+
+        time_start = time.time()
+        variants = [
+            build.Variant(Path(tmp) / f"multi-{n}", *spec)
+            for n, spec in enumerate(specs)
+        ]
+        build_source_file(gaia_path, None, variants=variants)
+        duration_multi = time.time() - time_start
+
+        for n in range(len(specs)):
+            single = pq.ParquetDataset(
+                Path(tmp) / f"single-{n}", schema=settings.SCHEMA
+            )
+            multi = pq.ParquetDataset(Path(tmp) / f"multi-{n}", schema=settings.SCHEMA)
+            assert single.read().sort_by("pk").equals(multi.read().sort_by("pk"))
+
+        print(
+            f"one at a time | {rows * len(specs) / duration_single:>12,.0f} rows/sec | {duration_single:.2f}s"
+        )
+        print(
+            f"single pass   | {rows * len(specs) / duration_multi:>12,.0f} rows/sec | {duration_multi:.2f}s"
+        )
+
+
+@click.command("sampling")
+@click.option("--rows", default=10_000_000, help="Number of source ids to sample")
+@click.option("--seed", default=2016, help="Sampling seed")
+def sampling_benchmark(rows, seed):
+    """Compares hash sampling to per-row random sampling, and checks nested rates are subsets"""
+    rng = np.random.default_rng(seed)
+    source_ids = rng.choice(2**59, size=rows, replace=False)
+
+    random.seed(seed)
+    time_start = time.time()
+    kept = sum(1 for _ in source_ids[: rows // 10] if random.random() <= 0.8)
+    duration = time.time() - time_start
+    print(f"random     | {rows // 10 / duration:>12,.0f} rows/sec | kept {kept:,}")
+
+    time_start = time.time()
+    masks = {
+        rate: utils.sample_mask(source_ids, seed, rate) for rate in (0.5, 0.8, 1.0)
+    }
+    duration = time.time() - time_start
+    print(f"hash       | {rows * len(masks) / duration:>12,.0f} rows/sec")
+
+    for rate, mask in masks.items():
+        print(f"rate {rate:<5} | kept {mask.mean():.4f} of stars")
+    assert not (masks[0.5] & ~masks[0.8]).any()
+    assert not (masks[0.8] & ~masks[1.0]).any()
+    print("nested     | 0.5 sample is a subset of 0.8, which is a subset of 1.0")
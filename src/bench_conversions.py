@@ -0,0 +1,68 @@
+import time
+
+import click
+import numpy as np
+import polars as pl
+
+import build
+import constellations
+import utils
+
+"""Benchmarks of the batched constellation lookup and the vectorized photometric conversions."""
+
+
+@click.command("constellations")
+@click.option("--points", default=5_000_000, help="Number of random points to look up")
+@click.option("--sample", default=50_000, help="Number of points to look up per-row")
+def constellations_benchmark(points, sample):
+    """Benchmarks the batched constellation lookup against the per-row one (`verify.py` checks they match)"""
+    rng = np.random.default_rng(2016)
+    ra = rng.uniform(0, 360, points)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, points)))
+
+    time_start = time.time()
+    constellations.lookup_grid()
+    print(f"grid       | built in {time.time() - time_start:.2f}s")
+
+    time_start = time.time()
+    constellations.constellation_ids(ra, dec)
+    duration = time.time() - time_start
+    print(f"batched    | {points / duration:>12,.0f} stars/sec | {duration:.2f}s")
+
+    time_start = time.time()
+    for r, d in zip(ra[:sample], dec[:sample]):
+        build.constellation_map(build.position_of_radec(r / 15, d))
+    duration = time.time() - time_start
+    print(f"per-row    | {sample / duration:>12,.0f} stars/sec | {duration:.2f}s")
+
+
+@click.command("photometry")
+@click.option("--rows", default=5_000_000, help="Number of stars to convert")
+@click.option("--sample", default=200_000, help="Number of stars to convert per-row")
+def photometry_benchmark(rows, sample):
+    """Benchmarks the vectorized photometric conversions against the scalar versions (`verify.py` checks they match)"""
+    rng = np.random.default_rng(2016)
+    phot_g_mean_mag = rng.uniform(3, 21, rows)
+    bp_rp = rng.uniform(-1, 6, rows)
+    phot_g_mean_mag[rng.random(rows) < 0.01] = np.nan
+    bp_rp[rng.random(rows) < 0.1] = np.nan
+
+    time_start = time.time()
+    for g, b in zip(phot_g_mean_mag[:sample], bp_rp[:sample]):
+        if not np.isnan(g + b):
+            utils.get_bv_v(g, b)
+    duration = time.time() - time_start
+    print(f"scalar     | {sample / duration:>12,.0f} stars/sec")
+
+    time_start = time.time()
+    utils.get_bv_v_array(phot_g_mean_mag, bp_rp)
+    duration = time.time() - time_start
+    print(f"numpy      | {rows / duration:>12,.0f} stars/sec")
+
+    df = pl.DataFrame({"phot_g_mean_mag": phot_g_mean_mag, "bp_rp": bp_rp})
+    df = df.with_columns(pl.all().fill_nan(None))
+    time_start = time.time()
+    bv_expr, v_expr = utils.get_bv_v_expr(pl.col("phot_g_mean_mag"), pl.col("bp_rp"))
+    df.select(bv=bv_expr, v=v_expr)
+    duration = time.time() - time_start
+    print(f"polars     | {rows / duration:>12,.0f} stars/sec")
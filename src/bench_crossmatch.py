@@ -0,0 +1,150 @@
+import csv
+import multiprocessing
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+
+import crossmatch
+import synthetic
+from bench_utils import measure_rss
+
+"""Benchmarks of loading and joining crossmatches in build workers."""
+
+
+def read_crossmatch_dict(source_path, cast=int):
+    """The original crossmatch reader, which parsed the CSV into a dict in main()"""
+    with open(source_path, mode="r") as csv_file:
+        reader = csv.DictReader(csv_file)
+        return {
+            int(row["source_id"]): cast(row["original_ext_source_id"]) for row in reader
+        }
+
+
+def load_pickled_crossmatch(pickle_path):
+    with open(pickle_path, "rb") as f:
+        return pickle.load(f)
+
+
+def memory_usage() -> dict:
+    """Returns Rss, Pss and private memory of this process in MB (Linux only)"""
+    usage = {"Private": 0}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss"):
+                usage[name] = int(value.split()[0]) / 1024
+            elif name.startswith("Private_"):
+                usage["Private"] += int(value.split()[0]) / 1024
+    return usage
+
+
+def hold_crossmatch(queue, barrier, method, cache_path, source_ids):
+    """Loads and joins a crossmatch like a build worker, then reports memory while all workers hold it"""
+    usage_start = memory_usage()
+    if method == "index":
+        loaded = crossmatch.load_index(cache_path, "tyc")
+    else:
+        loaded = crossmatch.load(cache_path)
+    crossmatch.join(pl.DataFrame({"source_id": source_ids}), loaded)
+
+    barrier.wait()
+    usage = memory_usage()
+    barrier.wait()
+    queue.put({k: v - usage_start[k] for k, v in usage.items()})
+
+
+def measure_workers_memory(num_workers, *args) -> dict:
+    """Runs `hold_crossmatch` in spawned workers concurrently, and returns their mean memory growth"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    barrier = context.Barrier(num_workers)
+    workers = [
+        context.Process(target=hold_crossmatch, args=(queue, barrier, *args))
+        for _ in range(num_workers)
+    ]
+    for w in workers:
+        w.start()
+    results = [queue.get() for _ in workers]
+    for w in workers:
+        w.join()
+    return {k: sum(r[k] for r in results) / num_workers for k in results[0]}
+
+
+@click.command("crossmatch")
+@click.option("--rows", default=2_500_000, help="Number of crossmatched stars")
+@click.option("--num_workers", default=12, help="Number of concurrent build workers")
+def crossmatch_benchmark(rows, num_workers):
+    """Compares the crossmatch dicts shipped to every worker with the cached Parquet crossmatch and index"""
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = Path(tmp) / crossmatch.TYC_CSV
+        rng = np.random.default_rng(2016)
+        source_ids = rng.choice(2**59, size=rows, replace=False)
+        synthetic.write_crossmatch_file(
+            csv_path, source_ids, [f"{n}-{n % 1000}-1" for n in range(rows)]
+        )
+
+        time_start = time.time()
+        crossmatch_dict = read_crossmatch_dict(csv_path, cast=str)
+        parse_duration = time.time() - time_start
+
+        pickle_path = Path(tmp) / "crossmatch.pickle"
+        with open(pickle_path, "wb") as f:
+            pickle.dump(crossmatch_dict, f)
+
+        time_start = time.time()
+        load_pickled_crossmatch(pickle_path)
+        load_duration = time.time() - time_start
+
+        print(
+            f"dict       | parse {parse_duration:.2f}s | "
+            f"{pickle_path.stat().st_size / 1024**2:,.1f} MB pickled per worker | "
+            f"worker load {load_duration:.2f}s | "
+            f"worker RSS +{measure_rss(load_pickled_crossmatch, pickle_path):,.0f} MB"
+        )
+
+        time_start = time.time()
+        cache_path = crossmatch.cache(csv_path, "tyc", pl.String)
+        parse_duration = time.time() - time_start
+
+        time_start = time.time()
+        loaded = crossmatch.load(cache_path)
+        load_duration = time.time() - time_start
+
+        print(
+            f"parquet    | parse {parse_duration:.2f}s | "
+            f"{cache_path.stat().st_size / 1024**2:,.1f} MB cached on disk | "
+            f"worker load {load_duration:.2f}s | "
+            f"worker RSS +{measure_rss(crossmatch.load, cache_path):,.0f} MB"
+        )
+
+        gaia = pl.DataFrame({"source_id": source_ids[::10]})
+        time_start = time.time()
+        joined = crossmatch.join(gaia, loaded)
+        print(
+            f"join       | {gaia.height / (time.time() - time_start):>12,.0f} stars/sec | "
+            f"{joined['tyc'].is_not_null().sum():,} matched"
+        )
+
+        index = crossmatch.load_index(cache_path, "tyc")
+        time_start = time.time()
+        joined_index = crossmatch.join(gaia, index)
+        print(
+            f"index join | {gaia.height / (time.time() - time_start):>12,.0f} stars/sec | "
+            f"{joined_index['tyc'].is_not_null().sum():,} matched"
+        )
+        assert joined_index.equals(joined)
+
+        # one source file's worth of lookups per worker
+        lookups = source_ids[rng.choice(rows, size=50_000)]
+        for method in ["parquet", "index"]:
+            usage = measure_workers_memory(num_workers, method, cache_path, lookups)
+            print(
+                f"{method:<10} | {num_workers} workers | per worker: "
+                f"RSS +{usage['Rss']:,.0f} MB, private +{usage['Private']:,.0f} MB, "
+                f"PSS +{usage['Pss']:,.0f} MB"
+            )
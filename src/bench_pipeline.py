@@ -0,0 +1,208 @@
+import contextlib
+import io
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import pyarrow.parquet as pq
+
+import archive
+import synthetic
+import tiers
+from bench_utils import files_written
+
+"""Benchmark of the whole pipeline (build, squash and archive) on synthetic Gaia data."""
+
+
+# Runs a command and prints the peak RSS of its processes. It's run in a fresh interpreter, since a process's
+# ru_maxrss starts from the RSS of the process that started it (it's kept across exec).
+MEASURE_STAGE = (
+    "import resource, subprocess, sys; "
+    "subprocess.run(sys.argv[1:], check=True, stdout=sys.stderr); "
+    "print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)"
+)
+
+
+def run_stage(script, *args, cwd) -> tuple[float, float]:
+    """
+    Runs a pipeline script in a subprocess (with its output in `<script>.log` in `cwd`), and returns its
+    duration and peak RSS in MB (of the largest process, i.e. the script or any of its workers)
+    """
+    command = [sys.executable, "-c", MEASURE_STAGE, sys.executable]
+    command += [str(Path(__file__).resolve().parent / script)]
+    command += [str(arg) for arg in args]
+    log_filename = Path(cwd) / f"{Path(script).stem}.log"
+    time_start = time.time()
+    with open(log_filename, "w") as log:
+        result = subprocess.run(
+            command, cwd=cwd, stdout=subprocess.PIPE, stderr=log, text=True
+        )
+    duration = time.time() - time_start
+    if result.returncode != 0:
+        log = log_filename.read_text().splitlines()
+        raise click.ClickException("\n".join([f"{script} failed:", *log[-20:]]))
+
+    # ru_maxrss is in bytes on macOS, and kilobytes on Linux
+    maxrss = int(result.stdout.split()[-1])
+    return duration, maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
+
+
+def catalog_rows(path: Path) -> int:
+    """Returns number of stars in the partitions of a build"""
+    return sum(
+        pq.read_metadata(filename).num_rows
+        for partition_name in tiers.partition_names(path)
+        for filename in (path / partition_name).glob("*.parquet")
+    )
+
+
+@click.command("pipeline")
+@click.option("--num_files", default=8, help="Number of source files")
+@click.option(
+    "--rows_per_file",
+    default=250_000,
+    help="Number of stars per file (on average, the sky isn't uniform)",
+)
+@click.option("--num_workers", default=4, help="Number of workers of each stage")
+@click.option("--nside", default=4, help="HEALPix NSIDE to build")
+@click.option("--mag_min", default=6, help="Minimum magnitude to build")
+@click.option("--mag_max", default=18, help="Maximum magnitude to build")
+@click.option(
+    "--compression",
+    default="gzip",
+    type=click.Choice(list(archive.SUFFIXES)),
+    help="Compression of the archives",
+)
+@click.option(
+    "--destination",
+    default=None,
+    help="Path to keep the synthetic data, build and archives in (defaults to a temporary directory)",
+)
+@click.option("--output", default=None, help="JSON file of the results")
+def pipeline_benchmark(
+    num_files,
+    rows_per_file,
+    num_workers,
+    nside,
+    mag_min,
+    mag_max,
+    compression,
+    destination,
+    output,
+):
+    """Runs build, squash and archive on realistic synthetic Gaia data, and reports throughput and peak RSS of each"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(destination or tmp)
+        gaia_path = path / "gaia"
+        build_path = path / "build"
+        archive_path = path / "archive"
+        for p in (gaia_path, build_path, archive_path):
+            shutil.rmtree(p, ignore_errors=True)
+        archive_path.mkdir(parents=True)
+
+        time_start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            synthetic.write_catalog(gaia_path, num_files, rows_per_file)
+        source_rows = num_files * rows_per_file
+        source_bytes = files_written(gaia_path)[1]
+        print(
+            f"{'synthetic':<8} | {source_rows:,} stars in {num_files} files "
+            f"| {source_bytes / 1024**2:,.1f} MB | {time.time() - time_start:.2f}s"
+        )
+
+        stages = []
+
+        def report(name, duration, peak, rows, bytes_in, bytes_out):
+            stage = dict(
+                stage=name,
+                duration=duration,
+                rows=rows,
+                rows_per_sec=rows / duration,
+                bytes_in=bytes_in,
+                bytes_out=bytes_out,
+                mb_per_sec=bytes_in / 1024**2 / duration,
+                peak_rss_mb=peak,
+            )
+            stages.append(stage)
+            print(
+                f"{name:<8} | {duration:>8.2f}s | {stage['rows_per_sec']:>12,.0f} rows/sec "
+                f"| {stage['mb_per_sec']:>8,.1f} MB/s | peak RSS {peak:>8,.1f} MB "
+                f"| {bytes_in / 1024**2:,.1f} MB -> {bytes_out / 1024**2:,.1f} MB"
+            )
+
+        duration, peak = run_stage(
+            "build.py",
+            "--source",
+            gaia_path,
+            "--destination",
+            build_path,
+            "--stop",
+            num_files - 1,
+            "--num_workers",
+            num_workers,
+            "--nside",
+            nside,
+            "--mag_min",
+            mag_min,
+            "--mag_max",
+            mag_max,
+            cwd=path,
+        )
+        built_rows = catalog_rows(build_path)
+        built_bytes = files_written(build_path)[1]
+        report("build", duration, peak, source_rows, source_bytes, built_bytes)
+
+        duration, peak = run_stage(
+            "squash.py",
+            "--source",
+            build_path,
+            "--num_workers",
+            num_workers,
+            cwd=path,
+        )
+        squashed_bytes = files_written(build_path)[1]
+        report("squash", duration, peak, built_rows, built_bytes, squashed_bytes)
+        assert catalog_rows(build_path) == built_rows
+
+        duration, peak = run_stage(
+            "archive.py",
+            "--source",
+            build_path,
+            "--destination",
+            archive_path,
+            "--compression",
+            compression,
+            "--num_workers",
+            num_workers,
+            cwd=path,
+        )
+        report(
+            "archive",
+            duration,
+            peak,
+            built_rows,
+            squashed_bytes,
+            files_written(archive_path)[1],
+        )
+
+        if output:
+            with open(output, "w") as f:
+                json.dump(
+                    dict(
+                        num_files=num_files,
+                        rows_per_file=rows_per_file,
+                        num_workers=num_workers,
+                        nside=nside,
+                        mag_min=mag_min,
+                        mag_max=mag_max,
+                        compression=compression,
+                        stages=stages,
+                    ),
+                    f,
+                    indent=1,
+                )
@@ -0,0 +1,485 @@
+import contextlib
+import functools
+import io
+import json
+import operator
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from astropy import units as u
+from astropy_healpix import HEALPix
+
+import build
+import catalog_index
+import settings
+import squash
+import subindex
+import synthetic
+import tiers
+from bench_utils import build_source_file, measure_peak_rss
+
+"""Benchmarks of querying built catalogs: the sub-index, the catalog index, and fields of view like m13.py's."""
+
+
+def cone_query(filename, ra, dec, radius, where, subindex_nside=0, repeat=5):
+    """
+    Queries stars in a cone from a squashed partition, and returns the number of row groups read,
+    the median duration and the number of stars in the cone
+    """
+    if subindex_nside:
+        column = ds.field(subindex.SUBINDEX_COLUMN)
+        ranges = subindex.subindex_ranges(ra, dec, radius, subindex_nside)
+        within = [(column >= lo) & (column <= hi) for lo, hi in ranges]
+        where = where & functools.reduce(operator.or_, within)
+
+    dataset = ds.dataset(filename, format="parquet")
+    row_groups = sum(
+        len(fragment.split_by_row_group(where))
+        for fragment in dataset.get_fragments(where)
+    )
+
+    durations = []
+    for _ in range(repeat):
+        time_start = time.time()
+        table = dataset.to_table(filter=where)
+        durations.append(time.time() - time_start)
+
+    # exact cone, from the rows read
+    ra_, dec_ = np.radians(table["ra"].to_numpy()), np.radians(table["dec"].to_numpy())
+    cos_distance = np.sin(dec_) * np.sin(np.radians(dec)) + np.cos(dec_) * np.cos(
+        np.radians(dec)
+    ) * np.cos(ra_ - np.radians(ra))
+    stars = int(np.sum(cos_distance >= np.cos(np.radians(radius))))
+
+    return row_groups, float(np.median(durations)), stars
+
+
+@click.command("subindex")
+@click.option("--num_files", default=8, help="Number of source files")
+@click.option("--rows_per_file", default=1_000_000, help="Number of stars per file")
+@click.option("--nside", default=4, help="HEALPix NSIDE of the partitions")
+@click.option("--subindex_nside", default=256, help="HEALPix NSIDE of the sub-index")
+@click.option(
+    "--radius",
+    default=0.56,
+    help="Radius of the query, in degrees (default is the m13.py optic's field of view)",
+)
+def subindex_benchmark(num_files, rows_per_file, nside, subindex_nside, radius):
+    """Compares the m13.py query (Omega Centauri, 9 < mag < 18) on partitions with and without a sub-index"""
+    # NGC 5139
+    ra, dec = 201.69683, -47.47958
+    healpix = HEALPix(nside=nside, order="nested")
+    partition = int(healpix.lonlat_to_healpix(ra * u.deg, dec * u.deg))
+    lon, lat = healpix.boundaries_lonlat([partition], step=8)
+    ra_range = (lon.to_value(u.deg).min(), lon.to_value(u.deg).max())
+    dec_range = (lat.to_value(u.deg).min(), lat.to_value(u.deg).max())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = Path(tmp) / "gaia"
+        (gaia_path / "gaia_source").mkdir(parents=True)
+        destination = Path(tmp) / "build"
+        for n in range(num_files):
+            # all stars in (and around) the partition of the target, so it's as dense as the galactic plane
+            synthetic.write_source_file(
+                gaia_path / "gaia_source" / f"GaiaSource_{n:06}.csv.gz",
+                rows_per_file,
+                seed=n,
+                ra_range=ra_range,
+                dec_range=dec_range,
+            )
+            build_source_file(
+                gaia_path,
+                None,
+                variants=[build.Variant(destination, nside, 0, 30, 1.0)],
+                index=n,
+            )
+
+        partition_name = f"healpix_index={partition}"
+        where = (ds.field("magnitude") > 9) & (ds.field("magnitude") < 18)
+        results = {}
+        for n in [0, subindex_nside]:
+            source_path = Path(tmp) / f"squash-{n}"
+            shutil.copytree(destination / partition_name, source_path / partition_name)
+            squash.squash_partition(partition_name, source_path, subindex_nside=n)
+
+            filename = source_path / partition_name / settings.SQUASHED_FILENAME
+            total = pq.read_metadata(filename).num_row_groups
+            results[n] = cone_query(filename, ra, dec, radius, where, n)
+            row_groups, duration, stars = results[n]
+            print(
+                f"subindex_nside {n:>5} | {row_groups:>4}/{total} row groups read | "
+                f"{duration * 1000:>8,.1f} ms | {stars:,} stars in cone"
+            )
+
+        assert results[0][2] == results[subindex_nside][2]
+
+
+def query_partitions(path, healpix_indices, mag_min, mag_max) -> int:
+    """Queries a build the way readers do without an index: discovering hive partitions, then filtering"""
+    partitioning = ds.partitioning(
+        pa.schema([("healpix_index", pa.int64())]), flavor="hive"
+    )
+    dataset = ds.dataset(path, format="parquet", partitioning=partitioning)
+    where = (
+        ds.field("healpix_index").isin(healpix_indices)
+        & (ds.field("magnitude") >= mag_min)
+        & (ds.field("magnitude") <= mag_max)
+    )
+    return dataset.to_table(filter=where).num_rows
+
+
+def query_index(path, healpix_indices, mag_min, mag_max) -> int:
+    """Queries a build by picking files and row groups from its index, and only opening those"""
+    index = catalog_index.read(path)
+    selected = catalog_index.select(index, healpix_indices, mag_min, mag_max)
+    tables = [
+        pq.ParquetFile(Path(path) / filename).read_row_groups(row_groups)
+        for filename, row_groups in selected.items()
+    ]
+    magnitude = ds.field("magnitude")
+    return (
+        ds.dataset(pa.concat_tables(tables))
+        .to_table(filter=(magnitude >= mag_min) & (magnitude <= mag_max))
+        .num_rows
+    )
+
+
+@click.command("index")
+@click.option("--num_files", default=4, help="Number of source files")
+@click.option("--rows_per_file", default=500_000, help="Number of stars per file")
+@click.option("--nside", default=8, help="HEALPix NSIDE to use")
+@click.option(
+    "--repeat",
+    default=5,
+    help="Number of cold queries of each kind (each in a fresh process, after evicting the catalog from the page cache)",
+)
+def index_benchmark(num_files, rows_per_file, nside, repeat):
+    """Compares cold-start latency of the m13.py query, with and without the catalog index"""
+    # NGC 5139, in the m13.py optic's field of view
+    ra, dec, radius = 201.69683, -47.47958, 0.56
+    mag_min, mag_max = 9, 18
+    healpix = HEALPix(nside=nside, order="nested")
+    healpix_indices = (
+        healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg)
+        .astype(int)
+        .tolist()
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = Path(tmp) / "gaia"
+        (gaia_path / "gaia_source").mkdir(parents=True)
+        destination = Path(tmp) / "build"
+        for n in range(num_files):
+            synthetic.write_source_file(
+                gaia_path / "gaia_source" / f"GaiaSource_{n:06}.csv.gz",
+                rows_per_file,
+                seed=n,
+            )
+            build_source_file(
+                gaia_path,
+                None,
+                variants=[build.Variant(destination, nside, 0, 30, 1.0)],
+                index=n,
+            )
+        with contextlib.redirect_stdout(io.StringIO()):
+            squash.main.callback(
+                source=str(destination),
+                num_workers=4,
+                memory_limit=0,
+                memory_budget=0,
+                subindex_nside=0,
+                magnitude_band=1.0,
+                profile="standard",
+                compression_level=9,
+                geometry=True,
+            )
+
+        index_bytes = (destination / catalog_index.INDEX_FILENAME).stat().st_size
+        partitions = len(list(destination.glob("healpix_index=*")))
+        print(
+            f"{partitions:,} partitions | index {index_bytes / 1024:,.1f} KB "
+            f"| query {len(healpix_indices)} partitions, {mag_min} <= mag <= {mag_max}"
+        )
+
+        rows = {}
+        for name, query in [("partitions", query_partitions), ("index", query_index)]:
+            # in a fresh process each time, so nothing is cached in the reader (or the page cache)
+            durations = []
+            for _ in range(repeat):
+                page_cache_dropped = drop_page_cache(destination)
+                durations.append(
+                    measure_peak_rss(
+                        query, destination, healpix_indices, mag_min, mag_max
+                    )[0]
+                )
+            rows[name] = query(destination, healpix_indices, mag_min, mag_max)
+            # without it, cold queries only start from a fresh process (with the files cached)
+            print(
+                f"{name:<10} | {'cold' if page_cache_dropped else 'fresh process'} query "
+                f"{np.median(durations) * 1000:>8,.1f} ms (median of {repeat}) | {rows[name]:,} rows"
+            )
+
+        assert rows["partitions"] == rows["index"]
+
+
+# sky positions of the query benchmark: the m13.py target, dense fields in the galactic plane, and the sparse galactic poles
+QUERY_POSITIONS = {
+    "omega_centauri": (201.69683, -47.47958),
+    "galactic_center": (266.40498, -28.93617),
+    "cygnus": (305.0, 40.0),
+    "north_galactic_pole": (192.85948, 27.12825),
+    "south_galactic_pole": (12.85948, -27.12825),
+}
+
+
+def query_layers(source_path, nside, mag_max) -> list[tuple[Path, int]]:
+    """Returns the path and NSIDE of each part of a build a query reads (each tier it needs, if it's tiered)"""
+    source_path = Path(source_path)
+    if not tiers.is_tiered(source_path):
+        return [(source_path, nside)]
+    return [
+        (source_path / tier["path"], tier["nside"])
+        for tier in tiers.select(tiers.read_index(source_path), mag_max=mag_max)
+    ]
+
+
+def query_healpix(nside, ra, dec, radius) -> list[int]:
+    healpix = HEALPix(nside=nside, order="nested")
+    return sorted(
+        int(i)
+        for i in healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg)
+    )
+
+
+def query_catalog(source_path, nside, ra, dec, radius, mag_max) -> pa.Table:
+    """
+    Queries stars in a cone the way starplot reads a catalog with `spatial_query_method="healpix"`
+    (with DuckDB, filtering hive partitions by HEALPix index, then by magnitude and the exact cone)
+    """
+    # only this benchmark uses DuckDB directly (it's installed as a dependency of starplot)
+    import duckdb
+
+    tables = []
+    for path, layer_nside in query_layers(source_path, nside, mag_max):
+        healpix_indices = ", ".join(
+            str(i) for i in query_healpix(layer_nside, ra, dec, radius)
+        )
+        tables.append(
+            duckdb.sql(
+                f"SELECT * FROM read_parquet('{path}/**/*.parquet', hive_partitioning=true) "
+                f"WHERE healpix_index IN ({healpix_indices}) AND magnitude <= {mag_max}"
+            ).arrow()
+        )
+    table = pa.concat_tables(tables, promote_options="permissive")
+
+    ra_, dec_ = np.radians(table["ra"].to_numpy()), np.radians(table["dec"].to_numpy())
+    cos_distance = np.sin(dec_) * np.sin(np.radians(dec)) + np.cos(dec_) * np.cos(
+        np.radians(dec)
+    ) * np.cos(ra_ - np.radians(ra))
+    return table.filter(pa.array(cos_distance >= np.cos(np.radians(radius))))
+
+
+def query_scanned(source_path, nside, ra, dec, radius, mag_max) -> dict:
+    """
+    Estimates the number of partitions, row groups, rows and bytes a query has to read, from the
+    footers of the files in its partitions: row groups with only fainter stars are skipped, the way
+    a reader skips them by their statistics (DuckDB doesn't report what it actually read)
+    """
+    scanned = dict(partitions=0, row_groups=0, rows=0, bytes=0)
+    for path, layer_nside in query_layers(source_path, nside, mag_max):
+        for healpix_index in query_healpix(layer_nside, ra, dec, radius):
+            partition_path = path / f"healpix_index={healpix_index}"
+            if not partition_path.exists():
+                continue
+            scanned["partitions"] += 1
+            for filename in sorted(partition_path.glob("*.parquet")):
+                for row_group in catalog_index.row_groups(path, filename):
+                    if (row_group["magnitude_min"] or -np.inf) > mag_max:
+                        continue
+                    scanned["row_groups"] += 1
+                    scanned["rows"] += row_group["rows"]
+                    scanned["bytes"] += row_group["length"]
+    return scanned
+
+
+def drop_page_cache(source_path) -> bool:
+    """
+    Evicts the files of a catalog (its partitions and index files) from the OS page cache (where
+    `posix_fadvise` is available, i.e. not on macOS), so the next query reads them from disk. Returns
+    whether it could.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    filenames = [
+        Path(source_path) / f
+        for f in (catalog_index.INDEX_FILENAME, tiers.INDEX_FILENAME)
+        if (Path(source_path) / f).exists()
+    ]
+    for partition_name in tiers.partition_names(source_path):
+        filenames += (Path(source_path) / partition_name).glob("*.parquet")
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            # dirty pages aren't evicted, so they're written back first
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def render_query(table: pa.Table, ra, dec, radius, resolution) -> float:
+    """Renders the stars of a query like m13.py (a refractor's view), and returns the duration"""
+    from datetime import datetime
+    from zoneinfo import ZoneInfo
+
+    from starplot import OpticPlot, Observer, _
+    from starplot.data.catalogs import Catalog
+    from starplot.models import Refractor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = Path(tmp) / "stars.parquet"
+        pq.write_table(table, filename)
+
+        time_start = time.time()
+        plot = OpticPlot(
+            ra=ra,
+            dec=dec,
+            observer=Observer(
+                dt=datetime(2023, 12, 16, 21, 0, 0, tzinfo=ZoneInfo("US/Pacific")),
+                lat=33.363484,
+                lon=-116.836394,
+            ),
+            # the m13.py refractor, with the eyepiece for the field of view
+            optic=Refractor(
+                focal_length=714,
+                eyepiece_focal_length=714 * radius * 2 / 100,
+                eyepiece_fov=100,
+            ),
+            resolution=resolution,
+            scale=0.25,
+            raise_on_below_horizon=False,
+        )
+        plot.stars(
+            where=[_.magnitude < 99], where_labels=[False], catalog=Catalog(filename)
+        )
+        plot.export(io.BytesIO(), padding=0.1)
+        return time.time() - time_start
+
+
+@click.command("query")
+@click.option("--source", help="Path of a built (squashed or merged) catalog")
+@click.option(
+    "--nside", default=4, help="HEALPix NSIDE of the catalog (ignored if it's tiered)"
+)
+@click.option(
+    "--position",
+    "positions",
+    multiple=True,
+    type=click.Choice(list(QUERY_POSITIONS)),
+    default=list(QUERY_POSITIONS),
+    help="Sky positions to query (can be repeated)",
+)
+@click.option(
+    "--radius",
+    "radii",
+    multiple=True,
+    default=[0.56, 2.5, 10.0],
+    help="Radius of the field of view, in degrees (can be repeated, default is the m13.py optic's and wider)",
+)
+@click.option(
+    "--mag_max",
+    "mag_maxes",
+    multiple=True,
+    default=[12.0, 15.0, 18.0],
+    help="Limiting magnitude (can be repeated)",
+)
+@click.option(
+    "--cold",
+    default=3,
+    help="Number of cold queries (each in a fresh process, after evicting the catalog from the page cache)",
+)
+@click.option("--warm", default=5, help="Number of warm queries (in one process)")
+@click.option("--render/--no_render", default=True, help="Also time rendering")
+@click.option("--resolution", default=2048, help="Resolution of the rendered plots")
+@click.option("--output", default=None, help="JSON file of the results")
+def query_benchmark(
+    source,
+    nside,
+    positions,
+    radii,
+    mag_maxes,
+    cold,
+    warm,
+    render,
+    resolution,
+    output,
+):
+    """Times queries (cold and warm) and rendering of a matrix of fields of view against a built catalog"""
+    source_path = Path(source)
+    results = []
+    for name in positions:
+        ra, dec = QUERY_POSITIONS[name]
+        for radius in radii:
+            for mag_max in mag_maxes:
+                args = (source_path, nside, ra, dec, radius, mag_max)
+                # in a fresh process each time, so nothing is cached in the reader (or the page cache)
+                cold_durations = []
+                for _ in range(cold):
+                    page_cache_dropped = drop_page_cache(source_path)
+                    cold_durations.append(measure_peak_rss(query_catalog, *args)[0])
+                table = query_catalog(*args)
+                warm_durations = []
+                for _ in range(warm):
+                    time_start = time.time()
+                    query_catalog(*args)
+                    warm_durations.append(time.time() - time_start)
+
+                scanned = query_scanned(*args)
+                result = dict(
+                    position=name,
+                    ra=ra,
+                    dec=dec,
+                    radius=radius,
+                    mag_max=mag_max,
+                    partitions=scanned["partitions"],
+                    estimated_row_groups_scanned=scanned["row_groups"],
+                    estimated_rows_scanned=scanned["rows"],
+                    estimated_bytes_scanned=scanned["bytes"],
+                    rows_returned=table.num_rows,
+                    cold_ms=float(np.median(cold_durations)) * 1000 if cold else None,
+                    # without it, cold queries only start from a fresh process (with the files cached)
+                    page_cache_dropped=page_cache_dropped if cold else None,
+                    warm_ms=float(np.median(warm_durations)) * 1000 if warm else None,
+                    render_ms=render_query(table, ra, dec, radius, resolution) * 1000
+                    if render
+                    else None,
+                )
+                results.append(result)
+                print(
+                    f"{name:<20} | r {radius:>5}° | mag <= {mag_max:<4} "
+                    f"| {'~' + format(result['estimated_rows_scanned'], ','):>13} scanned | {result['rows_returned']:>10,} returned "
+                    f"| {'cold' if result['page_cache_dropped'] else 'fresh process'} {result['cold_ms'] or 0:>8,.1f} ms | warm {result['warm_ms'] or 0:>8,.1f} ms "
+                    f"| render {result['render_ms'] or 0:>8,.1f} ms"
+                )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(
+                dict(
+                    source=str(source_path),
+                    tiered=tiers.is_tiered(source_path),
+                    nside=nside,
+                    results=results,
+                ),
+                f,
+                indent=1,
+            )
@@ -0,0 +1,89 @@
+import logging
+import multiprocessing
+import resource
+import time
+from pathlib import Path
+
+import polars as pl
+
+import build
+import synthetic
+import utils
+
+"""Helpers shared by the benchmarks: measuring RSS in fresh processes, and building synthetic source files."""
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger("bench")
+
+
+def current_rss() -> float:
+    """Returns resident set size of this process in MB (Linux only)"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024**2
+
+
+def rss_growth(queue, target, args):
+    rss_start = current_rss()
+    result = target(*args)  # noqa: F841 (held so its memory is still resident)
+    queue.put(current_rss() - rss_start)
+
+
+def measure_rss(target, *args) -> float:
+    """Runs target in a fresh (spawned) process, and returns how much its RSS grew in MB"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=rss_growth, args=(queue, target, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def timed_peak_rss(queue, target, args):
+    rss_start = current_rss()
+    utils.reset_peak_rss()
+    time_start = time.time()
+    target(*args)
+    queue.put((time.time() - time_start, utils.peak_rss() - rss_start))
+
+
+def measure_peak_rss(target, *args) -> tuple[float, float]:
+    """Runs target in a fresh (spawned) process, and returns its duration and how much its peak RSS grew in MB"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=timed_peak_rss, args=(queue, target, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def write_gaia_source(path: Path, rows: int, seed: int = 2016) -> Path:
+    """Writes a single synthetic gaia_source file, and returns the Gaia root path"""
+    source_path = path / "gaia_source"
+    source_path.mkdir(parents=True, exist_ok=True)
+    synthetic.write_source_file(source_path / "GaiaSource_000000.csv.gz", rows, seed)
+    return path
+
+
+def build_source_file(
+    gaia_path, destination, batch_size=0, variants=None, index=0, writer="dataset"
+) -> dict[str, list[str]]:
+    empty_hip = pl.DataFrame(schema={"source_id": pl.Int64, "hip": pl.Int64})
+    empty_tyc = pl.DataFrame(schema={"source_id": pl.Int64, "tyc": pl.String})
+    return build.build_columnar(
+        index,
+        logger,
+        gaia_path=gaia_path,
+        variants=variants or [build.Variant(destination, 4, 6, 18, 1.0)],
+        crossmatch_hip=empty_hip,
+        crossmatch_tyc=empty_tyc,
+        batch_size=batch_size,
+        writer=writer,
+    )
+
+
+def files_written(path: Path) -> tuple[int, int]:
+    """Returns number and total size (in bytes) of files under a path"""
+    files = [f for f in path.rglob("*") if f.is_file()]
+    return len(files), sum(f.stat().st_size for f in files)
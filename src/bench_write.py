@@ -0,0 +1,222 @@
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import archive
+import build
+import manifest
+import merge
+import profiles
+import settings
+import squash
+import synthetic
+from bench_utils import build_source_file, files_written, measure_peak_rss
+
+"""Benchmarks of writing partitions: squashing or merging them, and their storage profiles."""
+
+
+@click.command("writer")
+@click.option("--num_files", default=8, help="Number of source files")
+@click.option("--rows_per_file", default=250_000, help="Number of stars per file")
+@click.option("--nside", default=8, help="HEALPix NSIDE to use")
+@click.option("--num_workers", default=4, help="Number of squash/merge workers")
+@click.option(
+    "--subindex_nside",
+    default=0,
+    help="HEALPix NSIDE of the sub-index to cluster partitions by (0 sorts by magnitude only)",
+)
+def writer_benchmark(num_files, rows_per_file, nside, num_workers, subindex_nside):
+    """Compares writing fragments and squashing them, to writing runs and merging them"""
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = Path(tmp) / "gaia"
+        (gaia_path / "gaia_source").mkdir(parents=True)
+        for n in range(num_files):
+            synthetic.write_source_file(
+                gaia_path / "gaia_source" / f"GaiaSource_{n:06}.csv.gz",
+                rows_per_file,
+                seed=n,
+            )
+
+        results = {}
+        for writer in ["dataset", "merge"]:
+            destination = Path(tmp) / writer
+            variant = build.Variant(destination, nside, 6, 30, 1.0)
+
+            time_start = time.time()
+            for n in range(num_files):
+                fragments = build_source_file(
+                    gaia_path, None, variants=[variant], index=n, writer=writer
+                )
+                manifest.append(
+                    destination,
+                    dict(index=n, status="done", fragments=fragments[destination]),
+                )
+            duration_build = time.time() - time_start
+            intermediate = files_written(destination)
+
+            time_start = time.time()
+            if writer == "merge":
+                merge.merge_runs(
+                    destination, num_workers, subindex_nside=subindex_nside
+                )
+            else:
+                squash.main.callback(
+                    source=str(destination),
+                    num_workers=num_workers,
+                    memory_limit=0,
+                    memory_budget=0,
+                    subindex_nside=subindex_nside,
+                    magnitude_band=1.0,
+                    profile="standard",
+                    compression_level=9,
+                    geometry=True,
+                )
+            duration_final = time.time() - time_start
+
+            results[writer] = pl.read_parquet(
+                destination / "*" / settings.SQUASHED_FILENAME
+            )
+            print(
+                f"{writer:<8} | build {duration_build:.2f}s | "
+                f"{'merge' if writer == 'merge' else 'squash'} {duration_final:.2f}s | "
+                f"{intermediate[0]:,} intermediate files ({intermediate[1] / 1024**2:,.1f} MB)"
+            )
+
+        # both writers sort partitions the same way, so they write the same rows in the same order
+        assert results["dataset"].equals(results["merge"])
+
+
+@click.command("squash")
+@click.option("--num_files", default=8, help="Number of source files")
+@click.option("--rows_per_file", default=1_000_000, help="Number of stars per file")
+@click.option(
+    "--memory_limit",
+    "memory_limits",
+    multiple=True,
+    default=[0, 64, 16],
+    help="Memory limits to compare, in MB (0 sorts in memory)",
+)
+def squash_benchmark(num_files, rows_per_file, memory_limits):
+    """Compares peak RSS and rows/sec of squashing a partition in memory and with a memory limit (`verify.py` checks they write the same rows)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = Path(tmp) / "gaia"
+        (gaia_path / "gaia_source").mkdir(parents=True)
+        destination = Path(tmp) / "build"
+        for n in range(num_files):
+            synthetic.write_source_file(
+                gaia_path / "gaia_source" / f"GaiaSource_{n:06}.csv.gz",
+                rows_per_file,
+                seed=n,
+            )
+            build_source_file(
+                gaia_path,
+                None,
+                variants=[build.Variant(destination, 1, 6, 30, 1.0)],
+                index=n,
+            )
+
+        # the largest partition, copied for each memory limit
+        partition = max(
+            destination.glob("healpix_index=*"), key=lambda p: files_written(p)[1]
+        )
+        rows = pq.ParquetDataset(partition, schema=settings.SCHEMA).read().num_rows
+
+        for memory_limit in memory_limits:
+            source_path = Path(tmp) / f"squash-{memory_limit}"
+            shutil.copytree(partition, source_path / partition.name)
+
+            duration, peak = measure_peak_rss(
+                squash.squash_partition, partition.name, source_path, memory_limit
+            )
+            print(
+                f"memory_limit {memory_limit:>5} MB | {rows / duration:>12,.0f} rows/sec | "
+                f"peak RSS +{peak:>8,.1f} MB | {rows:,} rows"
+            )
+
+
+@click.command("profile")
+@click.option("--num_files", default=2, help="Number of source files")
+@click.option("--rows_per_file", default=1_000_000, help="Number of stars per file")
+@click.option("--compression_level", default=9, help="zstd compression level")
+@click.option("--repeat", default=3, help="Number of scans of each profile")
+def profile_benchmark(num_files, rows_per_file, compression_level, repeat):
+    """Compares on-disk size, archive size and scan speed of the storage profiles"""
+    storage_profiles = {
+        "standard": profiles.STANDARD,
+        "compact": profiles.Profile(compact=True, compression_level=compression_level),
+        "compact, no geometry": profiles.Profile(
+            compact=True, compression_level=compression_level, geometry=False
+        ),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = Path(tmp) / "gaia"
+        (gaia_path / "gaia_source").mkdir(parents=True)
+        destination = Path(tmp) / "build"
+        for n in range(num_files):
+            synthetic.write_source_file(
+                gaia_path / "gaia_source" / f"GaiaSource_{n:06}.csv.gz",
+                rows_per_file,
+                seed=n,
+            )
+            build_source_file(
+                gaia_path,
+                None,
+                variants=[build.Variant(destination, 1, 0, 30, 1.0)],
+                index=n,
+            )
+
+        expected = None
+        for name, profile in storage_profiles.items():
+            source_path = Path(tmp) / name.replace(" ", "")
+            shutil.copytree(destination, source_path)
+            partition_names = sorted(
+                p.name for p in source_path.glob("healpix_index=*")
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                for partition_name in partition_names:
+                    squash.squash_partition(
+                        partition_name, source_path, profile=profile
+                    )
+
+            filenames = [
+                source_path / p / settings.SQUASHED_FILENAME for p in partition_names
+            ]
+            size = sum(f.stat().st_size for f in filenames)
+            archive_filename = Path(tmp) / f"{source_path.name}.tar.gz"
+            archive.archive(filenames, archive_filename, source_path)
+
+            durations = []
+            for _ in range(repeat):
+                time_start = time.time()
+                table = pa.concat_tables(pq.read_table(f) for f in filenames)
+                durations.append(time.time() - time_start)
+
+            # the same stars and values, at the precision they're rounded to
+            values = {
+                c: table[c].to_numpy()
+                for c in ["pk", "magnitude", "bv", "parallax_mas"]
+            }
+            if expected is None:
+                expected = values
+            assert (values["pk"] == expected["pk"]).all()
+            for column in ["magnitude", "bv"]:
+                assert np.allclose(values[column], expected[column], atol=0.005)
+            assert np.allclose(
+                values["parallax_mas"], expected["parallax_mas"], rtol=1e-6, atol=1e-6
+            )
+
+            print(
+                f"{name:<20} | {size / 1024**2:>8,.1f} MB | archive "
+                f"{archive_filename.stat().st_size / 1024**2:>8,.1f} MB | scan "
+                f"{table.num_rows / np.median(durations):>12,.0f} rows/sec"
+            )
@@ -1,35 +1,261 @@
-import csv
+import cProfile
+import gzip
+import io
+import json
 import time
 import logging
-import math
 import multiprocessing
+import pstats
 import random
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
 from logging.handlers import QueueHandler
 from pathlib import Path
+from typing import Iterator
 
 import click
+import numpy as np
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from astropy import units as u
+from astropy_healpix import HEALPix
 from shapely.geometry import Point
 from skyfield.api import position_of_radec, load_constellation_map
 
 from starplot import Star
 from starplot.data import Catalog
 
-from utils import get_bv_v
+import catalog_index
+import crossmatch
+import manifest
+import merge
+import profiles
+import settings
+import tiers
+from constellations import constellation_ids
+from utils import (
+    get_bv_v,
+    get_bv_v_expr,
+    peak_rss,
+    reset_peak_rss,
+    sample_mask,
+    sample_values,
+    v_range,
+    wkb_points,
+)
 
 __version__ = "0.1.0"
 
 constellation_map = load_constellation_map()
 
+SOURCE_SCHEMA = {
+    "ra": pl.Float64,
+    "dec": pl.Float64,
+    "source_id": pl.Int64,
+    "ref_epoch": pl.Float64,
+    "parallax": pl.Float64,
+    "pmra": pl.Float64,
+    "pmdec": pl.Float64,
+    "phot_g_mean_mag": pl.Float64,
+    "bp_rp": pl.Float64,
+}
+SOURCE_COLUMNS = list(SOURCE_SCHEMA)
 
-def read_crossmatch(source_path, cast=int):
-    """Returns dictionary mapping Gaia source_id to external source id"""
+METRICS_FILENAME = "build-metrics.jsonl"
 
-    with open(source_path, mode="r") as csv_file:
-        reader = csv.DictReader(csv_file)
-        return {
-            int(row["source_id"]): cast(row["original_ext_source_id"]) for row in reader
-        }
+# Time spent (in seconds) in each stage of building a source file, and rows in and out of it, in this
+# process. Reset by `worker_process` before each source file.
+metrics = dict(stages=defaultdict(float), rows=defaultdict(int))
+
+
+def reset_metrics():
+    metrics["stages"].clear()
+    metrics["rows"].clear()
+
+
+@contextmanager
+def timed(stage):
+    """Adds the time spent in the block to the stage's duration in `metrics`"""
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics["stages"][stage] += time.perf_counter() - time_start
+
+
+def timed_batches(batches: Iterator[pl.DataFrame]) -> Iterator[pl.DataFrame]:
+    """Yields batches of a source file, adding the time spent reading them to the read stage"""
+    batches = iter(batches)
+    while True:
+        with timed("read"):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        metrics["rows"]["in"] += batch.height
+        yield batch
+
+
+@dataclass
+class Variant:
+    """An output catalog of a build"""
+
+    destination: str
+    nside: int
+    mag_min: float
+    mag_max: float
+    sample_rate: float
+    closed: str = "both"
+    """Which ends of the magnitude range are included (see `polars.Expr.is_between`)"""
+
+
+def source_row_groups(parquet_file: pq.ParquetFile, mag_range=None) -> list[int]:
+    """
+    Returns the row groups of a staged source file that can have stars with a V magnitude in `mag_range`
+    (all of them if it's None), from their `phot_g_mean_mag` and `bp_rp` statistics. Staged files are
+    sorted by G magnitude, so each row group covers a narrow range of them.
+    """
+    metadata = parquet_file.metadata
+    if mag_range is None:
+        return list(range(metadata.num_row_groups))
+
+    mag_min, mag_max = mag_range
+    names = parquet_file.schema_arrow.names
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        statistics = [
+            metadata.row_group(i).column(names.index(c)).statistics
+            for c in ("phot_g_mean_mag", "bp_rp")
+        ]
+        if not all(s is not None and s.has_min_max for s in statistics):
+            row_groups.append(i)
+            continue
+        (g_min, g_max), (bp_rp_min, bp_rp_max) = [(s.min, s.max) for s in statistics]
+        v_min, v_max = v_range(g_min, g_max, bp_rp_min, bp_rp_max)
+        # with some slack for rounding (the V of each star is computed in a different order)
+        if v_max >= mag_min - 1e-6 and v_min <= mag_max + 1e-6:
+            row_groups.append(i)
+    return row_groups
+
+
+def read_source(gaia_source_filename, mag_range=None) -> pl.DataFrame:
+    """
+    Reads a source file. Row groups of a staged (Parquet) source file without any stars in `mag_range`
+    (min, max) aren't read.
+    """
+    if Path(gaia_source_filename).suffix == ".parquet":
+        parquet_file = pq.ParquetFile(gaia_source_filename)
+        row_groups = source_row_groups(parquet_file, mag_range)
+        if not row_groups:
+            return pl.DataFrame(schema=SOURCE_SCHEMA)
+        return pl.from_arrow(
+            parquet_file.read_row_groups(row_groups, columns=SOURCE_COLUMNS)
+        )
+
+    return pl.read_csv(
+        source=gaia_source_filename,
+        comment_prefix="#",
+        null_values=["null"],
+        columns=SOURCE_COLUMNS,
+        schema_overrides=SOURCE_SCHEMA,
+    )
+
+
+def read_source_batches(
+    gaia_source_filename, batch_size=0, mag_range=None
+) -> Iterator[pl.DataFrame]:
+    """
+    Reads a source file in batches of about `batch_size` MB of CSV, decompressing it as a stream
+    so only one batch is in memory at a time. A `batch_size` of 0 reads the whole file at once.
+
+    Staged (Parquet) source files are read one row group at a time, skipping row groups without
+    any stars in `mag_range` (min, max).
+    """
+    if not batch_size:
+        yield read_source(gaia_source_filename, mag_range)
+        return
+
+    if Path(gaia_source_filename).suffix == ".parquet":
+        parquet_file = pq.ParquetFile(gaia_source_filename)
+        row_groups = source_row_groups(parquet_file, mag_range)
+        for i in row_groups:
+            yield pl.from_arrow(parquet_file.read_row_group(i, columns=SOURCE_COLUMNS))
+        if not row_groups:
+            yield pl.DataFrame(schema=SOURCE_SCHEMA)
+        return
+
+    with gzip.open(gaia_source_filename, "rt") as f:
+        comment_lines = 0
+        for line in f:
+            if not line.startswith("#"):
+                break
+            comment_lines += 1
+
+    with pa.input_stream(gaia_source_filename, compression="gzip") as stream:
+        reader = pacsv.open_csv(
+            stream,
+            read_options=pacsv.ReadOptions(
+                skip_rows=comment_lines, block_size=batch_size * 1024**2
+            ),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=SOURCE_COLUMNS,
+                column_types={
+                    c: pa.int64() if t == pl.Int64 else pa.float64()
+                    for c, t in SOURCE_SCHEMA.items()
+                },
+                null_values=["null"],
+            ),
+        )
+        empty = True
+        for batch in reader:
+            empty = False
+            yield pl.from_arrow(batch)
+
+    if empty:
+        yield pl.DataFrame(schema=SOURCE_SCHEMA)
+
+
+def staged_filename(staging_path, gaia_source_filename) -> Path:
+    """Returns path of a source file's staged copy (see staging.py)"""
+    return Path(staging_path) / Path(gaia_source_filename).name.replace(
+        ".csv.gz", ".parquet"
+    )
+
+
+def is_staged(staging_path, gaia_source_filename) -> bool:
+    """Returns True if the source file has a staged copy that's newer than it"""
+    staged = staged_filename(staging_path, gaia_source_filename)
+    return (
+        staged.exists()
+        and staged.stat().st_mtime >= Path(gaia_source_filename).stat().st_mtime
+    )
+
+
+def source_filename(gaia_path, index, logger, staging_path=None):
+    """
+    Returns path of the source file at `index`, or its staged copy if there's
+    one in `staging_path` that's up to date.
+    """
+    source_path = Path(gaia_path) / "gaia_source"
+    source_filenames = sorted(list(source_path.glob("*.csv.gz")))
+
+    try:
+        gaia_source_filename = source_filenames[index]
+    except IndexError:
+        logger.error(f"Index does not exist: {index}")
+        return
+
+    if staging_path is None:
+        return gaia_source_filename
+
+    if is_staged(staging_path, gaia_source_filename):
+        return staged_filename(staging_path, gaia_source_filename)
+
+    logger.info(f"Not staged, reading CSV: {gaia_source_filename.name}")
+    return gaia_source_filename
 
 
 def stars(
@@ -41,14 +267,12 @@ def stars(
     sample_rate,
     crossmatch_hip,
     crossmatch_tyc,
+    sampling="hash",
+    seed=None,
+    staging_path=None,
 ):
-    source_path = Path(gaia_path) / "gaia_source"
-    source_filenames = sorted(list(source_path.glob("*.csv.gz")))
-
-    try:
-        gaia_source_filename = source_filenames[index]
-    except IndexError:
-        logger.error(f"Index does not exist: {index}")
+    gaia_source_filename = source_filename(gaia_path, index, logger, staging_path)
+    if gaia_source_filename is None:
         return
 
     catalog_length = 0
@@ -60,24 +284,20 @@ def stars(
     logger.info(gaia_source_filename.name)
     time_start = time.time()
 
-    df = pl.read_csv(
-        source=gaia_source_filename,
-        comment_prefix="#",
-        null_values=["null"],
-        columns=[
-            "ra",
-            "dec",
-            "source_id",
-            "ref_epoch",
-            "parallax",
-            "pmra",
-            "pmdec",
-            "phot_g_mean_mag",
-            "bp_rp",
-        ],
-    )
+    with timed("read"):
+        df = read_source(gaia_source_filename, (mag_min, mag_max))
+    metrics["rows"]["in"] += df.height
+    if sampling == "hash":
+        with timed("sample"):
+            df = df.filter(pl.Series(sample_mask(df["source_id"], seed, sample_rate)))
+
+    # stages are timed with a clock call around each one (rather than `timed`, which would cost more
+    # than some of the stages), and added to the metrics once every row is done
+    clock = time.perf_counter
+    time_photometry = time_constellation = time_crossmatch = time_construct = 0.0
+
     for row in df.iter_rows(named=True):
-        if sample_rate < 1 and random.random() > sample_rate:
+        if sampling == "random" and sample_rate < 1 and random.random() > sample_rate:
             continue
 
         phot_g_mean_mag, bp_rp = row["phot_g_mean_mag"], row["bp_rp"]
@@ -85,7 +305,9 @@ def stars(
             skipped_no_mag += 1
             continue
 
+        time_stage = clock()
         bv, v = get_bv_v(phot_g_mean_mag, bp_rp)
+        time_photometry += clock() - time_stage
 
         if v < mag_min or v > mag_max:
             continue
@@ -97,12 +319,18 @@ def stars(
         dec_mas_per_year = round(row["pmdec"] or 0, 6)
 
         # Find constellation
+        time_stage = clock()
         pos = position_of_radec(ra / 15, dec)
         constellation_id = constellation_map(pos).lower()
+        time_constellation += clock() - time_stage
 
         source_id = row["source_id"]
+        time_stage = clock()
         hip = crossmatch_hip.get(source_id)
         tyc = crossmatch_tyc.get(source_id)
+        time_crossmatch += clock() - time_stage
+
+        time_stage = clock()
         star = Star(
             pk=source_id,
             ra=ra,
@@ -118,6 +346,7 @@ def stars(
             epoch_year=row["ref_epoch"],
             geometry=Point(ra, dec),
         )
+        time_construct += clock() - time_stage
         if hip:
             crossmatches_hip += 1
 
@@ -126,6 +355,13 @@ def stars(
 
         yield star
         catalog_length += 1
+        metrics["rows"]["selected"] += 1
+        metrics["rows"]["out"] += 1
+
+    metrics["stages"]["photometry"] += time_photometry
+    metrics["stages"]["constellation"] += time_constellation
+    metrics["stages"]["crossmatch"] += time_crossmatch
+    metrics["stages"]["construct"] += time_construct
 
     duration = round(time.time() - time_start, 4)
     logger.info(f"{gaia_source_filename.name} done in {duration}")
@@ -137,34 +373,342 @@ def stars(
     # logger.info(f"over_threshold_count = {over_threshold_count:,}")
 
 
+def geometry_array(ra, dec) -> pa.Array:
+    """Returns a binary array of WKB points, without creating any geometry objects"""
+    offsets = np.arange(0, 21 * (len(ra) + 1), 21, dtype=np.int32)
+    return pa.Array.from_buffers(
+        pa.binary(),
+        len(ra),
+        [None, pa.py_buffer(offsets), pa.py_buffer(wkb_points(ra, dec))],
+    )
+
+
+def is_sampled(sample: pl.Expr, sample_rate, sampling) -> pl.Expr:
+    """Returns whether stars with the given `sample` values (see `select_sources`) are in a sample"""
+    # random sampling keeps values <= sample_rate, the same as `stars`
+    return sample <= sample_rate if sampling == "random" else sample < sample_rate
+
+
+def select_sources(
+    df, mag_min, mag_max, sample_rate, sampling, seed, rng
+) -> tuple[pl.DataFrame, int]:
+    """
+    Samples a frame of sources, skips sources without photometry, and adds B-V and V magnitude
+    columns for sources within the magnitude range. Returns the selected sources and the number
+    of sources skipped for missing photometry.
+
+    Each source gets a uniform `sample` value in [0, 1), and is in the sample if it's below the
+    sample rate, so samples at lower rates can be taken from the selected sources later.
+    """
+    with timed("sample"):
+        if sampling == "hash":
+            sample = sample_values(df["source_id"], seed)
+        else:
+            sample = rng.random(df.height)
+        df = df.with_columns(sample=pl.Series(sample)).filter(
+            is_sampled(pl.col("sample"), sample_rate, sampling)
+        )
+
+    with timed("photometry"):
+        sampled_length = df.height
+        df = df.filter(
+            (pl.col("phot_g_mean_mag").fill_null(0) != 0)
+            & (pl.col("bp_rp").fill_null(0) != 0)
+        )
+        skipped_no_mag = sampled_length - df.height
+
+        bv, v = get_bv_v_expr(pl.col("phot_g_mean_mag"), pl.col("bp_rp"))
+        df = df.with_columns(bv=bv, v=v).filter(
+            pl.col("v").is_between(mag_min, mag_max)
+        )
+
+    return df, skipped_no_mag
+
+
+def stars_frames(
+    batches: Iterator[pl.DataFrame],
+    logger,
+    variants: list[Variant],
+    crossmatch_hip,
+    crossmatch_tyc,
+    sampling="hash",
+    seed=None,
+) -> Iterator[pl.DataFrame]:
+    """
+    Columnar version of `stars`: transforms batches of a source file (see `read_source_batches`)
+    into frames of every star in any of the variants, with their crossmatches, rounded
+    coordinates and constellation.
+
+    Each batch is transformed (and yielded) as soon as it's read, so only one batch of the full
+    source file is held in memory at a time.
+    """
+    mag_min = min(v.mag_min for v in variants)
+    mag_max = max(v.mag_max for v in variants)
+    sample_rate = max(v.sample_rate for v in variants)
+
+    rng = np.random.default_rng(random.getrandbits(64))
+    skipped_no_mag = 0
+
+    for batch in timed_batches(batches):
+        df, skipped = select_sources(
+            batch, mag_min, mag_max, sample_rate, sampling, seed, rng
+        )
+        skipped_no_mag += skipped
+
+        with timed("crossmatch"):
+            df = crossmatch.join(df, crossmatch_hip, crossmatch_tyc)
+        metrics["rows"]["selected"] += df.height
+
+        with timed("constellation"):
+            ra = np.round(df["ra"].to_numpy(), 6)
+            dec = np.round(df["dec"].to_numpy(), 6)
+            df = df.with_columns(
+                ra=pl.Series(ra),
+                dec=pl.Series(dec),
+                constellation_id=pl.Series(constellation_ids(ra, dec)),
+            )
+
+        yield df
+
+    logger.info(f"skipped_no_mag = {skipped_no_mag:,}")
+
+
+def stars_table(stars: pl.DataFrame, variant: Variant, sampling="hash") -> pa.Table:
+    """Returns the stars of a variant (from `stars_frames`) as an Arrow table that matches `settings.SCHEMA`"""
+    df = stars.filter(
+        pl.col("v").is_between(variant.mag_min, variant.mag_max, closed=variant.closed)
+        & is_sampled(pl.col("sample"), variant.sample_rate, sampling)
+    )
+
+    ra = df["ra"].to_numpy()
+    dec = df["dec"].to_numpy()
+
+    healpix = HEALPix(nside=variant.nside, order="nested")
+    healpix_index = healpix.lonlat_to_healpix(ra * u.deg, dec * u.deg)
+
+    table = pa.Table.from_pydict(
+        {
+            "pk": df["source_id"].to_numpy(),
+            "ra": ra,
+            "dec": dec,
+            "magnitude": np.round(df["v"].to_numpy(), 2),
+            "bv": np.round(df["bv"].to_numpy(), 2),
+            "constellation_id": df["constellation_id"].to_arrow(),
+            "hip": df["hip"].cast(pl.Float64).to_arrow(),
+            "tyc": df["tyc"].to_arrow(),
+            "parallax_mas": np.round(df["parallax"].fill_null(0).to_numpy(), 6),
+            "ra_mas_per_year": np.round(df["pmra"].fill_null(0).to_numpy(), 6),
+            "dec_mas_per_year": np.round(df["pmdec"].fill_null(0).to_numpy(), 6),
+            "epoch_year": df["ref_epoch"].cast(pl.Int64).to_numpy(),
+            "geometry": geometry_array(ra, dec),
+            "healpix_index": healpix_index.astype(np.int64),
+        }
+    ).cast(settings.SCHEMA)
+
+    return table
+
+
+# fragments a build worker keeps open at once (each source file covers a small area of the sky, so it's
+# usually in only a few partitions)
+MAX_OPEN_FRAGMENTS = 64
+
+FRAGMENT_SCHEMA = settings.SCHEMA.remove(
+    settings.SCHEMA.get_field_index("healpix_index")
+)
+
+
+class FragmentWriter:
+    """
+    Writes the stars of a source file to a parquet fragment in each of their partitions (hive partitioned,
+    like `pq.write_to_dataset`), a table at a time, so the source file can be built a batch at a time.
+
+    Each table is sorted by (magnitude, pk), and appended to the fragments of its partitions as row groups.
+    At most MAX_OPEN_FRAGMENTS fragments are kept open: when a table has stars in more partitions than
+    that, the least recently written fragments are closed, and a partition written to again gets another
+    fragment.
+    """
+
+    def __init__(self, destination, source_name):
+        self.destination = Path(destination)
+        self.source_name = source_name
+        self.writers = OrderedDict()
+        self.fragments = defaultdict(list)
+
+    def writer(self, partition: int) -> pq.ParquetWriter:
+        if partition in self.writers:
+            self.writers.move_to_end(partition)
+            return self.writers[partition]
+
+        if len(self.writers) >= MAX_OPEN_FRAGMENTS:
+            self.writers.popitem(last=False)[1].close()
+
+        # fragments are named after the source file, so rebuilding a file replaces its fragments
+        fragment = (
+            f"healpix_index={partition}/"
+            f"{self.source_name}-{len(self.fragments[partition])}.parquet"
+        )
+        (self.destination / fragment).parent.mkdir(parents=True, exist_ok=True)
+        self.fragments[partition].append(fragment)
+        self.writers[partition] = pq.ParquetWriter(
+            self.destination / fragment,
+            FRAGMENT_SCHEMA,
+            compression="snappy",
+            sorting_columns=[
+                pq.SortingColumn(FRAGMENT_SCHEMA.get_field_index("magnitude"))
+            ],
+        )
+        return self.writers[partition]
+
+    def write(self, table: pa.Table):
+        table = table.sort_by(
+            [("healpix_index", "ascending")] + settings.SORT_KEYS
+        ).combine_chunks()
+        partitions, starts = np.unique(
+            table["healpix_index"].to_numpy(), return_index=True
+        )
+        rows = np.diff(np.append(starts, table.num_rows))
+        table = table.drop_columns("healpix_index")
+        for partition, start, length in zip(partitions.tolist(), starts, rows):
+            self.writer(partition).write_table(
+                table.slice(start, length), row_group_size=100_000
+            )
+
+    def close(self) -> list[str]:
+        """Closes the fragments, and returns their paths (relative to the destination)"""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        return [f for fragments in self.fragments.values() for f in fragments]
+
+
+def build_columnar(
+    index,
+    logger,
+    gaia_path,
+    variants: list[Variant],
+    crossmatch_hip,
+    crossmatch_tyc,
+    sampling="hash",
+    seed=None,
+    batch_size=0,
+    staging_path=None,
+    writer="dataset",
+) -> dict[str, list[str]]:
+    """
+    Builds a single source file into each variant, without creating any star objects.
+
+    The source file is read, and each star's photometry, crossmatches and constellation are
+    computed, once for all variants. Returns paths (relative to each variant's destination)
+    of the parquet fragments written, by destination.
+    """
+    gaia_source_filename = source_filename(gaia_path, index, logger, staging_path)
+    if gaia_source_filename is None:
+        return {}
+
+    logger.info(gaia_source_filename.name)
+    time_start = time.time()
+
+    source_name = gaia_source_filename.name.split(".")[0]
+    writers = {
+        v.destination: (merge.RunWriter if writer == "merge" else FragmentWriter)(
+            v.destination, source_name
+        )
+        for v in variants
+    }
+    counts = {v.destination: defaultdict(int) for v in variants}
+
+    # each batch is written as soon as it's built, so only a batch of the source file is in memory
+    mag_range = (min(v.mag_min for v in variants), max(v.mag_max for v in variants))
+    for stars in stars_frames(
+        read_source_batches(gaia_source_filename, batch_size, mag_range),
+        logger,
+        variants,
+        crossmatch_hip,
+        crossmatch_tyc,
+        sampling,
+        seed,
+    ):
+        for variant in variants:
+            with timed("construct"):
+                table = stars_table(stars, variant, sampling)
+            metrics["rows"]["out"] += table.num_rows
+            with timed("write"):
+                writers[variant.destination].write(table)
+
+            count = counts[variant.destination]
+            count["catalog_length"] += table.num_rows
+            count["crossmatches_hip"] += table.num_rows - table["hip"].null_count
+            tyc_only = pc.and_(pc.is_null(table["hip"]), pc.is_valid(table["tyc"]))
+            count["crossmatches_tyc"] += pc.sum(tyc_only).as_py() or 0
+
+    fragments = {}
+    for destination, w in writers.items():
+        with timed("write"):
+            fragments[destination] = w.close()
+        for name, count in counts[destination].items():
+            logger.info(f"{destination} | {name} = {count:,}")
+
+    duration = round(time.time() - time_start, 4)
+    logger.info(f"{gaia_source_filename.name} done in {duration}")
+
+    return fragments
+
+
 def build(
     index,
     logger,
     gaia_path,
-    destination,
-    nside,
-    mag_min,
-    mag_max,
-    sample_rate,
+    variants: list[Variant],
     crossmatch_hip,
     crossmatch_tyc,
-):
-    """Builds a single source file"""
+    method="columnar",
+    sampling="hash",
+    seed=None,
+    batch_size=0,
+    staging_path=None,
+    writer="dataset",
+) -> dict[str, list[str]]:
+    """
+    Builds a single source file into each variant, and returns paths of the parquet fragments
+    written by destination (if known)
+    """
     logger.info(f"Building... {index}")
+
+    if method == "columnar":
+        return build_columnar(
+            index,
+            logger,
+            gaia_path,
+            variants,
+            crossmatch_hip,
+            crossmatch_tyc,
+            sampling,
+            seed,
+            batch_size,
+            staging_path,
+            writer,
+        )
+
+    # the object build only supports one variant
+    (variant,) = variants
     catalog = Catalog(
-        path=destination,
-        healpix_nside=nside,
+        path=variant.destination,
+        healpix_nside=variant.nside,
     )
+    time_start = time.perf_counter()
     catalog.build(
         objects=stars(
             index,
             logger,
             gaia_path,
-            mag_min,
-            mag_max,
-            sample_rate,
+            variant.mag_min,
+            variant.mag_max,
+            variant.sample_rate,
             crossmatch_hip,
             crossmatch_tyc,
+            sampling,
+            seed,
+            staging_path,
         ),
         chunk_size=1_000_000,
         columns=[
@@ -187,6 +731,10 @@ def build(
         compression="snappy",
         row_group_size=100_000,
     )
+    # stars are built as Catalog.build consumes them, so the rest of its time is writing
+    metrics["stages"]["write"] += (
+        time.perf_counter() - time_start - sum(metrics["stages"].values())
+    )
 
 
 def init_listener():
@@ -225,26 +773,123 @@ def init_worker(queue):
     root.setLevel(logging.INFO)
 
 
-def worker_process(queue, chunk, worker_id, **kwargs):
+# Build parameters of this worker process, set by `init_worker_process`
+worker = {}
+
+
+def init_worker_process(queue, kwargs):
     init_worker(queue)
     name = multiprocessing.current_process().name
-    logger = logging.getLogger(f"build.{worker_id}")
-    logger.info(f"Starting worker: {name} | {chunk}")
+    logger = logging.getLogger(f"build.{name}")
+    logger.info(f"Starting worker: {name}")
+
+    # each worker loads the cached crossmatches itself, instead of having them pickled from main
+    crossmatch_hip = kwargs.pop("crossmatch_hip")
+    crossmatch_tyc = kwargs.pop("crossmatch_tyc")
+    if kwargs["method"] == "objects":
+        crossmatch_hip = crossmatch.to_dict(crossmatch.load(crossmatch_hip))
+        crossmatch_tyc = crossmatch.to_dict(crossmatch.load(crossmatch_tyc))
+    else:
+        crossmatch_hip = crossmatch.load_index(crossmatch_hip, "hip")
+        crossmatch_tyc = crossmatch.load_index(crossmatch_tyc, "tyc")
+
+    worker.update(
+        kwargs,
+        logger=logger,
+        crossmatch_hip=crossmatch_hip,
+        crossmatch_tyc=crossmatch_tyc,
+    )
+
+
+def write_profile(profiler: cProfile.Profile, index, logger):
+    """Writes a source file's profile to `build-<index>.prof` (see `pstats`), and logs its hot spots"""
+    filename = Path(f"build-{index}.prof").resolve()
+    profiler.dump_stats(filename)
+
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+    logger.info(f"{index} profile written to {filename}\n{output.getvalue()}")
+
+
+def worker_process(index) -> dict:
+    """Builds one source file, and returns a summary of the build for the manifest (and its metrics)"""
+    kwargs = dict(worker)
+    logger = kwargs.pop("logger")
+    profiler = cProfile.Profile() if index in kwargs.pop("profile_indexes") else None
+
+    # seed per file, so random sampling doesn't depend on which worker builds the file
+    seed = kwargs["seed"]
+    if seed and kwargs["sampling"] == "random":
+        random.seed(f"{seed}-{index}")
 
-    seed = kwargs.pop("seed")
-    if seed:
-        random.seed(seed)
+    result = dict(
+        index=index,
+        worker=multiprocessing.current_process().name,
+        started=time.time(),
+        status="done",
+        fragments={},
+    )
+    reset_peak_rss()
+    reset_metrics()
+    if profiler:
+        profiler.enable()
+    try:
+        result["fragments"] = build(index, logger, **kwargs) or {}
+    except Exception:
+        logger.exception(f"Failed to build {index}")
+        result["status"] = "failed"
+    if profiler:
+        profiler.disable()
+        write_profile(profiler, index, logger)
+
+    result["finished"] = time.time()
+    result["peak_rss"] = round(peak_rss(), 1)
+    result["metrics"] = dict(
+        stages={stage: round(d, 4) for stage, d in metrics["stages"].items()},
+        rows=dict(metrics["rows"]),
+    )
+    logger.info(f"{index} peak_rss = {result['peak_rss']:,} MB")
+    return result
 
-    for index in chunk:
-        build(index, logger, **kwargs)
 
-    logger.info(f"Worker finished: {name} | {chunk}")
+def summarize_metrics(file_metrics: list[dict]) -> dict:
+    """Returns the totals of the metrics of each source file built, overall and by worker"""
+    stages = defaultdict(float)
+    rows = defaultdict(int)
+    workers = defaultdict(lambda: dict(files=0, busy=0.0, rows_in=0, peak_rss=0.0))
+    for m in file_metrics:
+        for stage, duration in m["stages"].items():
+            stages[stage] += duration
+        for name, count in m["rows"].items():
+            rows[name] += count
+        w = workers[m["worker"]]
+        w["files"] += 1
+        w["busy"] = round(w["busy"] + m["duration"], 4)
+        w["rows_in"] += m["rows"].get("in", 0)
+        w["peak_rss"] = max(w["peak_rss"], m["peak_rss"])
+
+    total = sum(stages.values())
+    return dict(
+        files=len(file_metrics),
+        failed=sum(m["status"] == "failed" for m in file_metrics),
+        rows=dict(rows),
+        stages={
+            stage: dict(
+                duration=round(duration, 4),
+                share=round(duration / total, 4) if total else 0,
+                rows_per_sec=round(rows.get("in", 0) / duration) if duration else None,
+            )
+            for stage, duration in sorted(stages.items(), key=lambda s: -s[1])
+        },
+        peak_rss=max((m["peak_rss"] for m in file_metrics), default=0),
+        workers=dict(sorted(workers.items())),
+    )
 
 
-def chunks(items, n):
-    """Yield successive n-sized chunks from items"""
-    for i in range(0, len(items), n):
-        yield items[i : i + n]
+def source_fingerprints(gaia_path) -> list[dict]:
+    """Returns filename, size (in bytes) and mtime of each source file, in the same order as the file indexes"""
+    source_path = Path(gaia_path) / "gaia_source"
+    return [manifest.fingerprint(f) for f in sorted(source_path.glob("*.csv.gz"))]
 
 
 @click.command()
@@ -262,6 +907,79 @@ def chunks(items, n):
 @click.option(
     "--sample_rate", default=1.0, help="Random sampling rate of stars to include"
 )
+@click.option(
+    "--sampling",
+    default="random",
+    type=click.Choice(["hash", "random"]),
+    help="Sample stars randomly, or by a hash of their source_id and the seed (reproducible)",
+)
+@click.option(
+    "--method",
+    default="columnar",
+    type=click.Choice(["columnar", "objects"]),
+    help="Build stars as columns (fast) or as Star objects via Catalog.build",
+)
+@click.option(
+    "--variant",
+    "variant_specs",
+    multiple=True,
+    type=(str, int, float, float, float),
+    metavar="DESTINATION NSIDE MAG_MIN MAG_MAX SAMPLE_RATE",
+    help="Build another catalog in the same pass over the source files (can be repeated, replaces --destination etc)",
+)
+@click.option(
+    "--tier",
+    "tier_specs",
+    multiple=True,
+    type=(int, float),
+    metavar="NSIDE MAG_MAX",
+    help="Build a magnitude tier (up to MAG_MAX, from the previous tier's or --mag_min) with its own NSIDE into the destination (can be repeated, see tiers.py)",
+)
+@click.option(
+    "--batch_size",
+    default=0,
+    help="Read source files in batches of this many MB of CSV, to bound memory (0 reads whole files)",
+)
+@click.option(
+    "--staging",
+    default=None,
+    help="Path of staged (Parquet) source files to read instead of the CSVs, see staging.py",
+)
+@click.option(
+    "--writer",
+    default="dataset",
+    type=click.Choice(["dataset", "merge"]),
+    help="Write parquet fragments into each partition (to squash later), or write sorted runs and merge them into each partition's stars.parquet at the end",
+)
+@click.option(
+    "--subindex_nside",
+    default=0,
+    help="With --writer merge, HEALPix NSIDE of the sub-index to cluster rows by within each magnitude band (0 sorts by magnitude only)",
+)
+@click.option(
+    "--magnitude_band",
+    default=1.0,
+    help="With --writer merge, width of the magnitude bands rows are clustered in, when there's a sub-index",
+)
+@profiles.click_options
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Skip source files the manifest says are already built with the same parameters",
+)
+@click.option(
+    "--metrics",
+    "metrics_filename",
+    default=METRICS_FILENAME,
+    help="JSON lines file to append metrics of each source file (time in each stage, rows and peak RSS) and their summary to",
+)
+@click.option(
+    "--profile_index",
+    "profile_indexes",
+    multiple=True,
+    type=int,
+    help="Profile building the source file at this index with cProfile, into build-<index>.prof (can be repeated)",
+)
 def main(
     source: str,
     destination: str,
@@ -273,16 +991,121 @@ def main(
     mag_max: float,
     seed: int,
     sample_rate: float,
+    sampling: str,
+    method: str,
+    variant_specs: list[tuple],
+    tier_specs: list[tuple],
+    batch_size: int,
+    staging: str,
+    writer: str,
+    subindex_nside: int,
+    magnitude_band: float,
+    profile: str,
+    compression_level: int,
+    geometry: bool,
+    resume: bool,
+    metrics_filename: str,
+    profile_indexes: list[int],
 ):
+    if resume and method != "columnar":
+        raise click.UsageError("--resume requires --method columnar")
+
+    if tier_specs and variant_specs:
+        raise click.UsageError("--tier can't be used with --variant")
+    if list(tier_specs) != sorted(tier_specs, key=lambda spec: spec[1]):
+        raise click.UsageError("Tiers must be in order of magnitude")
+
+    # each tier includes its lower magnitude, but not its upper one (except for the last tier)
+    tier_ranges = [
+        (tier_nside, tier_specs[n - 1][1] if n else mag_min, tier_mag_max)
+        for n, (tier_nside, tier_mag_max) in enumerate(tier_specs)
+    ]
+    tier_variants = [
+        Variant(
+            str(tiers.tier_path(destination, n)),
+            tier_nside,
+            tier_mag_min,
+            tier_mag_max,
+            sample_rate,
+            closed="left" if n < len(tier_ranges) - 1 else "both",
+        )
+        for n, (tier_nside, tier_mag_min, tier_mag_max) in enumerate(tier_ranges)
+    ]
+
+    variants = (
+        [Variant(*spec) for spec in variant_specs]
+        or tier_variants
+        or [Variant(destination, nside, mag_min, mag_max, sample_rate)]
+    )
+    if len(variants) > 1 and method != "columnar":
+        raise click.UsageError("Multiple variants require --method columnar")
+    if writer == "merge" and method != "columnar":
+        raise click.UsageError("--writer merge requires --method columnar")
+    if subindex_nside and writer != "merge":
+        raise click.UsageError(
+            "--subindex_nside requires --writer merge (otherwise, squash with it)"
+        )
+    if len({v.destination for v in variants}) < len(variants):
+        raise click.UsageError("Each variant needs its own destination")
+
+    # the manifest of a squashed (or merged) build no longer matches what's in its partitions, so files
+    # built into it again would be added next to (or merged over) the stars already squashed from them
+    if resume or writer == "merge":
+        for v in variants:
+            if manifest.is_squashed(v.destination):
+                raise click.UsageError(
+                    f"{v.destination} is already squashed or merged, so it has to be built from "
+                    "scratch (if a merge was interrupted, rerun src/merge.py instead)"
+                )
+
     time_start = time.time()
 
+    # each variant has its own manifest, in its destination
+    params = {
+        v.destination: dict(
+            version=__version__,
+            nside=v.nside,
+            mag_min=v.mag_min,
+            mag_max=v.mag_max,
+            sample_rate=v.sample_rate,
+            sampling=sampling,
+            seed=seed,
+            **({"closed": v.closed} if v.closed != "both" else {}),
+        )
+        for v in variants
+    }
+    sources = source_fingerprints(source)
+    entries = {v.destination: manifest.read(v.destination) for v in variants}
+
     items = [n for n in range(start, stop + 1)]
-    chunk_size = math.ceil(len(items) / num_workers)
-    items_chunked = list(chunks(items, chunk_size))
+    if resume:
+        items = [
+            n
+            for n in items
+            if n >= len(sources)
+            or not all(
+                manifest.is_done(entries[d].get(n), sources[n], params[d])
+                for d in entries
+            )
+        ]
+
+    # remove anything left over from previous builds of these files
+    for n in items:
+        for d in entries:
+            if n in entries[d]:
+                manifest.remove_fragments(d, entries[d][n])
 
-    queue = multiprocessing.Queue(-1)
+    # build largest files first, so stragglers don't hold up the end of the build
+    items.sort(
+        key=lambda n: sources[n]["size"] if n < len(sources) else 0,
+        reverse=True,
+    )
 
-    listener = multiprocessing.Process(target=logger_process, args=(queue,))
+    # spawn (instead of fork) because Polars' thread pool is not fork-safe once used in main
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue(-1)
+
+    listener = context.Process(target=logger_process, args=(queue,))
     listener.start()
 
     log_handler = QueueHandler(queue)
@@ -291,51 +1114,148 @@ def main(
     root.setLevel(logging.INFO)
     logger = logging.getLogger("build.main")
     logger.info(f"Starting {num_workers} workers...")
+    if resume:
+        logger.info(f"Resuming: {stop - start + 1 - len(items):,} files already built")
 
     gaia_path = Path(source)
 
-    crossmatch_hip = read_crossmatch(
-        source_path=gaia_path
-        / "cross_match"
-        / "hipparcos2_best_neighbor"
-        / "Hipparcos2BestNeighbour.csv"
+    crossmatch_hip = crossmatch.cache(
+        gaia_path / "cross_match" / crossmatch.HIP_CSV, "hip", pl.Int64
     )
-    crossmatch_tyc = read_crossmatch(
-        source_path=gaia_path
-        / "cross_match"
-        / "tycho2tdsc_merge_neighbourhood"
-        / "tycho2tdsc_merge_neighbourhood.csv",
-        cast=str,
+    crossmatch_tyc = crossmatch.cache(
+        gaia_path / "cross_match" / crossmatch.TYC_CSV, "tyc", pl.String
     )
 
-    workers = []
-    for i, chunk in enumerate(items_chunked):
-        worker = multiprocessing.Process(
-            target=worker_process,
-            kwargs=dict(
-                queue=queue,
-                chunk=chunk,
-                worker_id=i + 2,  # add 2 because first process is listener
-                gaia_path=source,
-                destination=destination,
-                nside=nside,
-                mag_min=mag_min,
-                mag_max=mag_max,
-                seed=seed,
-                sample_rate=sample_rate,
-                crossmatch_hip=crossmatch_hip,
-                crossmatch_tyc=crossmatch_tyc,
-            ),
-        )
-        workers.append(worker)
-        worker.start()
-    for w in workers:
-        w.join()
+    worker_kwargs = dict(
+        gaia_path=source,
+        variants=variants,
+        seed=seed,
+        sampling=sampling,
+        crossmatch_hip=crossmatch_hip,
+        crossmatch_tyc=crossmatch_tyc,
+        method=method,
+        batch_size=batch_size,
+        staging_path=staging,
+        writer=writer,
+        profile_indexes=set(profile_indexes),
+    )
+
+    # workers pull one source file at a time
+    busy = defaultdict(float)
+    built = defaultdict(int)
+    failed = []
+    peak_rss_max = 0
+    time_start_pool = time.time()
+    first_started = last_finished = None
+    file_metrics = []
+    with (
+        open(metrics_filename, "a") as metrics_file,
+        context.Pool(
+            processes=num_workers,
+            initializer=init_worker_process,
+            initargs=(queue, worker_kwargs),
+        ) as pool,
+    ):
+        for result in pool.imap_unordered(worker_process, items):
+            name, index = result["worker"], result["index"]
+            file_metrics.append(
+                dict(
+                    index=index,
+                    source=sources[index]["filename"] if index < len(sources) else None,
+                    worker=name,
+                    status=result["status"],
+                    duration=round(result["finished"] - result["started"], 4),
+                    peak_rss=result["peak_rss"],
+                    **result.pop("metrics"),
+                )
+            )
+            metrics_file.write(json.dumps(file_metrics[-1]) + "\n")
+            metrics_file.flush()
+            busy[name] += result["finished"] - result["started"]
+            built[name] += 1
+            peak_rss_max = max(peak_rss_max, result["peak_rss"])
+            first_started = min(first_started or result["started"], result["started"])
+            last_finished = max(last_finished or result["finished"], result["finished"])
+
+            if result["status"] == "failed":
+                failed.append(index)
+            if index < len(sources):
+                for d in entries:
+                    manifest.append(
+                        d,
+                        dict(
+                            result,
+                            fragments=result["fragments"].get(d, []),
+                            source=sources[index],
+                            params=params[d],
+                        ),
+                    )
 
     duration = time.time() - time_start
-    average = round(duration / len(items), 2)
+    average = round(duration / max(len(items), 1), 2)
     logger.info(f"Done: {start} -> {stop}")
     logger.info(f"Duration: {round(duration, 4)} | Average: {average}")
+    if failed:
+        logger.error(f"Failed: {sorted(failed)} (rerun with --resume to retry)")
+
+    if first_started is not None:
+        duration_workers = last_finished - first_started
+        logger.info(f"Worker startup: {round(first_started - time_start_pool, 2)}")
+        for name in sorted(busy):
+            logger.info(
+                f"{name} | files = {built[name]:,} | busy = {round(busy[name], 2)} "
+                f"| utilization = {busy[name] / duration_workers:.1%}"
+            )
+        utilization = sum(busy.values()) / (num_workers * duration_workers)
+        logger.info(f"Worker utilization: {utilization:.1%}")
+        logger.info(f"Peak worker RSS: {peak_rss_max:,} MB")
+
+    summary = summarize_metrics(file_metrics)
+    for stage, total in summary["stages"].items():
+        logger.info(
+            f"Stage {stage} | {round(total['duration'], 2)} | {total['share']:.1%} "
+            f"| {total['rows_per_sec'] or 0:,} rows/sec"
+        )
+
+    if writer == "merge" and not failed:
+        for d in entries:
+            time_start_merge = time.time()
+            logger.info(f"Merging {d}...")
+            rows = merge.merge_runs(
+                d,
+                num_workers,
+                profiles.from_options(profile, compression_level, geometry),
+                subindex_nside,
+                magnitude_band,
+            )
+            duration_merge = time.time() - time_start_merge
+            summary.setdefault("merge", {})[d] = dict(
+                rows=rows, duration=round(duration_merge, 4)
+            )
+            logger.info(
+                f"Merged {rows:,} rows in {round(duration_merge, 2)} "
+                f"| {rows / max(duration_merge, 1e-9):,.0f} rows/sec"
+            )
+    elif writer == "merge":
+        logger.error("Not merging until every source file is built")
+
+    if tier_specs:
+        tiers.write_index(
+            destination,
+            [
+                dict(nside=tier_nside, mag_min=tier_mag_min, mag_max=tier_mag_max)
+                for tier_nside, tier_mag_min, tier_mag_max in tier_ranges
+            ],
+        )
+
+    # merged builds are final, so they're indexed now (builds written as fragments are indexed when squashed)
+    if writer == "merge" and not failed:
+        for d in [destination] if tier_specs else entries:
+            catalog_index.write(d)
+
+    summary["duration"] = round(time.time() - time_start, 4)
+    with open(metrics_filename, "a") as f:
+        f.write(json.dumps(dict(summary=summary)) + "\n")
 
     queue.put_nowait(None)
     listener.join()
@@ -0,0 +1,195 @@
+from pathlib import Path
+
+import click
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import manifest
+import tiers
+
+"""
+Catalog-wide index of every row group in a build, for planning queries without listing partitions or
+reading parquet footers.
+
+The index is a single Arrow IPC file in the root of the build (prefixed with an underscore, and without
+a `.parquet` suffix, so it's never read as part of the catalog), with one row per row group: the
+path of its file (relative to the build), the file's tier (in a tiered build) and the NSIDE and index
+of its HEALPix partition (partition indexes are only unique within a tier), size and footer size, and the
+row group's number of rows, byte offset and length in the file, and min/max magnitude (and HEALPix
+sub-index, if the partitions were squashed with one).
+
+A query can then pick the files and row groups it needs from the index (see `select`), and only open
+those files. It's written after squashing (or merging) a build, so it describes the final files.
+"""
+
+INDEX_FILENAME = "_index.arrow"
+
+SCHEMA = pa.schema(
+    [
+        pa.field("path", pa.string(), nullable=False),
+        pa.field("tier", pa.int32()),
+        pa.field("nside", pa.int32()),
+        pa.field("healpix_index", pa.int64(), nullable=False),
+        pa.field("file_bytes", pa.int64(), nullable=False),
+        pa.field("footer_bytes", pa.int64(), nullable=False),
+        pa.field("row_group", pa.int32(), nullable=False),
+        pa.field("rows", pa.int64(), nullable=False),
+        pa.field("offset", pa.int64(), nullable=False),
+        pa.field("length", pa.int64(), nullable=False),
+        pa.field("magnitude_min", pa.float64()),
+        pa.field("magnitude_max", pa.float64()),
+        pa.field("subindex_min", pa.int64()),
+        pa.field("subindex_max", pa.int64()),
+    ]
+)
+
+
+def column_range(row_group, metadata, name) -> tuple:
+    """Returns min and max of a column in a row group, from its statistics (or None if there aren't any)"""
+    if name not in metadata.schema.names:
+        return None, None
+    statistics = row_group.column(metadata.schema.names.index(name)).statistics
+    if statistics is None or not statistics.has_min_max:
+        return None, None
+    return statistics.min, statistics.max
+
+
+def row_groups(source_path, filename: Path, tier=None, nside=None) -> list[dict]:
+    metadata = pq.read_metadata(filename)
+    file_bytes = filename.stat().st_size
+    rows = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        columns = [row_group.column(c) for c in range(row_group.num_columns)]
+        offset = min(
+            c.dictionary_page_offset
+            if c.dictionary_page_offset is not None
+            else c.data_page_offset
+            for c in columns
+        )
+        magnitude_min, magnitude_max = column_range(row_group, metadata, "magnitude")
+        subindex_min, subindex_max = column_range(
+            row_group, metadata, "healpix_subindex"
+        )
+        rows.append(
+            dict(
+                path=str(filename.relative_to(source_path)),
+                tier=tier,
+                nside=nside,
+                healpix_index=int(filename.parent.name.split("=")[1]),
+                file_bytes=file_bytes,
+                footer_bytes=metadata.serialized_size,
+                row_group=i,
+                rows=row_group.num_rows,
+                offset=offset,
+                length=sum(c.total_compressed_size for c in columns),
+                magnitude_min=magnitude_min,
+                magnitude_max=magnitude_max,
+                subindex_min=subindex_min,
+                subindex_max=subindex_max,
+            )
+        )
+    return rows
+
+
+def build_nside(source_path):
+    """Returns the NSIDE a (flat) build was built with, from its manifest, or None if it can't tell"""
+    nsides = {
+        entry["params"]["nside"]
+        for entry in manifest.read(source_path).values()
+        if "params" in entry
+    }
+    return nsides.pop() if len(nsides) == 1 else None
+
+
+def build_index(source_path) -> pa.Table:
+    """Returns the index of every row group in a build (or each tier of a tiered build)"""
+    source_path = Path(source_path)
+    # tier and NSIDE of the partitions in each directory
+    layers = {".": (None, build_nside(source_path))}
+    if tiers.is_tiered(source_path):
+        layers = {
+            tier["path"]: (tier["tier"], tier["nside"])
+            for tier in tiers.read_index(source_path)
+        }
+
+    rows = []
+    for partition_name in tiers.partition_names(source_path):
+        tier, nside = layers[str(Path(partition_name).parent)]
+        for filename in sorted((source_path / partition_name).glob("*.parquet")):
+            rows.extend(row_groups(source_path, filename, tier, nside))
+    return pa.Table.from_pylist(rows, schema=SCHEMA)
+
+
+def write(source_path) -> pa.Table:
+    """Writes the index of a build, and returns it"""
+    index = build_index(source_path)
+    partial = Path(source_path) / f"{INDEX_FILENAME}.partial"
+    with pa.OSFile(str(partial), "wb") as sink:
+        with pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(index)
+    partial.rename(Path(source_path) / INDEX_FILENAME)
+    return index
+
+
+def read(source_path) -> pa.Table:
+    with pa.memory_map(str(Path(source_path) / INDEX_FILENAME)) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def select(
+    index: pa.Table,
+    healpix_indices=None,
+    mag_min=None,
+    mag_max=None,
+    subindex_ranges=None,
+    tier=None,
+) -> dict[str, list[int]]:
+    """
+    Returns the row groups (of each file) that can have stars within the partitions, magnitude range
+    and sub-index ranges, going by the index alone. In a tiered build, partitions are selected within
+    a `tier` (since each tier has its own NSIDE).
+    """
+
+    def values(column, fill):
+        # row groups without statistics can't be ruled out
+        return pc.fill_null(index[column], fill).to_numpy()
+
+    mask = np.ones(index.num_rows, dtype=bool)
+    if tier is not None:
+        mask &= pc.fill_null(pc.equal(index["tier"], tier), False).to_numpy()
+    if healpix_indices is not None:
+        mask &= np.isin(index["healpix_index"].to_numpy(), healpix_indices)
+    if mag_min is not None:
+        mask &= values("magnitude_max", np.inf) >= mag_min
+    if mag_max is not None:
+        mask &= values("magnitude_min", -np.inf) <= mag_max
+    if subindex_ranges is not None:
+        low = values("subindex_min", np.iinfo(np.int64).min)
+        high = values("subindex_max", np.iinfo(np.int64).max)
+        overlaps = np.zeros(index.num_rows, dtype=bool)
+        for start, end in subindex_ranges:
+            overlaps |= (low <= end) & (high >= start)
+        mask &= overlaps
+
+    selected = {}
+    for row in index.filter(pa.array(mask)).select(["path", "row_group"]).to_pylist():
+        selected.setdefault(row["path"], []).append(row["row_group"])
+    return selected
+
+
+@click.command()
+@click.option("--source", help="Source path of catalog data")
+def main(source):
+    """Writes the index of a build (squashed or merged)"""
+    index = write(source)
+    print(
+        f"Indexed {pc.count_distinct(index['path']).as_py():,} files "
+        f"| {index.num_rows:,} row groups | {pc.sum(index['rows']).as_py() or 0:,} rows"
+    )
+
+
+if __name__ == "__main__":
+    main()
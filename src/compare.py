@@ -1,42 +1,222 @@
+import json
+import multiprocessing
+import time
 from pathlib import Path
 
+import click
+import numpy as np
+import polars as pl
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from starplot.data.catalogs import BIG_SKY
+
+import tiers
+
 
 __version__ = "0.1.0"
 
-HERE = Path(__file__).resolve().parent
-DATA_PATH = Path("/Volumes/Blue2TB/gaia/gdr3/")
-BUILD_PATH = HERE / "build"
-
-# logger = logging.getLogger(__name__)
-# logger.setLevel(logging.INFO)
-# console_handler = logging.StreamHandler()
-# file_handler = logging.FileHandler("build.log", mode='a')
-# logger.addHandler(console_handler)
-# logger.addHandler(file_handler)
-# formatter = logging.Formatter(
-#     "{asctime} - {levelname} - {message}",
-#     style="{",
-#     datefmt="%Y-%m-%d %H:%M",
-# )
-# console_handler.setFormatter(formatter)
-# file_handler.setFormatter(formatter)
-
-
-def compare_stars(gaia_star, bigsky_star, threshold=0.25) -> bool:
-    if not gaia_star or not bigsky_star:
-        return
-
-    over_threshold = False
-    fields = ["magnitude", "bv", "ra", "dec"]
-
-    for f in fields:
-        gaia_value = getattr(gaia_star, f, None)
-        bigsky_value = getattr(bigsky_star, f, None)
-        if gaia_value is None or bigsky_value is None:
-            continue
-        diff = abs(gaia_value - bigsky_value)
-        if diff > threshold:
-            # logger.info(f"HIP={bigsky_star.hip} | {f} diff -> {diff}")
-            over_threshold = True
-
-    return over_threshold
+"""
+Validates a build against a reference catalog (Big Sky, by default), by comparing the magnitude, B-V, RA
+and DEC of every star crossmatched to Hipparcos or Tycho.
+
+Crossmatched stars are read from the build in parallel, skipping the row groups that have none (going
+by the null counts in their footers, and since partitions are sorted by magnitude, the bright,
+crossmatched stars are in the first row groups). They're joined to the reference catalog on their
+Hipparcos id, or if they don't have one, their Tycho id, and the differences of each field are computed
+as whole columns. The summary of the differences is written to `_compare.json` in the root of the build,
+and the stars with any difference over the threshold to `_compare.csv`.
+"""
+
+FIELDS = ["magnitude", "bv", "ra", "dec"]
+COLUMNS = ["pk", "hip", "tyc", *FIELDS]
+
+REPORT_FILENAME = "_compare.json"
+OVER_THRESHOLD_FILENAME = "_compare.csv"
+
+
+def crossmatched_row_groups(parquet_file: pq.ParquetFile) -> list[int]:
+    """Returns the row groups that can have stars with a Hipparcos or Tycho id, from their null counts"""
+    metadata = parquet_file.metadata
+    columns = [metadata.schema.names.index(name) for name in ("hip", "tyc")]
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for c in columns:
+            statistics = row_group.column(c).statistics
+            if (
+                statistics is None
+                or not statistics.has_null_count
+                or statistics.null_count < row_group.num_rows
+            ):
+                row_groups.append(i)
+                break
+    return row_groups
+
+
+def read_crossmatched(filename) -> pl.DataFrame:
+    parquet_file = pq.ParquetFile(filename)
+    table = parquet_file.read_row_groups(
+        crossmatched_row_groups(parquet_file), columns=COLUMNS
+    )
+    table = table.filter(pc.or_(pc.is_valid(table["hip"]), pc.is_valid(table["tyc"])))
+    return pl.from_arrow(table).with_columns(
+        pl.col("hip").cast(pl.Int64),
+        pl.col("tyc").cast(pl.String),
+        *[pl.col(f).cast(pl.Float64) for f in FIELDS],
+    )
+
+
+def read_catalog(source_path, num_workers=10) -> pl.DataFrame:
+    """Returns every star of a build (or each tier of a tiered build) with a Hipparcos or Tycho id"""
+    source_path = Path(source_path)
+    filenames = [
+        filename
+        for partition_name in tiers.partition_names(source_path)
+        for filename in sorted((source_path / partition_name).glob("*.parquet"))
+    ]
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        frames = list(pool.imap_unordered(read_crossmatched, filenames))
+    if not frames:
+        return pl.DataFrame(
+            schema={"pk": pl.Int64, "hip": pl.Int64, "tyc": pl.String}
+            | {f: pl.Float64 for f in FIELDS}
+        )
+    return pl.concat(frames).sort("pk")
+
+
+def read_reference(path) -> pl.DataFrame:
+    return pl.read_parquet(path, columns=["hip", "tyc", *FIELDS]).with_columns(
+        pl.col("hip").cast(pl.Int64),
+        pl.col("tyc").cast(pl.String),
+        *[pl.col(f).cast(pl.Float64) for f in FIELDS],
+    )
+
+
+def tycho_id(column) -> pl.Expr:
+    """Returns Tycho ids without their (optional) catalog prefix, e.g. `TYC 1-2-1` -> `1-2-1`"""
+    return pl.col(column).str.strip_prefix("TYC ").str.strip_chars()
+
+
+def join(gaia: pl.DataFrame, reference: pl.DataFrame) -> pl.DataFrame:
+    """
+    Joins Gaia stars to reference stars on Hipparcos id, or Tycho id for stars without one,
+    with the reference values as `<field>_reference`
+    """
+    reference_fields = [pl.col(f).alias(f"{f}_reference") for f in FIELDS]
+
+    by_hip = gaia.filter(pl.col("hip").is_not_null()).join(
+        reference.filter(pl.col("hip").is_not_null())
+        .unique("hip", keep="first", maintain_order=True)
+        .select("hip", *reference_fields),
+        on="hip",
+    )
+    by_tyc = (
+        gaia.filter(pl.col("hip").is_null() & pl.col("tyc").is_not_null())
+        .with_columns(tycho_id("tyc").alias("_tyc"))
+        .join(
+            reference.filter(pl.col("tyc").is_not_null())
+            .with_columns(tycho_id("tyc").alias("_tyc"))
+            .unique("_tyc", keep="first", maintain_order=True)
+            .select("_tyc", *reference_fields),
+            on="_tyc",
+        )
+        .drop("_tyc")
+    )
+
+    return pl.concat(
+        [
+            by_hip.with_columns(pl.lit("hip").alias("match")),
+            by_tyc.with_columns(pl.lit("tyc").alias("match")),
+        ]
+    ).sort("pk")
+
+
+def add_deltas(matched: pl.DataFrame) -> pl.DataFrame:
+    """Adds the difference (Gaia - reference) of each field, as `<field>_delta`"""
+    deltas = [
+        (pl.col(f) - pl.col(f"{f}_reference")).alias(f"{f}_delta") for f in FIELDS
+    ]
+    # RA wraps around at 360
+    deltas[FIELDS.index("ra")] = (
+        (pl.col("ra") - pl.col("ra_reference") + 180) % 360 - 180
+    ).alias("ra_delta")
+    return matched.with_columns(deltas)
+
+
+def over_threshold(matched: pl.DataFrame, threshold=0.25) -> pl.DataFrame:
+    """Returns stars with the difference of any field over the threshold"""
+    return matched.filter(
+        pl.any_horizontal([pl.col(f"{f}_delta").abs() > threshold for f in FIELDS])
+    )
+
+
+def summarize(matched: pl.DataFrame, threshold=0.25) -> dict:
+    fields = {}
+    for f in FIELDS:
+        delta = matched[f"{f}_delta"].drop_nulls().drop_nans().to_numpy()
+        absolute = np.abs(delta)
+        fields[f] = dict(
+            count=len(delta),
+            mean=float(delta.mean()) if len(delta) else None,
+            std=float(delta.std()) if len(delta) else None,
+            median_abs=float(np.median(absolute)) if len(delta) else None,
+            p99_abs=float(np.percentile(absolute, 99)) if len(delta) else None,
+            max_abs=float(absolute.max()) if len(delta) else None,
+            over_threshold=int((absolute > threshold).sum()),
+        )
+    return dict(
+        matched=matched.height,
+        matched_hip=matched.filter(pl.col("match") == "hip").height,
+        matched_tyc=matched.filter(pl.col("match") == "tyc").height,
+        threshold=threshold,
+        fields=fields,
+    )
+
+
+@click.command()
+@click.option("--source", help="Source path of catalog data")
+@click.option(
+    "--reference",
+    default=str(BIG_SKY.path),
+    help="Parquet file of the reference catalog (with hip, tyc, magnitude, bv, ra and dec columns)",
+)
+@click.option(
+    "--destination", default=None, help="Path of the report (defaults to the source)"
+)
+@click.option("--threshold", default=0.25, help="Max difference of each field")
+@click.option("--num_workers", default=10, help="Number of workers to run")
+def main(source, reference, destination, threshold, num_workers):
+    """Compares the crossmatched stars of a build to a reference catalog"""
+    if not Path(reference).exists():
+        hint = ""
+        if reference == str(BIG_SKY.path):
+            hint = " (download it with `python -c 'from starplot.data.catalogs import BIG_SKY; BIG_SKY.download()'`)"
+        raise click.ClickException(f"Reference catalog {reference} doesn't exist{hint}")
+
+    time_start = time.time()
+    destination_path = Path(destination or source)
+
+    gaia = read_catalog(source, num_workers)
+    matched = add_deltas(join(gaia, read_reference(reference)))
+    report = summarize(matched, threshold)
+    report["crossmatched"] = gaia.height
+
+    with open(destination_path / REPORT_FILENAME, "w") as f:
+        json.dump(report, f, indent=1)
+    over = over_threshold(matched, threshold)
+    over.write_csv(destination_path / OVER_THRESHOLD_FILENAME)
+
+    for f, summary in report["fields"].items():
+        print(
+            f"{f} | {summary['count']:,} compared | max {summary['max_abs'] or 0:.4f} "
+            f"| p99 {summary['p99_abs'] or 0:.4f} | {summary['over_threshold']:,} over {threshold}"
+        )
+    print(
+        f"Done: {gaia.height:,} crossmatched | {matched.height:,} matched "
+        f"(hip={report['matched_hip']:,}, tyc={report['matched_tyc']:,}) "
+        f"| {over.height:,} over threshold | {time.time() - time_start:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
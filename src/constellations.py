@@ -0,0 +1,108 @@
+from functools import cache
+
+import numpy as np
+from skyfield.api import position_of_radec
+from skyfield.functions import load_bundled_npy
+from skyfield.timelib import Time, julian_date_of_besselian_epoch
+
+"""
+Vectorized constellation lookup for whole arrays of stars.
+
+Uses the same boundary tables as Skyfield's `load_constellation_map`, which divides the
+sky (in B1875 coordinates) into an irregular grid with a line at every right ascension and
+declination mentioned in a constellation boundary. Finding a star's cell in that grid takes
+two binary searches, so on top of it we precompute a uniform grid: any uniform cell that falls
+entirely within one constellation resolves with a single array lookup, and only stars in
+cells crossed by a boundary fall back to the binary searches.
+"""
+
+B1875 = Time(None, julian_date_of_besselian_epoch(1875))
+
+RA_BINS_PER_HOUR = 100
+DEC_BINS_PER_DEGREE = 10
+
+# Padding (in hours/degrees) added to each uniform cell when checking whether it's
+# entirely within one constellation, so float error in binning can never pick the wrong cell
+CELL_PADDING = 1e-9
+
+
+@cache
+def boundaries():
+    arrays = load_bundled_npy("constellations.npz")
+    return (
+        arrays["sorted_ra"],
+        arrays["sorted_dec"],
+        arrays["radec_to_index"],
+        np.char.lower(arrays["indexed_abbreviations"].astype(str)),
+    )
+
+
+@cache
+def lookup_grid() -> np.ndarray:
+    """
+    Returns a uniform (ra, dec) grid of constellation indexes in B1875 coordinates.
+
+    Cells that are crossed by a constellation boundary are set to -1.
+    """
+    sorted_ra, sorted_dec, radec_to_index, _ = boundaries()
+
+    ra_edges = np.arange(24 * RA_BINS_PER_HOUR + 1) / RA_BINS_PER_HOUR
+    dec_edges = np.arange(180 * DEC_BINS_PER_DEGREE + 1) / DEC_BINS_PER_DEGREE - 90
+
+    # range of boundary table indexes that each uniform cell can map to
+    i_lo = np.searchsorted(sorted_ra, ra_edges[:-1] - CELL_PADDING)
+    i_hi = np.searchsorted(sorted_ra, ra_edges[1:] + CELL_PADDING)
+    j_lo = np.searchsorted(sorted_dec, dec_edges[:-1] - CELL_PADDING, side="right")
+    j_hi = np.searchsorted(sorted_dec, dec_edges[1:] + CELL_PADDING, side="right")
+
+    ra_min = np.stack(
+        [radec_to_index[lo : hi + 1].min(axis=0) for lo, hi in zip(i_lo, i_hi)]
+    )
+    ra_max = np.stack(
+        [radec_to_index[lo : hi + 1].max(axis=0) for lo, hi in zip(i_lo, i_hi)]
+    )
+    cell_min = np.stack(
+        [ra_min[:, lo : hi + 1].min(axis=1) for lo, hi in zip(j_lo, j_hi)], axis=1
+    )
+    cell_max = np.stack(
+        [ra_max[:, lo : hi + 1].max(axis=1) for lo, hi in zip(j_lo, j_hi)], axis=1
+    )
+
+    return np.where(cell_min == cell_max, cell_min, -1).astype(np.int16)
+
+
+def precess_to_b1875(ra, dec) -> tuple[np.ndarray, np.ndarray]:
+    """Returns B1875 right ascension (hours) and declination (degrees) for arrays of ICRS ra/dec in degrees"""
+    position = position_of_radec(np.asarray(ra) / 15, np.asarray(dec))
+    ra_b1875, dec_b1875, _ = position.radec(epoch=B1875)
+    return ra_b1875.hours, dec_b1875.degrees
+
+
+def constellation_ids(ra, dec) -> np.ndarray:
+    """
+    Returns lowercase constellation ids for arrays of ra/dec (in degrees).
+
+    Results are identical to looking up each star with Skyfield's constellation map.
+    """
+    sorted_ra, sorted_dec, radec_to_index, abbreviations = boundaries()
+    grid = lookup_grid()
+
+    ra_hours, dec_degrees = precess_to_b1875(ra, dec)
+
+    ra_bin = np.clip(
+        (ra_hours * RA_BINS_PER_HOUR).astype(np.intp), 0, grid.shape[0] - 1
+    )
+    dec_bin = np.clip(
+        ((dec_degrees + 90) * DEC_BINS_PER_DEGREE).astype(np.intp),
+        0,
+        grid.shape[1] - 1,
+    )
+    index = grid[ra_bin, dec_bin]
+
+    boundary = index < 0
+    if boundary.any():
+        i = np.searchsorted(sorted_ra, ra_hours[boundary])
+        j = np.searchsorted(sorted_dec, dec_degrees[boundary], side="right")
+        index[boundary] = radec_to_index[i, j]
+
+    return abbreviations[index]
@@ -0,0 +1,156 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+
+"""
+Crossmatches between Gaia source ids and external catalogs (Hipparcos and Tycho).
+
+The crossmatch CSVs are parsed once and cached as Parquet files next to the CSVs, sorted by source_id,
+so build workers can load them in a fraction of the time (and memory) and join them to each source file.
+
+Next to each Parquet file, the crossmatch is also written as an index of plain NumPy arrays (sorted
+source ids, plus external ids in Arrow layout). Build workers memory-map these arrays, so all workers
+share one physical copy through the OS page cache, and look up source ids with a binary search.
+
+Each cache file is written to a temporary file first and renamed, and the Parquet file is written last,
+so a crashed (or concurrent) build never leaves a partial cache that a later build would trust.
+"""
+
+HIP_CSV = Path("hipparcos2_best_neighbor") / "Hipparcos2BestNeighbour.csv"
+TYC_CSV = Path("tycho2tdsc_merge_neighbourhood") / "tycho2tdsc_merge_neighbourhood.csv"
+
+
+def read_csv(source_path, column, dtype) -> pl.DataFrame:
+    """Returns frame of Gaia source_id and external source id (as `column`), sorted by source_id"""
+    df = pl.read_csv(
+        source_path,
+        columns=["source_id", "original_ext_source_id"],
+        schema_overrides={"source_id": pl.Int64, "original_ext_source_id": dtype},
+    )
+    return (
+        df.rename({"original_ext_source_id": column})
+        .unique(subset="source_id", keep="last", maintain_order=True)
+        .sort("source_id")
+    )
+
+
+def cache(source_path, column, dtype) -> Path:
+    """
+    Parses a crossmatch CSV into a sorted Parquet file next to it (unless it's already cached),
+    and returns the path of the Parquet file.
+    """
+    source_path = Path(source_path)
+    cache_path = source_path.with_suffix(".parquet")
+
+    if (
+        not cache_path.exists()
+        or not index_path(cache_path, "source_id").exists()
+        or cache_path.stat().st_mtime < source_path.stat().st_mtime
+    ):
+        crossmatch = read_csv(source_path, column, dtype)
+        write_index(crossmatch, cache_path)
+        partial = partial_path(cache_path)
+        crossmatch.write_parquet(partial, statistics=True)
+        partial.rename(cache_path)
+
+    return cache_path
+
+
+@dataclass
+class Index:
+    """Crossmatch backed by memory-mapped arrays"""
+
+    column: str
+    """Name of the external id column"""
+
+    source_id: np.ndarray
+    """Sorted Gaia source ids"""
+
+    values: pa.Array
+    """External ids, in the same order as `source_id`"""
+
+    def lookup(self, source_ids) -> pl.Series:
+        """Returns external id for each source id (or null if there's no crossmatch)"""
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        i = np.searchsorted(self.source_id, source_ids)
+        found = i < len(self.source_id)
+        found[found] = self.source_id[i[found]] == source_ids[found]
+        return pl.Series(self.column, self.values.take(pa.array(i, mask=~found)))
+
+
+def index_path(cache_path, name) -> Path:
+    return Path(cache_path).with_suffix(f".{name}.npy")
+
+
+def partial_path(path) -> Path:
+    # named after the process, so concurrent builds don't write to the same file
+    return Path(path).with_name(f"{Path(path).name}.{os.getpid()}.partial")
+
+
+def save_array(path, array: np.ndarray):
+    partial = partial_path(path)
+    with open(partial, "wb") as f:
+        np.save(f, array)
+    partial.rename(path)
+
+
+def write_index(crossmatch: pl.DataFrame, cache_path):
+    """Writes a (sorted) crossmatch frame as NumPy arrays that can be memory-mapped by `load_index`"""
+    source_id, column = crossmatch.columns
+    save_array(index_path(cache_path, "source_id"), crossmatch[source_id].to_numpy())
+
+    if crossmatch[column].dtype == pl.String:
+        values = pa.array(crossmatch[column].to_list(), type=pa.large_string())
+        _, offsets, data = values.buffers()
+        save_array(
+            index_path(cache_path, f"{column}.offsets"),
+            np.frombuffer(offsets, np.int64),
+        )
+        save_array(
+            index_path(cache_path, f"{column}.data"), np.frombuffer(data, np.uint8)
+        )
+    else:
+        save_array(index_path(cache_path, column), crossmatch[column].to_numpy())
+
+
+def load_index(cache_path, column) -> Index:
+    """Memory-maps a crossmatch index, without copying any of its arrays"""
+    source_id = np.load(index_path(cache_path, "source_id"), mmap_mode="r")
+
+    if index_path(cache_path, f"{column}.offsets").exists():
+        offsets = np.load(index_path(cache_path, f"{column}.offsets"), mmap_mode="r")
+        data = np.load(index_path(cache_path, f"{column}.data"), mmap_mode="r")
+        values = pa.LargeStringArray.from_buffers(
+            len(offsets) - 1, pa.py_buffer(offsets), pa.py_buffer(data)
+        )
+    else:
+        array = np.load(index_path(cache_path, column), mmap_mode="r")
+        values = pa.Array.from_buffers(
+            pa.from_numpy_dtype(array.dtype), len(array), [None, pa.py_buffer(array)]
+        )
+
+    return Index(column=column, source_id=source_id, values=values)
+
+
+def load(cache_path) -> pl.DataFrame:
+    return pl.read_parquet(cache_path)
+
+
+def to_dict(crossmatch: pl.DataFrame) -> dict:
+    """Returns dictionary mapping Gaia source_id to external source id"""
+    source_id, external_id = crossmatch.columns
+    return dict(zip(crossmatch[source_id].to_list(), crossmatch[external_id].to_list()))
+
+
+def join(df: pl.DataFrame, *crossmatches: pl.DataFrame | Index) -> pl.DataFrame:
+    """Left joins crossmatch frames (or indexes) to a frame of Gaia sources on source_id"""
+    for crossmatch in crossmatches:
+        if isinstance(crossmatch, Index):
+            df = df.with_columns(crossmatch.lookup(df["source_id"].to_numpy()))
+        else:
+            df = df.join(crossmatch, on="source_id", how="left")
+    return df
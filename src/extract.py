@@ -0,0 +1,40 @@
+import json
+from pathlib import Path
+
+import click
+
+import archive
+
+"""
+Extracts partitions from release archives (see `archive.py`), reading only the bytes of each partition's
+files, as listed in the archive manifest. The indexes in the root of the build (of its row groups and
+tiers) are always extracted too, and still list every partition in the build.
+"""
+
+
+@click.command()
+@click.option("--source", help="Path of the archives (and their manifest)")
+@click.option("--destination", help="Destination path of the extracted partitions")
+@click.option(
+    "--partition",
+    "partition_names",
+    multiple=True,
+    help="Partition to extract, e.g. healpix_index=42 (can be repeated)",
+)
+def main(source, destination, partition_names):
+    with open(Path(source) / archive.MANIFEST_FILENAME) as f:
+        manifest = json.load(f)
+
+    extracted = archive.extract(source, manifest, ".", destination)
+    if extracted:
+        print(f"Extracted {', '.join(p.name for p in extracted)}")
+
+    for partition_name in partition_names:
+        extracted = archive.extract(source, manifest, partition_name, destination)
+        if not extracted:
+            raise click.ClickException(f"{partition_name} isn't in the archives")
+        print(f"Extracted {partition_name} | {len(extracted):,} files")
+
+
+if __name__ == "__main__":
+    main()
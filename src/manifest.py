@@ -0,0 +1,142 @@
+import json
+import shutil
+from pathlib import Path
+
+import click
+
+import settings
+
+"""
+Build manifest, recording what was built from each Gaia source file.
+
+The manifest is a JSON lines file in the root of the build destination (prefixed with an underscore, so
+Parquet readers ignore it), with one entry appended each time a source file is built. For each source file
+index, the latest entry wins. Entries record the source file's size and mtime, the build parameters and the
+parquet fragments written, so a build can skip files that are already done, and redo files that failed,
+changed, or were built with different parameters.
+"""
+
+MANIFEST_FILENAME = "_manifest.jsonl"
+
+
+def fingerprint(source_filename: Path) -> dict:
+    stat = Path(source_filename).stat()
+    return {
+        "filename": Path(source_filename).name,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def read(destination) -> dict[int, dict]:
+    """Returns the latest manifest entry for each source file index"""
+    manifest_path = Path(destination) / MANIFEST_FILENAME
+    entries = {}
+
+    if not manifest_path.exists():
+        return entries
+
+    with open(manifest_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            entries[entry["index"]] = entry
+
+    return entries
+
+
+def append(destination, entry: dict):
+    Path(destination).mkdir(parents=True, exist_ok=True)
+    with open(Path(destination) / MANIFEST_FILENAME, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def is_done(entry: dict, source: dict, params: dict) -> bool:
+    """Returns True if the entry is a successful build of the same source file, with the same parameters"""
+    return (
+        entry is not None
+        and entry["status"] == "done"
+        and entry["source"] == source
+        and entry["params"] == params
+    )
+
+
+def is_squashed(destination) -> bool:
+    """
+    Returns True if a build's partitions have been squashed or merged into `stars.parquet`, so the
+    fragments (or runs) its manifest lists are gone
+    """
+    return any(Path(destination).glob(f"healpix_index=*/{settings.SQUASHED_FILENAME}"))
+
+
+def build_params(entries: dict[int, dict]) -> dict | None:
+    """Returns the build parameters of the first done entry of a manifest (None if nothing is done)"""
+    for _, entry in sorted(entries.items()):
+        if entry["status"] == "done":
+            return entry["params"]
+    return None
+
+
+def params_differences(params: dict, expected: dict) -> list[str]:
+    return [
+        f"{k}={params.get(k)} (not {expected.get(k)})"
+        for k in sorted(params.keys() | expected.keys())
+        if params.get(k) != expected.get(k)
+    ]
+
+
+def remove_fragments(destination, entry: dict):
+    """Deletes parquet fragments written by a previous build of a source file"""
+    for fragment in entry.get("fragments", []):
+        Path(destination, fragment).unlink(missing_ok=True)
+
+
+@click.command()
+@click.option(
+    "--source", multiple=True, help="Build destination to merge (can be repeated)"
+)
+@click.option("--destination", help="Destination path of the merged build")
+def main(source, destination):
+    """Merges builds of different source file ranges (e.g. built on different machines) into one"""
+    destination_path = Path(destination)
+    for path in [*source, destination]:
+        if is_squashed(path):
+            raise click.ClickException(
+                f"{path} is already squashed or merged, so its fragments are gone"
+            )
+    merged = read(destination_path)
+    sources = {Path(s): read(s) for s in source}
+
+    # every build has to have the same parameters (e.g. HEALPix NSIDE), or the partitions won't line up
+    expected, expected_path = build_params(merged), destination_path
+    for source_path, entries in sources.items():
+        for entry in entries.values():
+            if entry["status"] != "done":
+                continue
+            if expected is None:
+                expected, expected_path = entry["params"], source_path
+            elif differences := params_differences(entry["params"], expected):
+                raise click.ClickException(
+                    f"{source_path} was built with different parameters than {expected_path}: "
+                    + ", ".join(differences)
+                )
+
+    for source_path, entries in sources.items():
+        for index, entry in sorted(entries.items()):
+            if entry["status"] != "done":
+                continue
+            if index in merged:
+                remove_fragments(destination_path, merged[index])
+
+            for fragment in entry["fragments"]:
+                fragment_path = destination_path / fragment
+                fragment_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(source_path / fragment, fragment_path)
+            append(destination_path, entry)
+            merged[index] = entry
+            print(f"Merged {entry['source']['filename']} from {source_path}")
+
+
+if __name__ == "__main__":
+    main()
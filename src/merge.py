@@ -0,0 +1,406 @@
+import heapq
+import json
+import multiprocessing
+import shutil
+import time
+from pathlib import Path
+from typing import Iterator
+
+import click
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import catalog_index
+import manifest
+import profiles
+import settings
+import subindex
+
+"""
+Writes each HEALPix partition's `stars.parquet` directly from the build, without a separate squash.
+
+Instead of a parquet fragment in every partition, each source file is written as a single "run": an
+Arrow IPC file in `_runs/` (ignored by Parquet readers), sorted by partition then (magnitude, pk), with
+each partition in small record batches. Once all source files are built, the runs for each partition
+are combined with a k-way merge that reads each run a batch at a time (they're already sorted, so the
+partition is never loaded or sorted whole), and written to the partition's `stars.parquet` once.
+
+With a sub-index NSIDE, merged rows are clustered by sub-index within each magnitude band, the same as
+squash does it (see `subindex.py`), a band at a time.
+"""
+
+RUNS_DIRNAME = "_runs"
+
+# runs are only read once, by the merge, so they're compressed with a fast codec
+RUN_COMPRESSION = "lz4"
+
+ROW_GROUP_SIZE = 100_000
+
+# rows the merge buffers (past what it has to keep) before sorting them and yielding what's final
+MERGE_ROWS = 65_536
+
+# runs are written (and merged) in small batches, since the merge holds about a batch of every run in memory
+RUN_BATCH_SIZE = 8_192
+
+
+def write_run(table: pa.Table, destination, source_name) -> str:
+    """Writes a table as a run, and returns its path relative to the destination"""
+    table = table.sort_by(
+        [("healpix_index", "ascending")] + settings.SORT_KEYS
+    ).combine_chunks()
+    partitions, starts = np.unique(table["healpix_index"].to_numpy(), return_index=True)
+    rows = np.diff(np.append(starts, table.num_rows))
+
+    run_path = Path(destination) / RUNS_DIRNAME / f"{source_name}.arrow"
+    run_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # each partition is written in batches of up to RUN_BATCH_SIZE, so the merge can read it a batch at a time
+    batches = [-(-n // RUN_BATCH_SIZE) for n in rows.tolist()]
+    # partitions (their number of rows and first batch) are listed in the schema, so the merge can find them without reading any batches
+    schema = table.schema.with_metadata(
+        {
+            "partitions": json.dumps(partitions.tolist()),
+            "rows": json.dumps(rows.tolist()),
+            "batches": json.dumps(np.cumsum([0] + batches).tolist()),
+        }
+    )
+    with pa.OSFile(str(run_path), "wb") as sink:
+        with pa.ipc.new_file(
+            sink, schema, options=pa.ipc.IpcWriteOptions(compression=RUN_COMPRESSION)
+        ) as writer:
+            for start, length in zip(starts, rows):
+                writer.write_table(
+                    table.slice(start, length), max_chunksize=RUN_BATCH_SIZE
+                )
+
+    return str(run_path.relative_to(destination))
+
+
+class RunWriter:
+    """
+    Writes the stars of a source file as runs, a table at a time (the source file's first table is
+    its run, and each table after it is a run of its own), so the source file can be built a batch
+    at a time
+    """
+
+    def __init__(self, destination, source_name):
+        self.destination = destination
+        self.source_name = source_name
+        self.runs = []
+
+    def write(self, table: pa.Table):
+        if not table.num_rows:
+            return
+        name = f"{self.source_name}-{len(self.runs)}" if self.runs else self.source_name
+        self.runs.append(write_run(table, self.destination, name))
+
+    def close(self) -> list[str]:
+        """Returns paths of the runs written (relative to the destination)"""
+        return self.runs
+
+
+def read_run_partitions(run_path) -> dict[int, tuple[int, int, int]]:
+    """Returns the first batch, number of batches and number of rows of each partition in a run"""
+    with pa.OSFile(str(run_path)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata
+    partitions = json.loads(metadata[b"partitions"])
+    rows = json.loads(metadata[b"rows"])
+    # runs written before partitions were split into batches have a batch per partition
+    batches = json.loads(metadata.get(b"batches", b"null")) or list(
+        range(len(partitions) + 1)
+    )
+    return {
+        p: (batches[i], batches[i + 1] - batches[i], n)
+        for i, (p, n) in enumerate(zip(partitions, rows))
+    }
+
+
+def read_run_batches(run_path, first, count) -> Iterator[pa.RecordBatch]:
+    # the file is opened for each batch, so a merge of thousands of runs doesn't keep thousands of files open
+    for i in range(first, first + count):
+        with pa.OSFile(str(run_path)) as source:
+            yield pa.ipc.open_file(source).get_batch(i)
+
+
+def count_sorted_before(table: pa.Table, columns: list[str], key: tuple) -> int:
+    """Returns number of rows of a table (sorted by `columns`) that come before `key`"""
+    lo, hi = 0, table.num_rows
+    for column, value in zip(columns, key):
+        values = table[column].to_numpy()[lo:hi]
+        lo, hi = (
+            lo + np.searchsorted(values, value, side="left"),
+            lo + np.searchsorted(values, value, side="right"),
+        )
+    return lo
+
+
+def merge_sorted(
+    runs: list[Iterator[pa.RecordBatch]], sort_keys=settings.SORT_KEYS
+) -> Iterator[pa.Table]:
+    """
+    K-way merge of runs of record batches that are each sorted by `sort_keys` (ascending),
+    yielding tables in that order. Batches are only read from a run as the merge gets to them.
+
+    Batches are taken from a heap in order of their first row, so every row that hasn't been
+    taken yet comes at or after the first row of the batch on top of the heap, and buffered rows
+    before it are final. They're sorted and yielded once there are enough of them, and the rest
+    (about a batch of each run) stay buffered. Rows with equal keys from different runs can come
+    out in either order, so the sort keys should be unique.
+    """
+    columns = [column for column, _ in sort_keys]
+    runs = [iter(run) for run in runs]
+    heap = []
+
+    def push(i):
+        for batch in runs[i]:
+            if batch.num_rows:
+                key = tuple(batch[c][0].as_py() for c in columns)
+                heapq.heappush(heap, (key, i, pa.Table.from_batches([batch])))
+                return
+
+    for i in range(len(runs)):
+        push(i)
+
+    buffered = []
+    buffered_rows = 0
+    # rows left buffered after the last yield, so each sort yields at least as many rows as it keeps
+    kept_rows = 0
+    while heap:
+        _, i, table = heapq.heappop(heap)
+        push(i)
+        buffered.append(table)
+        buffered_rows += table.num_rows
+        if heap and buffered_rows - kept_rows < max(kept_rows, MERGE_ROWS):
+            continue
+
+        table = pa.concat_tables(buffered).sort_by(sort_keys)
+        n = count_sorted_before(table, columns, heap[0][0]) if heap else table.num_rows
+        if n:
+            yield table.slice(0, n)
+        buffered = [table.slice(n)]
+        buffered_rows = kept_rows = table.num_rows - n
+
+
+def cluster_bands(
+    tables: Iterator[pa.Table], subindex_nside, magnitude_band=1.0
+) -> Iterator[pa.Table]:
+    """
+    Sorts tables (in order of magnitude) by sub-index within each magnitude band, one band at a time,
+    yielding tables in the order squash writes partitions with a sub-index (`subindex.SUBINDEX_SORT_KEYS`)
+    """
+    buffered = []
+    for table in tables:
+        if not table.num_rows:
+            continue
+        table = subindex.add_subindex(table, subindex_nside, magnitude_band)
+        bands = table[subindex.BAND_COLUMN].to_numpy()
+        # bands go up with magnitude, so every band before this table's last one is complete
+        n = np.searchsorted(bands, bands[-1], side="left")
+        if n:
+            buffered.append(table.slice(0, n))
+            yield (
+                pa.concat_tables(buffered)
+                .sort_by(subindex.SUBINDEX_SORT_KEYS)
+                .drop_columns(subindex.BAND_COLUMN)
+            )
+            buffered = []
+        buffered.append(table.slice(n))
+
+    if buffered:
+        yield (
+            pa.concat_tables(buffered)
+            .sort_by(subindex.SUBINDEX_SORT_KEYS)
+            .drop_columns(subindex.BAND_COLUMN)
+        )
+
+
+def write_sorted(
+    tables: Iterator[pa.Table],
+    filename,
+    schema=settings.SCHEMA,
+    sorting_columns=tuple(c for c, _ in settings.SORT_KEYS),
+    profile=profiles.STANDARD,
+):
+    """
+    Writes sorted tables (of `schema`) to a parquet file, in row groups of ROW_GROUP_SIZE. Partitions are
+    sorted by `settings.SORT_KEYS` (magnitude, then pk), the same as squash sorts them.
+    """
+    partial = Path(filename).with_name(f"_{Path(filename).name}.partial")
+    buffered = []
+    buffered_rows = 0
+    stored_schema = profile.schema(schema)
+
+    with pq.ParquetWriter(
+        partial,
+        stored_schema,
+        sorting_columns=[
+            pq.SortingColumn(stored_schema.get_field_index(c)) for c in sorting_columns
+        ]
+        or None,
+        **profile.writer_options(stored_schema),
+    ) as writer:
+        for table in tables:
+            buffered.append(profile.cast(table.cast(schema)))
+            buffered_rows += table.num_rows
+            if buffered_rows >= ROW_GROUP_SIZE:
+                buffer = pa.concat_tables(buffered)
+                full = buffered_rows - buffered_rows % ROW_GROUP_SIZE
+                # contiguous, so pages are laid out the same as writing a whole table at once
+                writer.write_table(
+                    buffer.slice(0, full).combine_chunks(),
+                    row_group_size=ROW_GROUP_SIZE,
+                )
+                buffered = [buffer.slice(full)]
+                buffered_rows -= full
+
+        if buffered_rows:
+            writer.write_table(
+                pa.concat_tables(buffered).combine_chunks(),
+                row_group_size=ROW_GROUP_SIZE,
+            )
+
+    partial.rename(filename)
+
+
+def merge_partition(
+    destination,
+    partition,
+    runs: list[tuple[str, int, int, int]],
+    profile=profiles.STANDARD,
+    subindex_nside=0,
+    magnitude_band=1.0,
+) -> int:
+    """Merges a partition's batches from each run into its `stars.parquet`, and returns its number of rows"""
+    partition_path = Path(destination) / f"healpix_index={partition}"
+    partition_path.mkdir(parents=True, exist_ok=True)
+
+    batches = [
+        read_run_batches(Path(destination) / run, first, count)
+        for run, first, count, _ in runs
+    ]
+    merged = merge_sorted(batches)
+    schema = settings.SCHEMA
+    sorting_columns = [c for c, _ in settings.SORT_KEYS]
+    if subindex_nside:
+        merged = cluster_bands(merged, subindex_nside, magnitude_band)
+        schema, sorting_columns = subindex.SUBINDEX_SCHEMA, []
+
+    write_sorted(
+        merged,
+        partition_path / settings.SQUASHED_FILENAME,
+        schema,
+        sorting_columns,
+        profile,
+    )
+    return sum(rows for *_, rows in runs)
+
+
+def merge_partition_worker(args) -> tuple[int, int, float]:
+    time_start = time.time()
+    destination, partition, runs, profile, subindex_nside, magnitude_band = args
+    rows = merge_partition(
+        destination, partition, runs, profile, subindex_nside, magnitude_band
+    )
+    return partition, rows, time.time() - time_start
+
+
+def merge_runs(
+    destination,
+    num_workers=10,
+    profile=profiles.STANDARD,
+    subindex_nside=0,
+    magnitude_band=1.0,
+) -> int:
+    """
+    Merges the runs of every source file the manifest says is built into partitions (clustered by a
+    sub-index, if there's a sub-index NSIDE), and returns the number of rows. Once every partition is
+    written, the runs are deleted.
+    """
+    partition_runs = {}
+    partition_rows = {}
+    for entry in manifest.read(destination).values():
+        if entry["status"] != "done":
+            continue
+        for run in entry["fragments"]:
+            for partition, (first, count, n) in read_run_partitions(
+                Path(destination) / run
+            ).items():
+                partition_runs.setdefault(partition, []).append((run, first, count, n))
+                partition_rows[partition] = partition_rows.get(partition, 0) + n
+
+    # largest partitions first, so stragglers don't hold up the end
+    items = [
+        (
+            str(destination),
+            partition,
+            sorted(runs),
+            profile,
+            subindex_nside,
+            magnitude_band,
+        )
+        for partition, runs in sorted(
+            partition_runs.items(), key=lambda item: -partition_rows[item[0]]
+        )
+    ]
+
+    rows = 0
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=num_workers) as pool:
+        for partition, n, duration in pool.imap_unordered(
+            merge_partition_worker, items
+        ):
+            rows += n
+            print(f"Merged | healpix_index={partition} | {n:,} rows | {duration:.2f}s")
+
+    if (Path(destination) / RUNS_DIRNAME).exists():
+        shutil.rmtree(Path(destination) / RUNS_DIRNAME)
+    return rows
+
+
+@click.command()
+@click.option(
+    "--source", help="Source path of catalog data (built with --writer merge)"
+)
+@click.option("--num_workers", default=10, help="Number of workers to run")
+@click.option(
+    "--subindex_nside",
+    default=0,
+    help="HEALPix NSIDE of the sub-index to cluster rows by within each magnitude band (0 sorts by magnitude only)",
+)
+@click.option(
+    "--magnitude_band",
+    default=1.0,
+    help="Width of the magnitude bands rows are clustered in, when there's a sub-index",
+)
+@profiles.click_options
+def main(
+    source,
+    num_workers,
+    subindex_nside,
+    magnitude_band,
+    profile,
+    compression_level,
+    geometry,
+):
+    """Merges the runs of a build into a `stars.parquet` per partition"""
+    if not (Path(source) / RUNS_DIRNAME).exists():
+        raise click.ClickException(f"{source} has no runs to merge (already merged?)")
+
+    time_start = time.time()
+    rows = merge_runs(
+        source,
+        num_workers,
+        profiles.from_options(profile, compression_level, geometry),
+        subindex_nside,
+        magnitude_band,
+    )
+    catalog_index.write(source)
+    duration = time.time() - time_start
+    print(
+        f"Done: {rows:,} rows | {duration:.2f}s | {rows / max(duration, 1e-9):,.0f} rows/sec"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+
+import click
+import pyarrow as pa
+
+import settings
+
+"""
+Storage profiles of the squashed (or merged) catalog files.
+
+The standard profile writes `settings.SCHEMA` as is, with snappy compression. The compact profile stores
+values with the smallest types that hold them at the precision they're rounded to in the build:
+magnitude, B-V, parallax and proper motions as float32 (far more precise than their measurement errors),
+Hipparcos ids as (nullable) int32, epochs as int16 and constellation ids dictionary-encoded. It's
+compressed with zstd, and floats are written with byte stream split encoding (which compresses much
+better than plain floats). RA and DEC stay float64, since 6 decimals of a degree need 9 significant
+digits. The geometry column (WKB points of RA/DEC) can be left out of either profile.
+"""
+
+COMPACT_TYPES = {
+    "magnitude": pa.float32(),
+    "bv": pa.float32(),
+    "constellation_id": pa.dictionary(pa.int8(), pa.string()),
+    "hip": pa.int32(),
+    "parallax_mas": pa.float32(),
+    "ra_mas_per_year": pa.float32(),
+    "dec_mas_per_year": pa.float32(),
+    "epoch_year": pa.int16(),
+}
+
+
+@dataclass(frozen=True)
+class Profile:
+    """How the catalog files are stored"""
+
+    compact: bool = False
+
+    compression_level: int = 9
+    """zstd compression level (compact profile only)"""
+
+    geometry: bool = True
+    """Include the geometry column"""
+
+    def schema(self, schema: pa.Schema = settings.SCHEMA) -> pa.Schema:
+        """Returns the stored schema of a (build) schema"""
+        fields = []
+        for field in schema:
+            if field.name == "geometry" and not self.geometry:
+                continue
+            if self.compact and field.name in COMPACT_TYPES:
+                field = field.with_type(COMPACT_TYPES[field.name])
+            fields.append(field)
+        return pa.schema(fields, metadata=schema.metadata)
+
+    def cast(self, table, schema: pa.Schema = None):
+        """Casts a table (or record batch) of a build schema to its stored schema"""
+        schema = self.schema(schema or table.schema)
+        return table.select(schema.names).cast(schema)
+
+    def writer_options(self, schema: pa.Schema) -> dict:
+        """Returns options for `pq.write_table` or `pq.ParquetWriter` of the stored schema"""
+        if not self.compact:
+            return dict(compression="snappy")
+
+        floats = [f.name for f in schema if pa.types.is_floating(f.type)]
+        return dict(
+            compression="zstd",
+            compression_level=self.compression_level,
+            # floats are byte stream split instead of dictionary-encoded (which is preferred when both are enabled)
+            use_dictionary=[f.name for f in schema if f.name not in floats],
+            use_byte_stream_split=floats,
+        )
+
+
+STANDARD = Profile()
+
+
+def click_options(command):
+    """Adds the options of `from_options` to a click command"""
+    command = click.option(
+        "--geometry/--no_geometry",
+        default=True,
+        help="Include the geometry column (WKB points of RA/DEC)",
+    )(command)
+    command = click.option(
+        "--compression_level",
+        default=9,
+        help="zstd compression level of the compact profile",
+    )(command)
+    command = click.option(
+        "--profile",
+        default="standard",
+        type=click.Choice(["standard", "compact"]),
+        help="Store catalog files as is (snappy), or with compact types and encodings (zstd), see profiles.py",
+    )(command)
+    return command
+
+
+def from_options(profile="standard", compression_level=9, geometry=True) -> Profile:
+    return Profile(
+        compact=profile == "compact",
+        compression_level=compression_level,
+        geometry=geometry,
+    )
@@ -1,5 +1,11 @@
 import pyarrow as pa
 
+SQUASHED_FILENAME = "stars.parquet"
+
+# order of the rows in each partition's squashed (or merged) file, and in the fragments and runs it's written from
+# (pk breaks ties, so the order is the same whichever writer, and however the source files were read)
+SORT_KEYS = [("magnitude", "ascending"), ("pk", "ascending")]
+
 SCHEMA = pa.schema(
     [
         pa.field("pk", pa.int64(), nullable=False),
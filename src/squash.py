@@ -1,56 +1,362 @@
 import multiprocessing
+import queue
+import tempfile
+import time
 from pathlib import Path
+from typing import Iterator
 
 import click
+import numpy as np
+import pyarrow as pa
 import pyarrow.parquet as pq
 
+import catalog_index
+import merge
+import profiles
 import settings
+import subindex
+import tiers
+from settings import SQUASHED_FILENAME
 
-"""Squashes parquet files in each healpix partition into a single file, to optimize queries."""
+"""
+Squashes parquet files in each healpix partition into a single file, to optimize queries.
 
-SQUASHED_FILENAME = "stars.parquet"
+Rows are sorted by magnitude, then pk (`settings.SORT_KEYS`), the same order as the merge writer
+(`merge.py`) writes them in, so a build comes out the same whichever writer it's built with.
 
+Partitions are read into memory and sorted, unless there's a memory limit: then each partition is
+read in batches and sorted in runs that fit within the limit, which are spilled to disk and merged
+into the squashed file (see `merge.merge_sorted`).
 
-def squash_partition(partition_name: str, source_path: Path):
+Partitions vary a lot in size (the galactic plane is far denser than the poles), so each one is sized
+from its fragments' parquet metadata, and they're squashed largest first, starting a partition only
+when its estimated memory fits within what's left of the memory budget.
+
+With a sub-index NSIDE, rows are also clustered spatially, by magnitude band and then by a finer HEALPix
+index (see `subindex.py`).
+"""
+
+BATCH_SIZE = 65_536
+
+# peak memory of squashing a partition in memory, relative to its uncompressed size (measured on a 1M row partition)
+MEMORY_FACTOR = 5
+
+
+def partition_size(partition_path) -> tuple[int, int]:
+    """Returns the number of rows and uncompressed bytes of a partition's files, from their parquet metadata"""
+    rows = 0
+    uncompressed_bytes = 0
+    for filename in Path(partition_path).glob("*.parquet"):
+        metadata = pq.read_metadata(filename)
+        rows += metadata.num_rows
+        uncompressed_bytes += sum(
+            metadata.row_group(i).total_byte_size
+            for i in range(metadata.num_row_groups)
+        )
+    return rows, uncompressed_bytes
+
+
+def estimate_memory(uncompressed_bytes, memory_limit=0) -> float:
+    """Returns estimated peak memory (in MB) of squashing a partition, which a memory limit caps"""
+    estimate = uncompressed_bytes * MEMORY_FACTOR / 1024**2
+    if memory_limit:
+        return min(memory_limit, estimate)
+    return estimate
+
+
+def read_partition_batches(
+    source_filenames, partition_name
+) -> Iterator[pa.RecordBatch]:
+    """Reads a partition's files in batches, in the same order as `pq.ParquetDataset`"""
+    healpix_index = int(Path(partition_name).name.split("=")[1])
+    columns = [c for c in settings.SCHEMA.names if c != "healpix_index"]
+    for filename in source_filenames:
+        for batch in pq.ParquetFile(filename).iter_batches(
+            batch_size=BATCH_SIZE, columns=columns
+        ):
+            yield batch.append_column(
+                "healpix_index",
+                pa.array(np.full(batch.num_rows, healpix_index, dtype=np.int64)),
+            ).cast(settings.SCHEMA)
+
+
+def sort_runs(
+    batches: Iterator[pa.RecordBatch],
+    memory_limit,
+    runs_path,
+    schema=settings.SCHEMA,
+    sort_keys=settings.SORT_KEYS,
+) -> list[Path]:
+    """Sorts batches in runs of up to `memory_limit` MB, and spills each run to an Arrow IPC file"""
+    runs = []
+    buffered = []
+    buffered_bytes = 0
+
+    def spill():
+        table = pa.Table.from_batches(buffered, schema=schema)
+        run_path = Path(runs_path) / f"run-{len(runs)}.arrow"
+        with pa.OSFile(str(run_path), "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(
+                    table.sort_by(sort_keys), max_chunksize=merge.RUN_BATCH_SIZE
+                )
+        runs.append(run_path)
+
+    for batch in batches:
+        buffered.append(batch)
+        buffered_bytes += batch.nbytes
+        # half of the limit, to leave room for the sorted copy of the run
+        if buffered_bytes >= memory_limit * 1024**2 / 2:
+            spill()
+            buffered = []
+            buffered_bytes = 0
+
+    if buffered or not runs:
+        spill()
+
+    return runs
+
+
+def read_run(run_path) -> Iterator[pa.RecordBatch]:
+    # read (instead of memory-mapped), so batches that have been merged don't stay resident
+    with pa.OSFile(str(run_path)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def squash_partition_external(
+    source_filenames,
+    partition_name,
+    outfile_path,
+    memory_limit,
+    subindex_nside=0,
+    magnitude_band=1.0,
+    profile=profiles.STANDARD,
+):
+    """Squashes a partition with an external merge sort, using at most about `memory_limit` MB"""
+    batches = read_partition_batches(source_filenames, partition_name)
+    schema, sort_keys = settings.SCHEMA, settings.SORT_KEYS
+    sorting_columns = [c for c, _ in settings.SORT_KEYS]
+    if subindex_nside:
+        schema = subindex.SUBINDEX_SCHEMA.append(
+            pa.field(subindex.BAND_COLUMN, pa.int64())
+        )
+        batches = (
+            subindex.add_subindex(b, subindex_nside, magnitude_band).cast(schema)
+            for b in batches
+        )
+        sort_keys, sorting_columns = subindex.SUBINDEX_SORT_KEYS, []
+
+    with tempfile.TemporaryDirectory(
+        dir=Path(outfile_path).parent, prefix="_squash-"
+    ) as runs_path:
+        runs = sort_runs(batches, memory_limit, runs_path, schema, sort_keys)
+        merged = merge.merge_sorted([read_run(r) for r in runs], sort_keys)
+        if subindex_nside:
+            merged = (table.drop_columns(subindex.BAND_COLUMN) for table in merged)
+        merge.write_sorted(
+            merged,
+            outfile_path,
+            subindex.SUBINDEX_SCHEMA if subindex_nside else settings.SCHEMA,
+            sorting_columns,
+            profile,
+        )
+
+
+def squash_partition(
+    partition_name: str,
+    source_path: Path,
+    memory_limit=0,
+    subindex_nside=0,
+    magnitude_band=1.0,
+    profile=profiles.STANDARD,
+):
     print(f"Squashing | {partition_name}")
     source_filenames = Path(source_path / partition_name).glob("*.parquet")
     source_filenames = sorted([str(f) for f in source_filenames])
+
+    outfile_path = source_path / partition_name / SQUASHED_FILENAME
+    if memory_limit:
+        squash_partition_external(
+            source_filenames,
+            partition_name,
+            outfile_path,
+            memory_limit,
+            subindex_nside,
+            magnitude_band,
+            profile,
+        )
+        return True
+
     dataset = pq.ParquetDataset(source_filenames, schema=settings.SCHEMA)
     table = dataset.read()
 
     if "__index_level_0__" in table.column_names:
         table = table.drop_columns("__index_level_0__")
 
-    sorting_columns = ["magnitude"]
-    table = table.sort_by([(c, "ascending") for c in sorting_columns])
-    sort_columns = [
-        pq.SortingColumn(table.column_names.index(c)) for c in sorting_columns
-    ]
+    if subindex_nside:
+        table = subindex.add_subindex(table, subindex_nside, magnitude_band)
+        table = (
+            table.sort_by(subindex.SUBINDEX_SORT_KEYS)
+            .drop_columns(subindex.BAND_COLUMN)
+            .cast(subindex.SUBINDEX_SCHEMA)
+        )
+        sort_columns = None
+    else:
+        table = table.sort_by(settings.SORT_KEYS)
+
+    table = profile.cast(table)
+    if not subindex_nside:
+        sort_columns = [
+            pq.SortingColumn(table.column_names.index(c)) for c, _ in settings.SORT_KEYS
+        ]
 
-    outfile_path = source_path / partition_name / SQUASHED_FILENAME
     pq.write_table(
         table,
         outfile_path,
-        compression="snappy",
         row_group_size=100_000,
         sorting_columns=sort_columns,
+        **profile.writer_options(table.schema),
     )
     return True
 
 
+def squash_partition_worker(
+    partition_name, source_path, memory_limit, subindex_nside, magnitude_band, profile
+) -> dict:
+    time_start = time.time()
+    try:
+        squash_partition(
+            partition_name,
+            source_path,
+            memory_limit,
+            subindex_nside,
+            magnitude_band,
+            profile,
+        )
+    except Exception as e:
+        print(f"Error squashing {partition_name}: {e}")
+        return dict(partition=partition_name, ok=False)
+
+    return dict(
+        partition=partition_name,
+        ok=True,
+        bytes_written=(source_path / partition_name / SQUASHED_FILENAME).stat().st_size,
+        duration=time.time() - time_start,
+    )
+
+
 @click.command()
 @click.option("--source", help="Source path of catalog data")
 @click.option("--num_workers", default=10, help="Number of workers to run")
-def main(source, num_workers):
+@click.option(
+    "--memory_limit",
+    default=0.0,
+    help="Memory (in MB) each worker can use to sort a partition, spilling to disk beyond it (0 sorts partitions in memory)",
+)
+@click.option(
+    "--memory_budget",
+    default=0.0,
+    help="Memory (in MB) all workers can use together (0 is unlimited)",
+)
+@click.option(
+    "--subindex_nside",
+    default=0,
+    help="HEALPix NSIDE of the sub-index to cluster rows by within each magnitude band (0 sorts by magnitude only)",
+)
+@click.option(
+    "--magnitude_band",
+    default=1.0,
+    help="Width of the magnitude bands rows are clustered in, when there's a sub-index",
+)
+@profiles.click_options
+def main(
+    source,
+    num_workers,
+    memory_limit,
+    memory_budget,
+    subindex_nside,
+    magnitude_band,
+    profile,
+    compression_level,
+    geometry,
+):
+    storage_profile = profiles.from_options(profile, compression_level, geometry)
+    time_start = time.time()
     source_path = Path(source)
-    partition_names = sorted(
-        [item.name for item in source_path.iterdir() if item.is_dir()]
-    )
+    partition_names = tiers.partition_names(source_path)
+
+    sizes = {name: partition_size(source_path / name) for name in partition_names}
+    memory = {
+        name: estimate_memory(uncompressed_bytes, memory_limit)
+        for name, (_, uncompressed_bytes) in sizes.items()
+    }
+    # largest partitions first, so stragglers don't hold up the end
+    pending = sorted(partition_names, key=lambda name: -sizes[name][1])
 
-    process_args = [(partition_name, source_path) for partition_name in partition_names]
+    # a partition that can't fit in the budget on its own is sorted externally within it
+    limits = {name: memory_limit for name in partition_names}
+    if memory_budget:
+        for name in pending:
+            if memory[name] > memory_budget:
+                limits[name] = memory[name] = memory_budget
+
+    results = []
+    finished = queue.Queue()
+    running = {}
+    rows = 0
+    bytes_written = 0
 
     with multiprocessing.Pool(processes=num_workers) as pool:
-        results = pool.starmap(squash_partition, process_args)
+        while pending or running:
+            # start the largest partitions that fit in what's left of the budget (or the largest one, if nothing's running)
+            available = memory_budget - sum(running.values())
+            for name in list(pending):
+                if len(running) >= num_workers:
+                    break
+                if memory_budget and running and memory[name] > available:
+                    continue
+                pending.remove(name)
+                running[name] = memory[name]
+                available -= memory[name]
+                pool.apply_async(
+                    squash_partition_worker,
+                    (
+                        name,
+                        source_path,
+                        limits[name],
+                        subindex_nside,
+                        magnitude_band,
+                        storage_profile,
+                    ),
+                    callback=finished.put,
+                    error_callback=lambda e, name=name: finished.put(
+                        dict(partition=name, ok=False)
+                    ),
+                )
+
+            result = finished.get()
+            running.pop(result["partition"])
+            results.append(result["ok"])
+            if not result["ok"]:
+                continue
+
+            partition_rows = sizes[result["partition"]][0]
+            rows += partition_rows
+            bytes_written += result["bytes_written"]
+            print(
+                f"Squashed | {result['partition']} | {partition_rows:,} rows "
+                f"| {result['bytes_written'] / 1024**2:,.1f} MB written "
+                f"| {partition_rows / max(result['duration'], 1e-9):,.0f} rows/sec "
+                f"| {len(results)}/{len(partition_names)}"
+            )
+
+    duration = time.time() - time_start
+    print(
+        f"Done: {rows:,} rows | {bytes_written / 1024**2:,.1f} MB written | {duration:.2f}s "
+        f"| {rows / max(duration, 1e-9):,.0f} rows/sec"
+    )
 
     if all(results):
         for partition_name in partition_names:
@@ -59,6 +365,10 @@ def main(source, num_workers):
                 if source_file.name != SQUASHED_FILENAME:
                     source_file.unlink()
 
+        if tiers.is_tiered(source_path):
+            tiers.update_index(source_path)
+        catalog_index.write(source_path)
+
 
 if __name__ == "__main__":
     main()
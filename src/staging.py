@@ -0,0 +1,101 @@
+import multiprocessing
+import time
+from pathlib import Path
+
+import click
+import pyarrow.parquet as pq
+
+import build
+
+"""
+Stages Gaia source files as Parquet, so builds don't have to decompress and parse the CSVs every time.
+
+Each gaia_source CSV is converted (once) into a Parquet file of the same name, with only the columns
+the build uses. Rows are sorted by G magnitude, so each row group's min/max statistics on
+`phot_g_mean_mag` cover a narrow magnitude range, and builds skip row groups that can't have stars
+within their magnitude range (see `build.source_row_groups`). Pass the staging path to `build.py --staging` to
+read the staged files instead of the CSVs (any source file that isn't staged, or has changed since
+it was staged, is still read from its CSV).
+"""
+
+ROW_GROUP_SIZE = 100_000
+
+
+def stage(gaia_source_filename, staging_path) -> dict:
+    """Converts a single source file to Parquet, and returns its name and number of rows"""
+    time_start = time.time()
+    staged = build.staged_filename(staging_path, gaia_source_filename)
+
+    df = build.read_source(gaia_source_filename).sort(
+        "phot_g_mean_mag", nulls_last=True
+    )
+
+    # written to a temporary file first, so an interrupted staging never leaves a partial file behind
+    partial = staged.with_suffix(".parquet.partial")
+    pq.write_table(
+        df.to_arrow(),
+        partial,
+        compression="snappy",
+        row_group_size=ROW_GROUP_SIZE,
+        write_statistics=True,
+        sorting_columns=[pq.SortingColumn(df.columns.index("phot_g_mean_mag"))],
+    )
+    partial.rename(staged)
+
+    return dict(
+        filename=staged.name,
+        rows=df.height,
+        duration=time.time() - time_start,
+    )
+
+
+def stage_worker(args) -> dict:
+    return stage(*args)
+
+
+@click.command()
+@click.option("--source", help="Source path of Gaia DR3 data")
+@click.option("--destination", help="Destination path of the staged source files")
+@click.option("--start", default=0, help="What file to start at (when sorted)")
+@click.option(
+    "--stop", default=3389, help="What file to stop at (when sorted), inclusive"
+)
+@click.option("--num_workers", default=10, help="Number of workers to run")
+def main(source, destination, start, stop, num_workers):
+    """Stages Gaia source files as Parquet (skipping files that are already staged)"""
+    time_start = time.time()
+    staging_path = Path(destination)
+    staging_path.mkdir(parents=True, exist_ok=True)
+
+    source_filenames = sorted((Path(source) / "gaia_source").glob("*.csv.gz"))
+    source_filenames = source_filenames[start : stop + 1]
+    items = [
+        (f, staging_path)
+        for f in source_filenames
+        if not build.is_staged(staging_path, f)
+    ]
+    print(
+        f"Staging {len(items):,} files ({len(source_filenames) - len(items):,} already staged)"
+    )
+
+    # largest files first, so stragglers don't hold up the end
+    items.sort(key=lambda item: item[0].stat().st_size, reverse=True)
+
+    rows = 0
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=num_workers) as pool:
+        for result in pool.imap_unordered(stage_worker, items):
+            rows += result["rows"]
+            print(
+                f"{result['filename']} | {result['rows']:,} rows | {result['duration']:.2f}s"
+            )
+
+    duration = time.time() - time_start
+    print(
+        f"Done: {len(items):,} files | {rows:,} rows | {duration:.2f}s "
+        f"| {rows / max(duration, 1e-9):,.0f} rows/sec"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,164 @@
+import json
 import multiprocessing
-
+import time
 from pathlib import Path
 
-from starplot import Star
-from starplot.data import Catalog
-
-COMBINED_PATH = Path("/Volumes/Blue2TB/build/gdr3/")
-
-
-mag_min = 6
-mag_max = 18
-
-
-def calc(partition_name):
-    # for partition_name in partition_path_names:
-    print(partition_name)
-
-    total_stars = 0
-    total_stars_mag_under_threshold = 0
-    total_stars_mag_over_threshold = 0
-
-    pq_path = COMBINED_PATH / partition_name / "stars.parquet"
-    partition_catalog = Catalog(path=pq_path)
-
-    all_stars = Star.all(catalog=partition_catalog)
-
-    for star in all_stars:
-        total_stars += 1
-
-        if star.magnitude < mag_min:
-            total_stars_mag_under_threshold += 1
-
-        if star.magnitude > mag_max:
-            total_stars_mag_over_threshold += 1
-
-    print(f"total_stars = {total_stars:,}")
-    print(f"total_stars_mag_under_threshold = {total_stars_mag_under_threshold:,}")
-    print(f"total_stars_mag_over_threshold = {total_stars_mag_over_threshold:,}")
-
-    return total_stars, total_stars_mag_under_threshold, total_stars_mag_over_threshold
+import click
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import tiers
+
+"""
+Statistics of a catalog build, computed per partition straight from the parquet files.
+
+Row counts and null counts (which give crossmatch coverage and null rates) come from the files' footer
+statistics, and only the `magnitude` and `constellation_id` columns are read, for the magnitude histogram
+and the number of stars in each constellation. Partitions are read in parallel, and the report is
+written to `_stats.json` in the root of the catalog.
+"""
+
+STATS_FILENAME = "_stats.json"
+
+
+def null_counts(parquet_file: pq.ParquetFile) -> dict[str, int]:
+    """Returns the number of nulls in each column, from the footer statistics (or the column, if it has none)"""
+    metadata = parquet_file.metadata
+    counts = {}
+    for c, name in enumerate(metadata.schema.names):
+        statistics = [
+            metadata.row_group(i).column(c).statistics
+            for i in range(metadata.num_row_groups)
+        ]
+        if all(s is not None and s.has_null_count for s in statistics):
+            counts[name] = sum(s.null_count for s in statistics)
+        else:
+            counts[name] = parquet_file.read(columns=[name])[name].null_count
+    return counts
+
+
+def partition_stats(source_path, partition_name, mag_min, mag_max) -> dict:
+    rows = 0
+    nulls = {}
+    magnitudes = []
+    constellations = {}
+
+    for filename in sorted((Path(source_path) / partition_name).glob("*.parquet")):
+        parquet_file = pq.ParquetFile(filename)
+        rows += parquet_file.metadata.num_rows
+        for name, count in null_counts(parquet_file).items():
+            nulls[name] = nulls.get(name, 0) + count
+
+        table = parquet_file.read(columns=["magnitude", "constellation_id"])
+        magnitudes.append(table["magnitude"].to_numpy())
+        for item in pc.value_counts(table["constellation_id"]).to_pylist():
+            constellation = str(item["values"])
+            constellations[constellation] = (
+                constellations.get(constellation, 0) + item["counts"]
+            )
+
+    magnitude = np.concatenate(magnitudes) if magnitudes else np.array([])
+    bins, counts = np.unique(np.floor(magnitude).astype(int), return_counts=True)
+
+    return dict(
+        partition=partition_name,
+        rows=rows,
+        mag_under_threshold=int(np.sum(magnitude < mag_min)),
+        mag_over_threshold=int(np.sum(magnitude > mag_max)),
+        magnitude_min=float(magnitude.min()) if rows else None,
+        magnitude_max=float(magnitude.max()) if rows else None,
+        magnitude_histogram={str(b): int(n) for b, n in zip(bins, counts)},
+        constellations=constellations,
+        crossmatch_hip=rows - nulls.get("hip", rows),
+        crossmatch_tyc=rows - nulls.get("tyc", rows),
+        nulls=nulls,
+    )
 
 
-if __name__ == "__main__":
-    partition_path_names = sorted(
-        [item.name for item in COMBINED_PATH.iterdir() if item.is_dir()]
+def partition_stats_worker(args) -> dict:
+    return partition_stats(*args)
+
+
+def add_counts(total: dict, counts: dict):
+    for key, count in counts.items():
+        total[key] = total.get(key, 0) + count
+
+
+def summarize(partitions: list[dict]) -> dict:
+    """Returns the totals of the stats of each partition"""
+    rows = sum(p["rows"] for p in partitions)
+    histogram = {}
+    constellations = {}
+    nulls = {}
+    for p in partitions:
+        add_counts(histogram, p["magnitude_histogram"])
+        add_counts(constellations, p["constellations"])
+        add_counts(nulls, p["nulls"])
+
+    magnitude_mins = [p["magnitude_min"] for p in partitions if p["rows"]]
+    magnitude_maxs = [p["magnitude_max"] for p in partitions if p["rows"]]
+    crossmatch_hip = sum(p["crossmatch_hip"] for p in partitions)
+    crossmatch_tyc = sum(p["crossmatch_tyc"] for p in partitions)
+
+    return dict(
+        partitions=len(partitions),
+        rows=rows,
+        mag_under_threshold=sum(p["mag_under_threshold"] for p in partitions),
+        mag_over_threshold=sum(p["mag_over_threshold"] for p in partitions),
+        magnitude_min=min(magnitude_mins, default=None),
+        magnitude_max=max(magnitude_maxs, default=None),
+        magnitude_histogram=dict(sorted(histogram.items(), key=lambda i: int(i[0]))),
+        constellations=dict(sorted(constellations.items())),
+        crossmatch_hip=crossmatch_hip,
+        crossmatch_tyc=crossmatch_tyc,
+        crossmatch_hip_rate=crossmatch_hip / rows if rows else 0,
+        crossmatch_tyc_rate=crossmatch_tyc / rows if rows else 0,
+        null_rates={name: n / rows if rows else 0 for name, n in nulls.items()},
     )
 
-    with multiprocessing.Pool(processes=12) as pool:
-        results = pool.map(calc, partition_path_names)
 
-    total_stars = 0
-    total_stars_mag_under_threshold = 0
-    total_stars_mag_over_threshold = 0
+@click.command()
+@click.option("--source", help="Source path of catalog data")
+@click.option("--num_workers", default=10, help="Number of workers to run")
+@click.option(
+    "--mag_min", default=6.0, help="Count stars under this magnitude (e.g. the build's)"
+)
+@click.option(
+    "--mag_max", default=18.0, help="Count stars over this magnitude (e.g. the build's)"
+)
+def main(source, num_workers, mag_min, mag_max):
+    """Computes statistics of a catalog, and writes them to _stats.json in its root"""
+    time_start = time.time()
+    source_path = Path(source)
+    items = [
+        (source_path, partition_name, mag_min, mag_max)
+        for partition_name in tiers.partition_names(source_path)
+    ]
+
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        partitions = sorted(
+            pool.imap_unordered(partition_stats_worker, items),
+            key=lambda p: p["partition"],
+        )
+
+    total = summarize(partitions)
+    with open(source_path / STATS_FILENAME, "w") as f:
+        json.dump(dict(total=total, partitions=partitions), f, indent=1)
+
+    duration = time.time() - time_start
+    print(f"total_stars = {total['rows']:,}")
+    print(f"total_stars_mag_under_threshold = {total['mag_under_threshold']:,}")
+    print(f"total_stars_mag_over_threshold = {total['mag_over_threshold']:,}")
+    print(
+        f"crossmatch_hip = {total['crossmatch_hip']:,} ({total['crossmatch_hip_rate']:.2%}) "
+        f"| crossmatch_tyc = {total['crossmatch_tyc']:,} ({total['crossmatch_tyc_rate']:.2%})"
+    )
+    print(
+        f"Done: {len(partitions):,} partitions | {duration:.2f}s "
+        f"| {total['rows'] / max(duration, 1e-9):,.0f} rows/sec"
+    )
 
-    for total, total_under, total_over in results:
-        total_stars += total
-        total_stars_mag_under_threshold += total_under
-        total_stars_mag_over_threshold += total_over
 
-    print(f"total_stars = {total_stars:,}")
-    print(f"total_stars_mag_under_threshold = {total_stars_mag_under_threshold:,}")
-    print(f"total_stars_mag_over_threshold = {total_stars_mag_over_threshold:,}")
+if __name__ == "__main__":
+    main()
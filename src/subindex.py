@@ -0,0 +1,53 @@
+import numpy as np
+import pyarrow as pa
+from astropy import units as u
+from astropy_healpix import HEALPix
+
+import settings
+
+"""
+HEALPix sub-index of a partition, for clustering its rows spatially (when it's squashed or merged).
+
+Rows are sorted by magnitude band, then by a finer (nested) HEALPix index written as a `healpix_subindex`
+column, then by magnitude and pk. Each row group then covers a small area of the partition, so queries of
+a small field of view can skip row groups using the min/max statistics of `healpix_subindex` (as well as
+`magnitude`).
+"""
+
+SUBINDEX_COLUMN = "healpix_subindex"
+
+# only used for sorting, not written to the squashed file
+BAND_COLUMN = "_magnitude_band"
+
+SUBINDEX_SORT_KEYS = [
+    (BAND_COLUMN, "ascending"),
+    (SUBINDEX_COLUMN, "ascending"),
+    *settings.SORT_KEYS,
+]
+
+SUBINDEX_SCHEMA = settings.SCHEMA.append(
+    pa.field(SUBINDEX_COLUMN, pa.int64(), nullable=False)
+)
+
+
+def add_subindex(table, subindex_nside, magnitude_band):
+    """Appends the HEALPix sub-index and magnitude band columns to a table (or record batch)"""
+    healpix = HEALPix(nside=subindex_nside, order="nested")
+    subindex = healpix.lonlat_to_healpix(
+        table["ra"].to_numpy() * u.deg, table["dec"].to_numpy() * u.deg
+    )
+    band = np.floor(table["magnitude"].to_numpy() / magnitude_band)
+    table = table.append_column(SUBINDEX_COLUMN, pa.array(subindex.astype(np.int64)))
+    return table.append_column(BAND_COLUMN, pa.array(band.astype(np.int64)))
+
+
+def subindex_ranges(ra, dec, radius, subindex_nside) -> list[tuple[int, int]]:
+    """Returns ranges (inclusive) of the sub-index that cover a cone, for filtering on its row group statistics"""
+    healpix = HEALPix(nside=subindex_nside, order="nested")
+    subindex = np.sort(
+        healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg)
+    )
+    breaks = np.flatnonzero(np.diff(subindex) > 1)
+    starts = np.append(subindex[0], subindex[breaks + 1])
+    ends = np.append(subindex[breaks], subindex[-1])
+    return list(zip(starts.tolist(), ends.tolist()))
@@ -0,0 +1,348 @@
+import gzip
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy_healpix import HEALPix
+
+import crossmatch
+
+"""
+Writes synthetic Gaia DR3 source files, for benchmarking the build locally.
+
+Stars are either uniformly distributed over the sky, or (by default, for `main`) distributed like Gaia's:
+- Sky density follows a simple model of the galaxy (a disk concentrated towards the galactic center, a
+  bulge, a faint halo and the Magellanic clouds), so fields in the galactic plane are hundreds of times
+  denser than the galactic poles.
+- Like the real dump, each source file covers a contiguous range of HEALPix pixels (and source ids, which
+  encode the HEALPix level 12 index of each star), so files vary in size with the density of their sky.
+- G magnitudes follow Gaia's number counts (rising about 0.35 dex per magnitude, turning over at the survey
+  limit near G=20.7), and parallaxes, proper motions and `bp_rp` are null mostly for faint stars, at about
+  Gaia's rates (~19% and ~15%).
+
+Hipparcos and Tycho crossmatch CSVs are written for the bright stars, in the layout of Gaia's cross_match
+tables, so the synthetic data can be built like the real data.
+"""
+
+COLUMNS = [
+    "source_id",
+    "ra",
+    "dec",
+    "ref_epoch",
+    "parallax",
+    "pmra",
+    "pmdec",
+    "phot_g_mean_mag",
+    "bp_rp",
+]
+
+# HEALPix NSIDE of the sky density model, and of the pixel ranges of each source file
+DENSITY_NSIDE = 64
+
+# Gaia source ids are the HEALPix level 12 index of the star * 2^35, plus a running number
+SOURCE_ID_NSIDE = 4096
+
+# brightest stars are crossmatched to Hipparcos (all up to HIP_MAG_MAX, some up to HIP_MAG_PARTIAL)
+HIP_MAG_MAX = 8.5
+HIP_MAG_PARTIAL = 10.0
+TYC_MAG_MAX = 12.0
+
+
+def format_column(values: np.ndarray, fmt: str) -> np.ndarray:
+    """Formats a float column as strings, writing nulls the same way Gaia does"""
+    formatted = np.char.mod(fmt, values)
+    formatted[np.isnan(values)] = "null"
+    return formatted
+
+
+def write_rows(
+    filename: Path,
+    source_id,
+    ra,
+    dec,
+    parallax,
+    pmra,
+    pmdec,
+    phot_g_mean_mag,
+    bp_rp,
+):
+    num_rows = len(source_id)
+    columns = [
+        source_id.astype(str),
+        format_column(ra, "%.12f"),
+        format_column(dec, "%.12f"),
+        np.full(num_rows, "2016.0"),
+        format_column(parallax, "%.6f"),
+        format_column(pmra, "%.6f"),
+        format_column(pmdec, "%.6f"),
+        format_column(phot_g_mean_mag, "%.6f"),
+        format_column(bp_rp, "%.6f"),
+    ]
+
+    with gzip.open(filename, "wt") as f:
+        f.write("# Synthetic Gaia DR3 gaia_source\n")
+        f.write(",".join(COLUMNS) + "\n")
+        for row in zip(*columns):
+            f.write(",".join(row) + "\n")
+
+
+def write_source_file(
+    filename: Path,
+    num_rows: int,
+    seed: int = 0,
+    ra_range=(0, 360),
+    dec_range=(-90, 90),
+) -> pl.DataFrame:
+    """
+    Writes a single gaia_source file with stars uniformly distributed over the sky (or part of it),
+    and returns the position and magnitude of each star (by source_id)
+    """
+    rng = np.random.default_rng(seed)
+
+    source_id = np.sort(rng.choice(2**59, size=num_rows, replace=False))
+    ra = rng.uniform(*ra_range, num_rows)
+    sin_dec = np.sin(np.radians(dec_range))
+    dec = np.degrees(np.arcsin(rng.uniform(*sin_dec, num_rows)))
+    parallax = rng.normal(0.5, 1.0, num_rows)
+    pmra = rng.normal(0, 5, num_rows)
+    pmdec = rng.normal(0, 5, num_rows)
+    phot_g_mean_mag = rng.uniform(3, 21, num_rows)
+    bp_rp = rng.normal(1.0, 0.5, num_rows)
+
+    phot_g_mean_mag[rng.random(num_rows) < 0.01] = np.nan
+    bp_rp[rng.random(num_rows) < 0.1] = np.nan
+    for values in (parallax, pmra, pmdec):
+        values[rng.random(num_rows) < 0.2] = np.nan
+
+    write_rows(
+        filename, source_id, ra, dec, parallax, pmra, pmdec, phot_g_mean_mag, bp_rp
+    )
+    return pl.DataFrame(
+        {"source_id": source_id, "ra": ra, "dec": dec, "magnitude": phot_g_mean_mag}
+    )
+
+
+def sky_density(nside=DENSITY_NSIDE) -> np.ndarray:
+    """Returns the relative density of stars in each (nested) HEALPix pixel"""
+    healpix = HEALPix(nside=nside, order="nested")
+    ra, dec = healpix.healpix_to_lonlat(np.arange(healpix.npix))
+    coordinates = SkyCoord(ra=ra, dec=dec, frame="icrs")
+    galactic = coordinates.galactic
+    longitude = (galactic.l.to_value(u.deg) + 180) % 360 - 180
+    latitude = galactic.b.to_value(u.deg)
+
+    disk = np.exp(-np.abs(latitude) / 6) * (1 + 4 * np.exp(-((longitude / 60) ** 2)))
+    bulge = 6 * np.exp(-(longitude**2 + latitude**2) / (2 * 10**2))
+    halo = 0.05
+    density = disk + bulge + halo
+
+    for ra_center, dec_center, sigma, amplitude in [
+        (80.894, -69.756, 3.0, 2.0),  # Large Magellanic Cloud
+        (13.187, -72.829, 1.5, 1.0),  # Small Magellanic Cloud
+    ]:
+        center = SkyCoord(ra=ra_center * u.deg, dec=dec_center * u.deg)
+        separation = coordinates.separation(center).to_value(u.deg)
+        density += amplitude * np.exp(-(separation**2) / (2 * sigma**2))
+
+    return density
+
+
+def sample_magnitudes(rng, num_rows) -> np.ndarray:
+    """Samples G magnitudes from Gaia's number counts (inverse CDF on a fine grid)"""
+    grid = np.linspace(3, 21.5, 4096)
+    counts = 10 ** (0.35 * grid) / (1 + np.exp((grid - 20.7) / 0.25))
+    cdf = np.cumsum(counts)
+    cdf /= cdf[-1]
+    return np.interp(rng.random(num_rows), cdf, grid)
+
+
+def realistic_rows(rng, healpix_indices, counts) -> dict[str, np.ndarray]:
+    """Returns columns of stars in HEALPix pixels (of DENSITY_NSIDE), with `counts` stars in each"""
+    healpix = HEALPix(nside=DENSITY_NSIDE, order="nested")
+    pixels = np.repeat(healpix_indices, counts)
+    num_rows = len(pixels)
+
+    lon, lat = healpix.healpix_to_lonlat(
+        pixels, dx=rng.random(num_rows), dy=rng.random(num_rows)
+    )
+    ra, dec = lon.to_value(u.deg), lat.to_value(u.deg)
+    latitude = SkyCoord(ra=lon, dec=lat, frame="icrs").galactic.b.to_value(u.deg)
+
+    level12 = HEALPix(nside=SOURCE_ID_NSIDE, order="nested").lonlat_to_healpix(lon, lat)
+    source_id = level12.astype(np.int64) * 2**35 + rng.integers(0, 2**35, num_rows)
+    order = np.argsort(source_id)
+
+    magnitude = sample_magnitudes(rng, num_rows)
+
+    # 2-parameter solutions (no parallax or proper motion) and missing BP/RP are mostly faint stars
+    no_astrometry = rng.random(num_rows) < 1 / (1 + np.exp(-(magnitude - 20.7) / 0.3))
+    no_color = rng.random(num_rows) < 1 / (1 + np.exp(-(magnitude - 20.85) / 0.3))
+
+    true_parallax = 10 ** (-0.2 * (magnitude - 10)) * rng.lognormal(0, 0.6, num_rows)
+    error = np.maximum(0.01, 0.02 * 10 ** (0.2 * (magnitude - 15)))
+    parallax = true_parallax + rng.normal(0, 1, num_rows) * error
+    pm_scale = 3 + 5 * true_parallax
+    pmra = rng.normal(0, 1, num_rows) * pm_scale
+    pmdec = rng.normal(0, 1, num_rows) * pm_scale
+    for values in (parallax, pmra, pmdec):
+        values[no_astrometry] = np.nan
+
+    # redder in the galactic plane (extinction)
+    bp_rp = rng.normal(0.9, 0.35, num_rows) + 0.6 * np.exp(-np.abs(latitude) / 4)
+    bp_rp[no_color] = np.nan
+
+    phot_g_mean_mag = magnitude.copy()
+    phot_g_mean_mag[rng.random(num_rows) < 0.003] = np.nan
+
+    columns = dict(
+        source_id=source_id,
+        ra=ra,
+        dec=dec,
+        parallax=parallax,
+        pmra=pmra,
+        pmdec=pmdec,
+        phot_g_mean_mag=phot_g_mean_mag,
+        bp_rp=bp_rp,
+    )
+    return {name: values[order] for name, values in columns.items()}
+
+
+def write_realistic_source_file(
+    filename: Path, healpix_indices, counts, seed: int = 0
+) -> pl.DataFrame:
+    """
+    Writes a single gaia_source file with `counts` stars in each of its HEALPix pixels, and returns the
+    position and magnitude of each star (by source_id)
+    """
+    rows = realistic_rows(np.random.default_rng(seed), healpix_indices, counts)
+    write_rows(filename, **rows)
+    return pl.DataFrame(
+        {
+            "source_id": rows["source_id"],
+            "ra": rows["ra"],
+            "dec": rows["dec"],
+            "magnitude": rows["phot_g_mean_mag"],
+        }
+    )
+
+
+def write_crossmatch_file(filename: Path, source_ids, external_ids):
+    """Writes a crossmatch CSV, in the same layout as Gaia's cross_match tables"""
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    pl.DataFrame(
+        {
+            "source_id": source_ids,
+            "original_ext_source_id": external_ids,
+            "angular_distance": np.zeros(len(source_ids)),
+        }
+    ).write_csv(filename)
+
+
+def write_crossmatches(gaia_path: Path, stars: pl.DataFrame, seed: int = 0):
+    """
+    Writes Hipparcos and Tycho crossmatch CSVs for the bright stars (with source_id, ra, dec and
+    magnitude). Hipparcos ids are numbered by RA, like the real ones, and Tycho ids are numbered within
+    regions of the sky.
+    """
+    rng = np.random.default_rng(seed)
+    magnitude = stars["magnitude"].fill_nan(None).fill_null(99).to_numpy()
+
+    hip = stars.filter(
+        pl.Series(
+            (magnitude < HIP_MAG_MAX)
+            | ((magnitude < HIP_MAG_PARTIAL) & (rng.random(stars.height) < 0.1))
+        )
+    ).sort("ra")
+    write_crossmatch_file(
+        gaia_path / "cross_match" / crossmatch.HIP_CSV,
+        hip["source_id"],
+        np.arange(1, hip.height + 1),
+    )
+
+    tyc = stars.filter(pl.Series(magnitude < TYC_MAG_MAX)).sort("source_id")
+    region = (
+        HEALPix(nside=32, order="nested").lonlat_to_healpix(
+            tyc["ra"].to_numpy() * u.deg, tyc["dec"].to_numpy() * u.deg
+        )
+        + 1
+    )
+    # running number of each star within its region
+    order = np.argsort(region, kind="stable")
+    number = np.empty(len(region), dtype=np.int64)
+    number[order] = (
+        np.arange(len(region)) - np.searchsorted(region[order], region[order]) + 1
+    )
+    write_crossmatch_file(
+        gaia_path / "cross_match" / crossmatch.TYC_CSV,
+        tyc["source_id"],
+        [f"{r}-{n}-1" for r, n in zip(region, number)],
+    )
+    return hip.height, tyc.height
+
+
+def write_catalog(
+    gaia_path, num_files, rows_per_file, seed: int = 2016, realistic=True
+) -> list[Path]:
+    """
+    Writes gaia_source files (with about `rows_per_file` stars each, on average) and their crossmatches,
+    and returns the paths of the source files
+    """
+    source_path = Path(gaia_path) / "gaia_source"
+    source_path.mkdir(parents=True, exist_ok=True)
+
+    if realistic:
+        rng = np.random.default_rng(seed)
+        density = sky_density()
+        counts = rng.multinomial(num_files * rows_per_file, density / density.sum())
+        pixel_ranges = np.array_split(np.arange(len(density)), num_files)
+
+    filenames = []
+    bright = []
+    for n in range(num_files):
+        filename = source_path / f"GaiaSource_{n:06}.csv.gz"
+        print(f"Writing {filename}")
+        if realistic:
+            pixels = pixel_ranges[n]
+            stars = write_realistic_source_file(
+                filename, pixels, counts[pixels], seed=seed + n
+            )
+        else:
+            stars = write_source_file(filename, rows_per_file, seed=seed + n)
+        bright.append(stars.filter(pl.col("magnitude") < TYC_MAG_MAX))
+        filenames.append(filename)
+
+    hip, tyc = write_crossmatches(Path(gaia_path), pl.concat(bright), seed)
+    print(f"Crossmatches | {hip:,} Hipparcos | {tyc:,} Tycho")
+    return filenames
+
+
+@click.command()
+@click.option("--destination", help="Destination path of the synthetic Gaia data")
+@click.option("--num_files", default=4, help="Number of gaia_source files to write")
+@click.option(
+    "--rows_per_file",
+    default=100_000,
+    help="Number of stars per file (on average, for realistic files)",
+)
+@click.option(
+    "--distribution",
+    default="realistic",
+    type=click.Choice(["realistic", "uniform"]),
+    help="Distribute stars like Gaia's, or uniformly (over the sky, and in magnitude)",
+)
+@click.option("--seed", default=2016, help="Random seed")
+def main(destination, num_files, rows_per_file, distribution, seed):
+    write_catalog(
+        destination,
+        num_files,
+        rows_per_file,
+        seed=seed,
+        realistic=distribution == "realistic",
+    )
+
+
+if __name__ == "__main__":
+    main()
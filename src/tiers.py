@@ -0,0 +1,135 @@
+import json
+from pathlib import Path
+
+import click
+import pyarrow.parquet as pq
+
+"""
+Magnitude-tiered (level of detail) catalog layout.
+
+A tiered build splits the catalog by magnitude into tiers, each with its own HEALPix NSIDE: bright stars
+in a few coarse partitions, fainter stars in more, finer partitions. Each tier is a subdirectory
+(`tier=0`, `tier=1`, ...) laid out like a regular build, and the tiers are listed in a small index in
+the root of the build (prefixed with an underscore, so Parquet readers ignore it), recording each
+tier's NSIDE, magnitude range, number of rows and size.
+
+A wide field of view of bright stars then only reads the first tier, and a deep, narrow field of view
+only reads the partitions it covers in each tier it needs (see `select`).
+"""
+
+INDEX_FILENAME = "_tiers.json"
+
+
+def tier_path(destination, tier: int) -> Path:
+    return Path(destination) / f"tier={tier}"
+
+
+def is_tiered(destination) -> bool:
+    return (Path(destination) / INDEX_FILENAME).exists()
+
+
+def read_index(destination) -> list[dict]:
+    with open(Path(destination) / INDEX_FILENAME) as f:
+        return json.load(f)["tiers"]
+
+
+def summarize(path: Path) -> dict:
+    """Returns number of partitions, rows, bytes and magnitude range of the parquet files in a tier"""
+    summary = dict(partitions=0, rows=0, bytes=0, magnitude=None)
+    for partition_path in path.glob("healpix_index=*"):
+        summary["partitions"] += 1
+        for filename in partition_path.glob("*.parquet"):
+            metadata = pq.read_metadata(filename)
+            summary["rows"] += metadata.num_rows
+            summary["bytes"] += filename.stat().st_size
+
+            column = metadata.schema.names.index("magnitude")
+            for i in range(metadata.num_row_groups):
+                statistics = metadata.row_group(i).column(column).statistics
+                if statistics is None or not statistics.has_min_max:
+                    continue
+                low, high = summary["magnitude"] or (statistics.min, statistics.max)
+                summary["magnitude"] = [
+                    min(low, statistics.min),
+                    max(high, statistics.max),
+                ]
+    return summary
+
+
+def write_index(destination, tiers: list[dict]):
+    """
+    Writes the index of a tiered build, from each tier's `nside`, `mag_min` and `mag_max`
+    (the range of magnitudes built into the tier), adding a summary of what's in the tier.
+    """
+    index = []
+    for n, tier in enumerate(tiers):
+        tier = dict(
+            tier=n,
+            path=tier_path(destination, n).name,
+            nside=tier["nside"],
+            mag_min=tier["mag_min"],
+            mag_max=tier["mag_max"],
+        )
+        tier.update(summarize(tier_path(destination, n)))
+        index.append(tier)
+
+    Path(destination).mkdir(parents=True, exist_ok=True)
+    with open(Path(destination) / INDEX_FILENAME, "w") as f:
+        json.dump(dict(tiers=index), f, indent=2)
+
+
+def update_index(destination):
+    """Rewrites the summary of each tier in the index (e.g. after squashing)"""
+    write_index(destination, read_index(destination))
+
+
+def select(tiers: list[dict], mag_min=None, mag_max=None) -> list[dict]:
+    """Returns the tiers that can have stars within a magnitude range (of the `magnitude` column)"""
+    selected = []
+    for tier in tiers:
+        if tier["magnitude"] is None:
+            continue
+        low, high = tier["magnitude"]
+        if mag_min is not None and high < mag_min:
+            continue
+        if mag_max is not None and low > mag_max:
+            continue
+        selected.append(tier)
+    return selected
+
+
+def partition_names(source_path) -> list[str]:
+    """
+    Returns the partition directories of a build (relative to it), including the partitions of
+    each tier if it's a tiered build
+    """
+    source_path = Path(source_path)
+    roots = [source_path]
+    if is_tiered(source_path):
+        roots = [source_path / tier["path"] for tier in read_index(source_path)]
+
+    return sorted(
+        str(item.relative_to(source_path))
+        for root in roots
+        if root.exists()
+        for item in root.iterdir()
+        if item.is_dir() and not item.name.startswith("_")
+    )
+
+
+@click.command()
+@click.option("--source", help="Source path of a tiered build")
+def main(source):
+    """Updates the index of a tiered build, and prints it"""
+    update_index(source)
+    for tier in read_index(source):
+        magnitude = tier["magnitude"] or ["-", "-"]
+        print(
+            f"{tier['path']} | nside {tier['nside']} | mag {tier['mag_min']} - {tier['mag_max']} "
+            f"(stars {magnitude[0]} - {magnitude[1]}) | {tier['partitions']:,} partitions "
+            f"| {tier['rows']:,} rows | {tier['bytes'] / 1024**2:,.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,10 @@
+import resource
+import sys
+
+import numpy as np
+import polars as pl
+
+
 def tycho2_bv_v(mag_bt, mag_vt) -> tuple[float, float]:
     """
     Calculates B-V and Johnson V magnitude from Tycho-2 data.
@@ -58,3 +65,169 @@ def get_bv_v(phot_g_mean_mag, bp_rp) -> tuple[float, float]:
     bt = get_bt(phot_g_mean_mag, bp_rp)
     vt = get_vt(phot_g_mean_mag, bp_rp)
     return tycho2_bv_v(mag_bt=bt, mag_vt=vt)
+
+
+# Polynomial coefficients of G-BT and G-VT in terms of bp_rp, in ascending order of power
+# (Table 5.6, same source as `get_bt` and `get_vt`)
+G_BT_COEFFICIENTS = (-0.004288, -0.8547, 0.1244, -0.9085, 0.4843, -0.06814)
+G_VT_COEFFICIENTS = (-0.01077, -0.0682, -0.2387, 0.02342)
+
+
+def horner(x, coefficients):
+    """
+    Evaluates a polynomial with Horner's method.
+
+    Coefficients are in ascending order of power. `x` can be a float, a NumPy array or a Polars expression.
+    """
+    result = coefficients[-1]
+    for c in reversed(coefficients[:-1]):
+        result = result * x + c
+    return result
+
+
+def get_bt_array(phot_g_mean_mag, bp_rp):
+    """Vectorized `get_bt`, for NumPy arrays or Polars expressions. Nulls (or NaNs) propagate."""
+    return phot_g_mean_mag - horner(bp_rp, G_BT_COEFFICIENTS)
+
+
+def get_vt_array(phot_g_mean_mag, bp_rp):
+    """Vectorized `get_vt`, for NumPy arrays or Polars expressions. Nulls (or NaNs) propagate."""
+    return phot_g_mean_mag - horner(bp_rp, G_VT_COEFFICIENTS)
+
+
+def tycho2_bv_v_array(mag_bt, mag_vt) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorized `tycho2_bv_v` for NumPy arrays, where NaN is treated as None"""
+    mag_bt = np.asarray(mag_bt, dtype=np.float64)
+    mag_vt = np.asarray(mag_vt, dtype=np.float64)
+    missing = np.isnan(mag_bt) | np.isnan(mag_vt)
+
+    bv = np.where(missing, np.nan, 0.850 * (mag_bt - mag_vt))
+    mag = np.where(
+        missing,
+        np.where(np.isnan(mag_vt) | (mag_vt == 0), mag_bt, mag_vt),
+        mag_vt - 0.09 * (mag_bt - mag_vt),
+    )
+    return bv, mag
+
+
+def tycho2_bv_v_expr(mag_bt: pl.Expr, mag_vt: pl.Expr) -> tuple[pl.Expr, pl.Expr]:
+    """Vectorized `tycho2_bv_v` as Polars expressions, where null is treated as None"""
+    missing = mag_bt.is_null() | mag_vt.is_null()
+
+    bv = pl.when(missing).then(None).otherwise(0.850 * (mag_bt - mag_vt))
+    mag = (
+        pl.when(~missing)
+        .then(mag_vt - 0.09 * (mag_bt - mag_vt))
+        .when(mag_vt.is_null() | (mag_vt == 0))
+        .then(mag_bt)
+        .otherwise(mag_vt)
+    )
+    return bv, mag
+
+
+def get_bv_v_array(phot_g_mean_mag, bp_rp) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorized `get_bv_v` for NumPy arrays"""
+    phot_g_mean_mag = np.asarray(phot_g_mean_mag, dtype=np.float64)
+    bp_rp = np.asarray(bp_rp, dtype=np.float64)
+    bt = get_bt_array(phot_g_mean_mag, bp_rp)
+    vt = get_vt_array(phot_g_mean_mag, bp_rp)
+    return tycho2_bv_v_array(mag_bt=bt, mag_vt=vt)
+
+
+def get_bv_v_expr(phot_g_mean_mag: pl.Expr, bp_rp: pl.Expr) -> tuple[pl.Expr, pl.Expr]:
+    """Vectorized `get_bv_v` as Polars expressions"""
+    bt = get_bt_array(phot_g_mean_mag, bp_rp)
+    vt = get_vt_array(phot_g_mean_mag, bp_rp)
+    return tycho2_bv_v_expr(mag_bt=bt, mag_vt=vt)
+
+
+def v_range(g_min, g_max, bp_rp_min, bp_rp_max) -> tuple[float, float]:
+    """
+    Returns the range of V magnitudes (from `get_bv_v`) of stars with G magnitudes and bp_rp in the given
+    ranges. V is G plus a polynomial of bp_rp (V = VT - 0.09 * (BT - VT), with BT and VT both G minus a
+    polynomial of bp_rp), so its extremes are at the ends of the bp_rp range or where its derivative is 0.
+    """
+    # V - G
+    correction = 0.09 * np.polynomial.Polynomial(
+        G_BT_COEFFICIENTS
+    ) - 1.09 * np.polynomial.Polynomial(G_VT_COEFFICIENTS)
+    extremes = [bp_rp_min, bp_rp_max] + [
+        r.real
+        for r in correction.deriv().roots()
+        if abs(r.imag) < 1e-12 and bp_rp_min < r.real < bp_rp_max
+    ]
+    values = correction(np.array(extremes))
+    return g_min + values.min(), g_max + values.max()
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """SplitMix64 hash of an array of unsigned 64-bit integers"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def sample_mask(source_ids, seed: int, sample_rate: float) -> np.ndarray:
+    """
+    Returns boolean mask of which sources to keep when sampling.
+
+    Each source's keep/drop decision only depends on its id and the seed, so samples are the same however
+    the build is parallelized, and a sample at a lower rate is always a subset of one at a higher rate.
+    """
+    if sample_rate >= 1:
+        return np.ones(len(source_ids), dtype=bool)
+
+    return sample_values(source_ids, seed) < sample_rate
+
+
+def sample_values(source_ids, seed: int) -> np.ndarray:
+    """Returns a uniform value in [0, 1) for each source, that only depends on its id and the seed"""
+    source_ids = np.asarray(source_ids, dtype=np.int64).astype(np.uint64)
+    key = splitmix64(np.array([(seed or 0) % 2**64], dtype=np.uint64))
+    hashed = splitmix64(source_ids ^ key)
+    # top 53 bits as a uniform float in [0, 1)
+    return (hashed >> np.uint64(11)) * 2.0**-53
+
+
+def wkb_points(x, y) -> bytes:
+    """
+    Encodes arrays of coordinates as a contiguous buffer of little-endian WKB points.
+
+    Each point is 21 bytes: byte order (1), geometry type (uint32) and two float64 coordinates.
+    """
+    wkb = np.empty(
+        len(x),
+        dtype=np.dtype(
+            [("byte_order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")]
+        ),
+    )
+    wkb["byte_order"] = 1
+    wkb["type"] = 1
+    wkb["x"] = x
+    wkb["y"] = y
+    return wkb.tobytes()
+
+
+def reset_peak_rss():
+    """Resets the peak RSS of this process, so it can be measured per task (Linux only, a no-op elsewhere)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> float:
+    """Returns peak RSS of this process in MB, since the last `reset_peak_rss` on Linux"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in bytes on macOS, and kilobytes on Linux
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
@@ -0,0 +1,238 @@
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+import build
+import constellations
+import manifest
+import settings
+import squash
+import synthetic
+import utils
+from bench_utils import build_source_file, files_written
+
+"""
+Checks that the fast paths of the pipeline give the same results as the slower code they replaced, and
+exits non-zero if any of them doesn't (`make bench` runs it first, the benchmarks only time them):
+
+    constellations: the batched grid lookup against skyfield's per-star `constellation_map`
+    photometry: the NumPy and Polars versions of the photometric conversions against the scalar ones
+    squash: the external merge sort of a partition against sorting it in memory (with and without a sub-index)
+    manifest: merging builds (src/manifest.py) refuses builds with different parameters
+
+Each check prints its number of mismatches.
+"""
+
+
+def check_constellations(rows, seed) -> int:
+    """Returns the number of positions where the batched lookup disagrees with the per-star lookup"""
+    rng = np.random.default_rng(seed)
+    # a dense regular grid crosses every boundary, on top of random positions
+    grid_ra, grid_dec = np.meshgrid(np.arange(0, 360, 0.5), np.arange(-90, 90, 0.5))
+    ra = np.concatenate([rng.uniform(0, 360, rows), grid_ra.ravel()])
+    dec = np.concatenate(
+        [np.degrees(np.arcsin(rng.uniform(-1, 1, rows))), grid_dec.ravel()]
+    )
+
+    expected = [
+        build.constellation_map(build.position_of_radec(r / 15, d)).lower()
+        for r, d in zip(ra, dec)
+    ]
+    batched = constellations.constellation_ids(ra, dec)
+    return int((batched != np.array(expected)).sum())
+
+
+def count_mismatches(values, expected, atol=1e-9) -> int:
+    """Returns the number of values that differ from the expected ones (where NaN, i.e. null, matches NaN)"""
+    values = np.asarray(values, dtype=np.float64)
+    return int((~np.isclose(values, expected, rtol=0, atol=atol, equal_nan=True)).sum())
+
+
+def check_photometry(rows, seed) -> int:
+    """Returns the number of B-V and V values where the vectorized conversions disagree with the scalar ones"""
+    rng = np.random.default_rng(seed)
+    phot_g_mean_mag = rng.uniform(3, 21, rows)
+    bp_rp = rng.uniform(-1, 6, rows)
+    phot_g_mean_mag[rng.random(rows) < 0.01] = np.nan
+    bp_rp[rng.random(rows) < 0.1] = np.nan
+    bp_rp[:10] = 0
+
+    expected = np.array(
+        [
+            utils.get_bv_v(g, b) if not np.isnan(g + b) else (None, None)
+            for g, b in zip(phot_g_mean_mag, bp_rp)
+        ],
+        dtype=np.float64,
+    )
+    df = pl.DataFrame({"phot_g_mean_mag": phot_g_mean_mag, "bp_rp": bp_rp})
+    bv_expr, v_expr = utils.get_bv_v_expr(pl.col("phot_g_mean_mag"), pl.col("bp_rp"))
+    converted = df.with_columns(pl.all().fill_nan(None)).select(bv=bv_expr, v=v_expr)
+    mismatches = sum(
+        count_mismatches(values, expected[:, i])
+        for i, values in enumerate(utils.get_bv_v_array(phot_g_mean_mag, bp_rp))
+    )
+    mismatches += sum(
+        count_mismatches(converted[c].to_numpy(), expected[:, i])
+        for i, c in enumerate(["bv", "v"])
+    )
+
+    # Tycho-2 conversion on its own, where only one of the magnitudes can be missing
+    mag_bt = rng.choice([np.nan, 0, 1], rows) * rng.uniform(3, 21, rows)
+    mag_vt = rng.choice([np.nan, 0, 1], rows) * rng.uniform(3, 21, rows)
+
+    def scalar(value):
+        return None if np.isnan(value) else float(value)
+
+    expected = np.array(
+        [utils.tycho2_bv_v(scalar(bt), scalar(vt)) for bt, vt in zip(mag_bt, mag_vt)],
+        dtype=np.float64,
+    )
+    df = pl.DataFrame({"bt": mag_bt, "vt": mag_vt})
+    bv_expr, v_expr = utils.tycho2_bv_v_expr(pl.col("bt"), pl.col("vt"))
+    converted = df.with_columns(pl.all().fill_nan(None)).select(bv=bv_expr, v=v_expr)
+    mismatches += sum(
+        count_mismatches(values, expected[:, i])
+        for i, values in enumerate(utils.tycho2_bv_v_array(mag_bt, mag_vt))
+    )
+    mismatches += sum(
+        count_mismatches(converted[c].to_numpy(), expected[:, i])
+        for i, c in enumerate(["bv", "v"])
+    )
+    return mismatches
+
+
+def check_squash(rows, seed, num_files=4, memory_limit=0.05) -> int:
+    """
+    Returns the number of rows of a partition that the external merge sort writes in a different order
+    than the in-memory sort (with a memory limit small enough that every batch is spilled to its own run)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        gaia_path = Path(tmp) / "gaia"
+        (gaia_path / "gaia_source").mkdir(parents=True)
+        destination = Path(tmp) / "build"
+        for n in range(num_files):
+            synthetic.write_source_file(
+                gaia_path / "gaia_source" / f"GaiaSource_{n:06}.csv.gz",
+                rows // num_files,
+                seed=seed + n,
+            )
+            build_source_file(
+                gaia_path,
+                None,
+                variants=[build.Variant(destination, 1, 6, 30, 1.0)],
+                index=n,
+            )
+        partition = max(
+            destination.glob("healpix_index=*"), key=lambda p: files_written(p)[1]
+        )
+
+        mismatches = 0
+        for subindex_nside in [0, 64]:
+            squashed = {}
+            for limit in [0, memory_limit]:
+                source_path = Path(tmp) / f"squash-{subindex_nside}-{limit}"
+                shutil.copytree(partition, source_path / partition.name)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    squash.squash_partition(
+                        partition.name,
+                        source_path,
+                        memory_limit=limit,
+                        subindex_nside=subindex_nside,
+                    )
+                squashed[limit] = pq.read_table(
+                    source_path / partition.name / settings.SQUASHED_FILENAME
+                )
+
+            expected, external = squashed[0], squashed[memory_limit]
+            if external.num_rows != expected.num_rows:
+                mismatches += max(external.num_rows, expected.num_rows)
+            else:
+                mismatches += int(
+                    (external["pk"].to_numpy() != expected["pk"].to_numpy()).sum()
+                )
+        return mismatches
+
+
+def write_manifest_build(destination, index, nside):
+    """Writes a build of one (empty) fragment, with its manifest entry"""
+    fragment = f"healpix_index=0/fragment-{index}.parquet"
+    (Path(destination) / fragment).parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(settings.SCHEMA.empty_table(), Path(destination) / fragment)
+    manifest.append(
+        destination,
+        dict(
+            index=index,
+            status="done",
+            source=dict(filename=f"GaiaSource_{index:06}.csv.gz", size=0, mtime=0),
+            params=dict(nside=nside, mag_min=6, mag_max=16, sample_rate=1.0),
+            fragments=[fragment],
+        ),
+    )
+
+
+def check_manifest(rows, seed) -> int:
+    """Returns the number of merges of builds that went through with different parameters (or didn't with the same)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        builds = {name: Path(tmp) / name for name in ["nside-8", "nside-4", "merged"]}
+        write_manifest_build(builds["nside-8"], 0, 8)
+        write_manifest_build(builds["nside-4"], 1, 4)
+        write_manifest_build(builds["merged"], 2, 8)
+
+        mismatches = 0
+        for name, expected_error in [("nside-4", True), ("nside-8", False)]:
+            args = ["--source", str(builds[name]), "--destination", builds["merged"]]
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    manifest.main(args, standalone_mode=False)
+                mismatches += expected_error
+            except click.ClickException:
+                mismatches += not expected_error
+        # the refused merge didn't copy anything
+        mismatches += sorted(manifest.read(builds["merged"])) != [0, 2]
+        return int(mismatches)
+
+
+CHECKS = {
+    "constellations": check_constellations,
+    "photometry": check_photometry,
+    "squash": check_squash,
+    "manifest": check_manifest,
+}
+
+
+@click.command()
+@click.option(
+    "--check",
+    "checks",
+    multiple=True,
+    type=click.Choice(list(CHECKS)),
+    default=list(CHECKS),
+    help="Checks to run (can be repeated, defaults to all)",
+)
+@click.option("--rows", default=50_000, help="Number of random stars of each check")
+@click.option("--seed", default=2016, help="Seed of the random stars")
+def main(checks, rows, seed):
+    failed = []
+    for name in checks:
+        time_start = time.time()
+        mismatches = CHECKS[name](rows, seed)
+        print(
+            f"{name:<15} | {mismatches:,} mismatches | {time.time() - time_start:.2f}s"
+        )
+        if mismatches:
+            failed.append(name)
+
+    if failed:
+        raise click.ClickException(f"Mismatches in: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()